@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+# AR benchmark of the fba_sv1.py stages, on synthetic catalogues
+# AR no need of NERSC/KPNO: the desitarget readers are replaced by local stand-ins,
+# AR    returning synthetic target/sky/skysupp/gfa catalogues in the tile
+# AR    with realistic densities (scaled by --densities)
+# AR timed stages: selection, mtl, sky (with dedup), gfa, std, targ, dithering, plotting
+# AR fiberassign itself (run_assign_full, run_merge) is not timed
+# AR e.g.: python bench_fba_sv1.py --outdir /tmp/bench/ --densities 1,10,100
+
+import os
+import numpy as np
+import fitsio
+from time import time
+from argparse import ArgumentParser
+from astropy.io import fits
+from astropy.table import Table
+from astropy import units
+from astropy.coordinates import SkyCoord
+from desitarget.cmx.cmx_targetmask import cmx_mask
+from fiberassign.utils import Logger
+from desiutil.redirect import stdouterr_redirected
+import fba_sv1
+
+
+# AR typical densities [deg-2] for the 1x case
+# AR targets: one CMX_TARGET bit per object
+targ_densities = {
+    "SV0_WD": 3,
+    "SV0_LRG": 600,
+    "SV0_ELG": 2400,
+    "SV0_QSO": 260,
+    "SV0_BGS": 1400,
+    "SV0_MWS_FAINT": 700,
+    "STD_FAINT": 150,
+    "STD_BRIGHT": 60,
+    "STD_DITHER": 30,
+}
+sky_density = 2500
+skysupp_density = 500
+gfa_density = 2000
+# AR fraction of skies-supp duplicated in the skies (to exercise the dedup)
+skysupp_dupfrac = 0.01
+# AR radius [deg] of the disc where the synthetic objects are drawn
+bench_radius = 1.65
+# AR number of fibers/sky fibers for the synthetic FIBERASSIGN extension
+bench_nfiber = 5000
+bench_nsky = 400
+
+
+# AR uniform positions in a disc of radius bench_radius around (tilera, tiledec)
+def get_disc_radecs(rng, n, tilera, tiledec):
+    r = bench_radius * np.sqrt(rng.random(n))
+    theta = 2 * np.pi * rng.random(n)
+    tsky = SkyCoord(ra=tilera * units.deg, dec=tiledec * units.deg, frame="icrs")
+    c = tsky.directional_offset_by(theta * units.rad, r * units.deg)
+    return c.ra.value, c.dec.value
+
+
+# AR columns from fba_sv1.mtldatamodel that are in the target catalogues
+# AR (the other ones are added by fba_sv1.cmx_make_mtl())
+def get_mtl_columns():
+    return [
+        (key, fba_sv1.mtldatamodel[key].dtype.str)
+        for key in [
+            "RA",
+            "DEC",
+            "PARALLAX",
+            "PMRA",
+            "PMDEC",
+            "REF_EPOCH",
+            "TARGETID",
+            "SUBPRIORITY",
+            "PRIORITY_INIT",
+            "NUMOBS_INIT",
+        ]
+    ]
+
+
+# AR synthetic target catalogue
+def get_targ(rng, density, tilera, tiledec, tidoff):
+    # density : density scaling
+    # tidoff  : TARGETID offset
+    area = np.pi * bench_radius ** 2
+    ns = {msk: int(density * targ_densities[msk] * area) for msk in targ_densities}
+    n = np.sum(list(ns.values()))
+    d = np.zeros(
+        n,
+        dtype=get_mtl_columns()
+        + [
+            ("CMX_TARGET", ">i8"),
+            ("FLUX_G", ">f4"),
+            ("FLUX_R", ">f4"),
+            ("FLUX_Z", ">f4"),
+            ("GAIA_PHOT_G_MEAN_MAG", ">f4"),
+            ("GAIA_PHOT_RP_MEAN_MAG", ">f4"),
+            ("GAIA_ASTROMETRIC_EXCESS_NOISE", ">f4"),
+        ],
+    )
+    d["RA"], d["DEC"] = get_disc_radecs(rng, n, tilera, tiledec)
+    d["TARGETID"] = tidoff + np.arange(n)
+    d["SUBPRIORITY"] = rng.random(n)
+    d["CMX_TARGET"] = np.repeat(
+        [cmx_mask[msk] for msk in ns], [ns[msk] for msk in ns]
+    )
+    d["PRIORITY_INIT"] = rng.integers(1000, 3500, n)
+    d["NUMOBS_INIT"] = 1
+    d["PARALLAX"] = np.abs(rng.normal(0.5, 0.5, n))
+    d["PMRA"], d["PMDEC"] = rng.normal(0, 5, n), rng.normal(0, 5, n)
+    d["REF_EPOCH"] = 2015.5
+    rmag = rng.uniform(16, 23, n)
+    d["FLUX_R"] = 10 ** (-0.4 * (rmag - 22.5))
+    d["FLUX_G"] = d["FLUX_R"] * 10 ** (-0.4 * rng.normal(0.6, 0.3, n))
+    d["FLUX_Z"] = d["FLUX_R"] * 10 ** (0.4 * rng.normal(0.6, 0.3, n))
+    d["GAIA_PHOT_G_MEAN_MAG"] = rmag + 0.2
+    d["GAIA_PHOT_RP_MEAN_MAG"] = rmag - 0.2
+    d["GAIA_ASTROMETRIC_EXCESS_NOISE"] = np.abs(rng.normal(0, 0.5, n))
+    return d
+
+
+# AR synthetic sky catalogue
+def get_sky(rng, n, tilera, tiledec, tidoff):
+    # n      : number of skies
+    # tidoff : TARGETID offset
+    d = np.zeros(
+        n,
+        dtype=[
+            ("RA", ">f8"),
+            ("DEC", ">f8"),
+            ("TARGETID", ">i8"),
+            ("DESI_TARGET", ">i8"),
+            ("SUBPRIORITY", ">f8"),
+            ("OBSCONDITIONS", ">i8"),
+            ("BLOBDIST", ">f4"),
+            ("APFLUX_G", ">f4"),
+            ("APFLUX_R", ">f4"),
+            ("APFLUX_Z", ">f4"),
+        ],
+    )
+    d["RA"], d["DEC"] = get_disc_radecs(rng, n, tilera, tiledec)
+    d["TARGETID"] = tidoff + np.arange(n)
+    d["DESI_TARGET"] = 2 ** 32  # AR SKY bit
+    d["SUBPRIORITY"] = rng.random(n)
+    d["OBSCONDITIONS"] = 2 ** 16 - 1
+    d["BLOBDIST"] = rng.uniform(0, 10, n)
+    for key in ["APFLUX_G", "APFLUX_R", "APFLUX_Z"]:
+        d[key] = rng.normal(0, 0.05, n)
+    return d
+
+
+# AR synthetic gfa catalogue
+def get_gfa(rng, n, tilera, tiledec, tidoff):
+    # n      : number of gfa targets
+    # tidoff : TARGETID offset
+    d = np.zeros(
+        n,
+        dtype=[
+            ("RA", ">f8"),
+            ("DEC", ">f8"),
+            ("TARGETID", ">i8"),
+            ("PARALLAX", ">f4"),
+            ("PMRA", ">f4"),
+            ("PMDEC", ">f4"),
+            ("REF_EPOCH", ">f4"),
+            ("GAIA_PHOT_G_MEAN_MAG", ">f4"),
+            ("GAIA_ASTROMETRIC_EXCESS_NOISE", ">f4"),
+        ],
+    )
+    d["RA"], d["DEC"] = get_disc_radecs(rng, n, tilera, tiledec)
+    d["TARGETID"] = tidoff + np.arange(n)
+    d["PARALLAX"] = rng.normal(0.5, 1.0, n)
+    d["PMRA"], d["PMDEC"] = rng.normal(0, 5, n), rng.normal(0, 5, n)
+    d["REF_EPOCH"] = 2015.5
+    d["GAIA_PHOT_G_MEAN_MAG"] = rng.uniform(12, 21, n)
+    d["GAIA_ASTROMETRIC_EXCESS_NOISE"] = np.abs(rng.normal(0, 1.0, n))
+    return d
+
+
+# AR synthetic catalogues, with the same keys as mydirs
+def get_catalogs(density, tilera, tiledec, seed):
+    rng = np.random.default_rng(seed)
+    area = np.pi * bench_radius ** 2
+    cats = {}
+    cats["targ"] = get_targ(rng, density, tilera, tiledec, 0)
+    cats["sky"] = get_sky(rng, int(density * sky_density * area), tilera, tiledec, 10 ** 9)
+    cats["skysupp"] = get_sky(
+        rng, int(density * skysupp_density * area), tilera, tiledec, 2 * 10 ** 9
+    )
+    # AR some duplicates
+    ndup = int(skysupp_dupfrac * len(cats["skysupp"]))
+    cats["skysupp"]["TARGETID"][:ndup] = cats["sky"]["TARGETID"][:ndup]
+    cats["gfa"] = get_gfa(
+        rng, int(density * gfa_density * area), tilera, tiledec, 3 * 10 ** 9
+    )
+    return cats
+
+
+# AR local stand-in for desitarget.io.read_targets_in_tiles()
+# AR returns a copy of the synthetic catalogue for the requested directory
+def get_reader(mydirs, cats):
+    def read_targets_in_tiles(hpdirname, tiles=None, header=False, **kwargs):
+        key = [key for key in mydirs if mydirs[key] == hpdirname][0]
+        d = cats[key].copy()
+        if header:
+            return d, {}
+        return d
+
+    return read_targets_in_tiles
+
+
+# AR synthetic FIBERASSIGN extension, with (bench_nfiber - bench_nsky) assigned targets
+def get_fiberassign(rng, dp):
+    # dp : parent targets (-targ.fits)
+    d = np.zeros(
+        bench_nfiber,
+        dtype=[
+            ("TARGETID", ">i8"),
+            ("OBJTYPE", "S3"),
+            ("PETAL_LOC", ">i2"),
+            ("CMX_TARGET", ">i8"),
+            ("FLUX_G", ">f4"),
+            ("FLUX_R", ">f4"),
+            ("FLUX_Z", ">f4"),
+            ("TARGET_RA", ">f8"),
+            ("TARGET_DEC", ">f8"),
+            ("GAIA_PHOT_RP_MEAN_MAG", ">f4"),
+            ("PRIORITY", ">i8"),
+        ],
+    )
+    d["PETAL_LOC"] = np.arange(bench_nfiber) // (bench_nfiber // 10)
+    d["OBJTYPE"][:bench_nsky] = "SKY"
+    ntgt = min(bench_nfiber - bench_nsky, len(dp))
+    ii = rng.choice(len(dp), size=ntgt, replace=False)
+    jj = bench_nsky + np.arange(ntgt)
+    d["OBJTYPE"][jj] = "TGT"
+    d["TARGETID"][jj] = dp["TARGETID"][ii]
+    d["TARGET_RA"][jj], d["TARGET_DEC"][jj] = dp["RA"][ii], dp["DEC"][ii]
+    for key in [
+        "CMX_TARGET",
+        "FLUX_G",
+        "FLUX_R",
+        "FLUX_Z",
+        "GAIA_PHOT_RP_MEAN_MAG",
+        "PRIORITY",
+    ]:
+        d[key][jj] = dp[key][ii]
+    return d
+
+
+# AR running and timing all stages for a density
+def run_bench(density, mydirs, tdict, seed):
+    rng = np.random.default_rng(seed)
+    times, nrows = {}, {}
+    # AR synthetic catalogues + plugging the reader stand-in
+    t0 = time()
+    tilera, tiledec = tdict["tile"]["RA"][0], tdict["tile"]["DEC"][0]
+    cats = get_catalogs(density, tilera, tiledec, seed)
+    fba_sv1.read_targets_in_tiles = get_reader(mydirs, cats)
+    times["catalogs"], nrows["catalogs"] = time() - t0, np.sum(
+        [len(cats[key]) for key in cats]
+    )
+    fdict = fba_sv1.get_fdict("scidark", 1, seed)
+    # AR selection
+    t0 = time()
+    _ = fba_sv1.select_targ(cats["targ"], fdict)
+    _ = fba_sv1.select_std(cats["targ"], fdict)
+    times["select"], nrows["select"] = time() - t0, len(cats["targ"])
+    # AR mtl building
+    d = fba_sv1.select_targ(cats["targ"], fdict)
+    t0 = time()
+    _ = fba_sv1.cmx_make_mtl(d, "{}-bench-mtl.fits".format(fba_sv1.root))
+    times["mtl"], nrows["mtl"] = time() - t0, len(d)
+    # AR sky dedup
+    t0 = time()
+    _ = fba_sv1.merge_skies(cats["sky"], cats["skysupp"])
+    times["dedup"], nrows["dedup"] = time() - t0, len(cats["sky"]) + len(
+        cats["skysupp"]
+    )
+    # AR stages, with the reader stand-in
+    for stage, func, fargs, keys in [
+        ("sky", fba_sv1.make_sky, (mydirs, tdict, fdict), ["sky", "skysupp"]),
+        ("gfa", fba_sv1.make_gfa, (mydirs, tdict), ["gfa"]),
+        ("std", fba_sv1.make_std, (mydirs, tdict, fdict), ["targ"]),
+        ("targ", fba_sv1.make_targ, (mydirs, tdict, fdict), ["targ"]),
+    ]:
+        t0 = time()
+        func(*fargs)
+        times[stage] = time() - t0
+        nrows[stage] = np.sum([len(cats[key]) for key in keys])
+    # AR dithering (dithprec settings), with synthetic assigned targets
+    dithfdict = fba_sv1.get_fdict("dithprec", 1, seed)
+    dp = fits.open("{}-targ.fits".format(fba_sv1.root))[1].data
+    fafn = "{}-bench-fiberassign.fits".format(fba_sv1.root)
+    fitsio.write(fafn, get_fiberassign(rng, dp), extname="FIBERASSIGN", clobber=True)
+    fa = fits.open(fafn)[1].data
+    t0 = time()
+    tids = fa["TARGETID"][fa["OBJTYPE"] == "TGT"]
+    ginds, linds, _ = fba_sv1.get_dither_inds(dp["TARGETID"], tids, dithfdict, 0)
+    for i in range(dithfdict["ndither"]):
+        _ = fba_sv1.get_dither_radecs(
+            dp["RA"], dp["DEC"], dp["TARGETID"], ginds, linds, dithfdict, 1 + i
+        )
+    times["dither"], nrows["dither"] = time() - t0, len(dp)
+    # AR plotting
+    t0 = time()
+    skyp = SkyCoord(ra=dp["RA"] * units.deg, dec=dp["DEC"] * units.deg, frame="icrs")
+    fba_sv1.plot_tile(
+        tdict["tile"]["TILEID"][0], fa, dp, skyp, tdict["tsky"], fdict, 1, 1
+    )
+    times["plot"], nrows["plot"] = time() - t0, len(dp)
+    return times, nrows
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--outdir",
+        help="output directory",
+        type=str,
+        default=None,
+        required=True,
+        metavar="OUTDIR",
+    )
+    parser.add_argument(
+        "--densities",
+        help="comma-separated density scalings (default=1,10,100)",
+        type=str,
+        default="1,10,100",
+        required=False,
+        metavar="DENSITIES",
+    )
+    parser.add_argument(
+        "--tilera",
+        help="tile centre ra (default=150.119166667, COSMOS)",
+        type=float,
+        default=150.119166667,
+        required=False,
+        metavar="TILERA",
+    )
+    parser.add_argument(
+        "--tiledec",
+        help="tile centre dec (default=2.20583333, COSMOS)",
+        type=float,
+        default=2.20583333,
+        required=False,
+        metavar="TILEDEC",
+    )
+    parser.add_argument(
+        "--seed",
+        help="numpy random seed for the synthetic catalogues (default=1234)",
+        type=int,
+        default=1234,
+        required=False,
+        metavar="SEED",
+    )
+    parser.add_argument(
+        "--outfn",
+        help="output ecsv file with the timings (default=None)",
+        type=str,
+        default=None,
+        required=False,
+        metavar="OUTFN",
+    )
+    bargs = parser.parse_args()
+    if bargs.outdir[-1] != "/":
+        bargs.outdir += "/"
+    if not os.path.isdir(bargs.outdir):
+        os.makedirs(bargs.outdir)
+
+    # AR fba_sv1.py globals
+    tileid = 999999
+    fba_sv1.args = fba_sv1.get_parser().parse_args(
+        [
+            "--outdir",
+            bargs.outdir,
+            "--tileid",
+            str(tileid),
+            "--tilera",
+            str(bargs.tilera),
+            "--tiledec",
+            str(bargs.tiledec),
+            "--flavor",
+            "scidark",
+            "--dtver",
+            "bench",
+            "--seed",
+            str(bargs.seed),
+        ]
+    )
+    fba_sv1.args.gfacachedir = os.path.join(bargs.outdir, "gfa-cache")
+    fba_sv1.log = Logger.get()
+    fba_sv1.start = time()
+    fba_sv1.root = "{}{:06d}".format(bargs.outdir, tileid)
+    mydirs = {key: "synthetic/{}".format(key) for key in ["targ", "sky", "skysupp", "gfa"]}
+    fdict = fba_sv1.get_fdict("scidark", 1, bargs.seed)
+    tdict = fba_sv1.get_tdict([tileid], fdict)
+    fba_sv1.make_tiles(tdict)
+
+    # AR benchmark, with the fba_sv1.py logs in a file
+    rows = []
+    for density in [float(x) for x in bargs.densities.split(",")]:
+        with stdouterr_redirected(to="{}bench-{:g}x.log".format(bargs.outdir, density)):
+            times, nrows = run_bench(density, mydirs, tdict, bargs.seed)
+        for stage in times:
+            rows.append((density, stage, nrows[stage], times[stage]))
+            print(
+                "density={:g}x\tstage={}\tnrows={:.0f}\ttime={:.2f}s".format(
+                    density, stage, nrows[stage], times[stage]
+                )
+            )
+    if bargs.outfn is not None:
+        t = Table(rows=rows, names=["DENSITY", "STAGE", "NROWS", "TIME"])
+        t.write(bargs.outfn, overwrite=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+# AR output-equivalence check of two fba_sv1.py run folders (e.g., before/after an optimization)
+# AR for each fiberassign-{tileid}.fits(.gz) file present in either folder:
+# AR - same HDUs, same columns (names, dtypes), same number of rows
+# AR - same header keywords, except the volatile ones (--ignore), the folder names being masked
+# AR - same per-column digests, computed by chunks of --chunksize rows:
+# AR     digest = sum over the rows of a 64-bit hash of (key, value), i.e. independent of the chunking
+# AR     FIBERASSIGN, SKY_MONITOR, GFA_TARGETS : key = row index (order-aware)
+# AR     TARGETS, POTENTIAL_ASSIGNMENTS, EXTRA : key = TARGETID (row order ignored)
+# AR the columns in --ignore are skipped (e.g., TIMESTAMP)
+# AR for a differing column, the first --nshow differing rows (or TARGETIDs) are reported
+# AR files compared in parallel (--nthread processes); exit code 1 if any difference
+# AR e.g.: python compare_fba_sv1.py --dir1 /tmp/ref/ --dir2 /tmp/new/ --nthread 6
+
+import os
+import sys
+import numpy as np
+import fitsio
+from glob import glob
+from time import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from fiberassign.utils import Logger
+import fba_sv1
+
+
+# AR HDUs compared without the row order, with their key column
+keyed_extnames = {
+    "TARGETS": "TARGETID",
+    "POTENTIAL_ASSIGNMENTS": "TARGETID",
+    "EXTRA": "TARGETID",
+}
+# AR header keywords never compared
+skip_keys = ["COMMENT", "HISTORY", ""]
+
+
+# AR per-row 64-bit hashes of (key, value)
+# AR values in native byte order, -0.0 -> 0.0, all NaNs equal; multi-dimensional/string columns hashed word by word
+def row_hashes(keys, col):
+    # keys : row keys (uint64 array)
+    # col  : column values
+    col = col.astype(col.dtype.newbyteorder("="))
+    if col.dtype.kind == "f":
+        col = np.where(np.isnan(col), np.nan, col + 0.0).astype(col.dtype)
+    b = np.ascontiguousarray(col).reshape(len(col), -1).view(np.uint8)
+    b = b.reshape(len(col), -1)
+    nword = (b.shape[1] + 7) // 8
+    words = np.zeros((len(col), 8 * nword), dtype=np.uint8)
+    words[:, : b.shape[1]] = b
+    words = words.view(np.uint64)
+    h = fba_sv1.splitmix64(keys)
+    for i in range(nword):
+        h = fba_sv1.splitmix64(h ^ words[:, i])
+    return h
+
+
+# AR row keys of a chunk of rows starting at row start: row index, or the key column
+def get_keys(d, extname, start):
+    # d       : chunk of rows (with the key column, if extname in keyed_extnames)
+    # extname : extension name
+    # start   : first row of the chunk
+    if extname in keyed_extnames:
+        return d[keyed_extnames[extname]].astype(np.int64).view(np.uint64)
+    return np.arange(start, start + len(d), dtype=np.uint64)
+
+
+# AR per-column digests of a table HDU, streamed by chunks
+def get_digests(hdu, extname, colnames, chunksize):
+    # hdu       : fitsio HDU
+    # extname   : extension name
+    # colnames  : columns to digest
+    # chunksize : number of rows per chunk
+    digests = {name: 0 for name in colnames}
+    nrows = hdu.get_nrows()
+    for start in range(0, nrows, chunksize):
+        d = hdu[colnames][start : min(start + chunksize, nrows)]
+        keys = get_keys(d, extname, start)
+        for name in colnames:
+            s = int(row_hashes(keys, d[name]).sum(dtype=np.uint64))
+            digests[name] = (digests[name] + s) % 2 ** 64
+    return digests
+
+
+# AR first differing rows of a column (after a digest mismatch)
+# AR order-aware: row indexes; keyed: key values present in only one file with that value
+def get_diff_rows(hdu1, hdu2, extname, name, nshow):
+    # hdu1, hdu2 : fitsio HDUs
+    # extname    : extension name
+    # name       : column name
+    # nshow      : maximum number of reported rows
+    cols = [name]
+    if (extname in keyed_extnames) and (keyed_extnames[extname] != name):
+        cols.append(keyed_extnames[extname])
+    d1, d2 = hdu1.read(columns=cols), hdu2.read(columns=cols)
+    n1, n2 = len(d1), len(d2)
+    col1, col2 = d1[name], d2[name]
+    keys1, keys2 = get_keys(d1, extname, 0), get_keys(d2, extname, 0)
+    h1, h2 = row_hashes(keys1, col1), row_hashes(keys2, col2)
+    rows = []
+    if extname in keyed_extnames:
+        for keys, h, other, col, lab in [
+            (keys1, h1, h2, col1, "dir1"),
+            (keys2, h2, h1, col2, "dir2"),
+        ]:
+            ii = np.where(~np.in1d(h, other))[0]
+            ii = ii[np.argsort(keys[ii].view(np.int64), kind="stable")][:nshow]
+            rows += [
+                "{}={} {}: {}".format(
+                    keyed_extnames[extname], keys[i].view(np.int64), lab, col[i]
+                )
+                for i in ii
+            ]
+    else:
+        n = min(n1, n2)
+        ii = np.where(h1[:n] != h2[:n])[0][:nshow]
+        rows += ["row {}: {} != {}".format(i, col1[i], col2[i]) for i in ii]
+    return rows
+
+
+# AR header keywords, with the folder name masked in the string values
+def get_header_dict(hdu, rundir, ignore):
+    # hdu    : fitsio HDU
+    # rundir : run folder
+    # ignore : keywords not compared
+    hdr = hdu.read_header()
+    hdict = {}
+    for key in hdr.keys():
+        if (key in skip_keys) | (key in ignore):
+            continue
+        val = hdr[key]
+        if isinstance(val, str):
+            val = val.replace(rundir, "{RUNDIR}").replace(
+                rundir.rstrip("/"), "{RUNDIR}"
+            )
+        hdict[key] = val
+    return hdict
+
+
+# AR comparing two fiberassign files; returns the list of differences (empty if equivalent)
+def compare_files(fn1, fn2, dir1, dir2, ignore, chunksize, nshow):
+    # fn1, fn2   : files to compare
+    # dir1, dir2 : run folders
+    # ignore     : header keywords and columns not compared
+    # chunksize  : number of rows per chunk
+    # nshow      : maximum number of reported rows per column
+    diffs = []
+    f1, f2 = fitsio.FITS(fn1), fitsio.FITS(fn2)
+    extnames1 = [hdu.get_extname() for hdu in f1]
+    extnames2 = [hdu.get_extname() for hdu in f2]
+    if extnames1 != extnames2:
+        diffs.append("HDUs: {} != {}".format(extnames1, extnames2))
+    for iext, extname in enumerate(extnames1):
+        if extname not in extnames2:
+            continue
+        hdu1, hdu2 = f1[iext], f2[extnames2.index(extname)]
+        extlab = extname if extname != "" else "PRIMARY"
+        # AR headers
+        h1 = get_header_dict(hdu1, dir1, ignore)
+        h2 = get_header_dict(hdu2, dir2, ignore)
+        for key in sorted(set(h1) | set(h2)):
+            if h1.get(key) != h2.get(key):
+                diffs.append(
+                    "{} header {}: {} != {}".format(extlab, key, h1.get(key), h2.get(key))
+                )
+        if hdu1.get_exttype() == "IMAGE_HDU":
+            continue
+        # AR table structure
+        dtype1, dtype2 = hdu1.get_rec_dtype()[0], hdu2.get_rec_dtype()[0]
+        if dtype1.names != dtype2.names:
+            diffs.append(
+                "{} columns: {} != {}".format(extlab, dtype1.names, dtype2.names)
+            )
+        if hdu1.get_nrows() != hdu2.get_nrows():
+            diffs.append(
+                "{} rows: {} != {}".format(extlab, hdu1.get_nrows(), hdu2.get_nrows())
+            )
+        colnames = [
+            name
+            for name in dtype1.names
+            if (name in dtype2.names) and (name not in ignore)
+        ]
+        for name in colnames:
+            if dtype1[name].newbyteorder("=") != dtype2[name].newbyteorder("="):
+                diffs.append(
+                    "{} {} dtype: {} != {}".format(
+                        extlab, name, dtype1[name], dtype2[name]
+                    )
+                )
+        colnames = [
+            name
+            for name in colnames
+            if dtype1[name].newbyteorder("=") == dtype2[name].newbyteorder("=")
+        ]
+        if (extname in keyed_extnames) and (
+            keyed_extnames[extname] not in colnames
+        ):
+            diffs.append(
+                "{}: no {} column to key the rows".format(
+                    extlab, keyed_extnames[extname]
+                )
+            )
+            continue
+        # AR column digests
+        dig1 = get_digests(hdu1, extname, colnames, chunksize)
+        dig2 = get_digests(hdu2, extname, colnames, chunksize)
+        for name in colnames:
+            if dig1[name] != dig2[name]:
+                diffs.append("{} {}: digests differ".format(extlab, name))
+                diffs += [
+                    "    {}".format(row)
+                    for row in get_diff_rows(hdu1, hdu2, extname, name, nshow)
+                ]
+    f1.close()
+    f2.close()
+    return diffs
+
+
+# AR comparing the files of name in two folders (missing in one of them is a difference)
+def compare_name(name, fns1, fns2, dir1, dir2, ignore, chunksize, nshow):
+    # name       : file name, without .gz
+    # fns1, fns2 : dictionaries of the files of each run folder, keyed by name
+    # dir1, dir2 : run folders
+    # ignore     : header keywords and columns not compared
+    # chunksize  : number of rows per chunk
+    # nshow      : maximum number of reported rows per column
+    if (name not in fns1) | (name not in fns2):
+        return ["missing in {}".format(dir2 if name in fns1 else dir1)]
+    return compare_files(fns1[name], fns2[name], dir1, dir2, ignore, chunksize, nshow)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--dir1",
+        help="reference run folder",
+        type=str,
+        default=None,
+        required=True,
+        metavar="DIR1",
+    )
+    parser.add_argument(
+        "--dir2",
+        help="run folder to compare to DIR1",
+        type=str,
+        default=None,
+        required=True,
+        metavar="DIR2",
+    )
+    parser.add_argument(
+        "--pattern",
+        help="file pattern, in both folders (default=fiberassign-??????.fits*)",
+        type=str,
+        default="fiberassign-??????.fits*",
+        required=False,
+        metavar="PATTERN",
+    )
+    parser.add_argument(
+        "--ignore",
+        help="comma-separated header keywords and columns not compared (default=TIMESTAMP,DATE,CHECKSUM,DATASUM)",
+        type=str,
+        default="TIMESTAMP,DATE,CHECKSUM,DATASUM",
+        required=False,
+        metavar="IGNORE",
+    )
+    parser.add_argument(
+        "--chunksize",
+        help="number of rows read per chunk (default=100000)",
+        type=int,
+        default=100000,
+        required=False,
+        metavar="CHUNKSIZE",
+    )
+    parser.add_argument(
+        "--nshow",
+        help="number of reported differing rows per column (default=5)",
+        type=int,
+        default=5,
+        required=False,
+        metavar="NSHOW",
+    )
+    parser.add_argument(
+        "--nthread",
+        help="number of files compared in parallel, in separate processes (default=1)",
+        type=int,
+        default=1,
+        required=False,
+        metavar="NTHREAD",
+    )
+    cargs = parser.parse_args()
+    for key in ["dir1", "dir2"]:
+        if getattr(cargs, key)[-1] != "/":
+            setattr(cargs, key, getattr(cargs, key) + "/")
+    ignore = cargs.ignore.split(",")
+    start = time()
+
+    # AR files, matched by tileid (.fits or .fits.gz)
+    fns1, fns2 = [
+        {
+            os.path.basename(fn).replace(".gz", ""): fn
+            for fn in glob(os.path.join(rundir, cargs.pattern))
+        }
+        for rundir in [cargs.dir1, cargs.dir2]
+    ]
+    names = sorted(set(fns1) | set(fns2))
+    log.info(
+        "{:.1f}s\t{:.0f} files to compare in {} and {}".format(
+            time() - start, len(names), cargs.dir1, cargs.dir2
+        )
+    )
+
+    # AR processes: fitsio holds the GIL while reading
+    with ProcessPoolExecutor(max_workers=cargs.nthread) as pool:
+        futures = [
+            pool.submit(
+                compare_name,
+                name,
+                fns1,
+                fns2,
+                cargs.dir1,
+                cargs.dir2,
+                ignore,
+                cargs.chunksize,
+                cargs.nshow,
+            )
+            for name in names
+        ]
+        alldiffs = [future.result() for future in futures]
+    ndiff = 0
+    for name, diffs in zip(names, alldiffs):
+        if len(diffs) == 0:
+            log.info("{:.1f}s\t{}: identical".format(time() - start, name))
+        else:
+            ndiff += 1
+            log.info(
+                "{:.1f}s\t{}: {:.0f} differences".format(time() - start, name, len(diffs))
+            )
+            for diff in diffs:
+                print("{}\t{}".format(name, diff))
+    log.info(
+        "{:.1f}s\t{:.0f}/{:.0f} files identical".format(
+            time() - start, len(names) - ndiff, len(names)
+        )
+    )
+    if ndiff > 0:
+        sys.exit(1)
+
+
+log = Logger.get()
+
+
+if __name__ == "__main__":
+    main()
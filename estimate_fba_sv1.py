@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# AR fast surrogate of the fba_sv1.py assignment, to compare tile centres
+# AR no fiberassign run: for a tile centre, counts the positioners (focalplane at --rundate)
+# AR    whose patrol disc reaches at least one target of each class (flavor masks, std, sky)
+# AR    via KD-trees over the focal plane (tangent-plane) positions of the targets
+# AR grid mode (--gridsize > 0): the tile centre is moved on a grid around --tilera,--tiledec
+# AR    the targets are projected once, at --tilera,--tiledec, and the patrol discs are shifted
+# AR    (i.e. the field rotation and distortion changes are neglected for the small offsets)
+# AR candidates ranked by: the std,sky per-petal requirements are met, then the number
+# AR    of positioners reaching a science target (upper bound of the science assignments)
+# AR only the best candidates are then worth a full fba_sv1.py run
+# AR the fba_sv1.py arguments (--outdir, --tilera, --tiledec, --flavor, --dtver, --rundate, ...) are passed as is
+# AR e.g.: python estimate_fba_sv1.py --outdir /tmp/est/ --tilera 115 --tiledec 50 --flavor scidark --dtver 0.47.0 --gridsize 0.5 --gridstep 0.02 --nthread 16
+
+import os
+import sys
+import numpy as np
+from time import time
+from argparse import ArgumentParser
+from astropy.table import Table
+from concurrent.futures import ThreadPoolExecutor
+from scipy.spatial import cKDTree
+from desitarget.cmx.cmx_targetmask import cmx_mask
+from desitarget.io import read_targets_in_cap
+from desimodel.footprint import get_tile_radius_deg
+from desimodel.focalplane import radec2xy
+from fiberassign.utils import Logger
+import fba_sv1
+
+
+# AR (ras, decs) of each target class: flavor masks, std (if addstd), sky
+# AR targets read in a disc covering the fields of all the candidates
+def get_classes(mydirs, radecrad, fdict):
+    # mydirs   : dictionary with the catalogue directories
+    # radecrad : [ra, dec, radius] of the disc [deg]
+    # fdict    : dictionary with the flavor settings
+    classes = {}
+    d = read_targets_in_cap(mydirs["targ"], radecrad)
+    for msk in fdict["msks"].split(","):
+        sel = (d["CMX_TARGET"] & cmx_mask[msk]) > 0
+        classes[msk] = (d["RA"][sel], d["DEC"][sel])
+    if fdict["addstd"]:
+        dstd = fba_sv1.select_std(d, fdict)
+        classes["STD"] = (dstd["RA"], dstd["DEC"])
+    dsky = fba_sv1.merge_skies(
+        read_targets_in_cap(mydirs["sky"], radecrad),
+        read_targets_in_cap(mydirs["skysupp"], radecrad),
+    )
+    classes["SKY"] = (dsky["RA"], dsky["DEC"])
+    return classes
+
+
+# AR scoring one candidate centre: (cx, cy) shift [mm] of the patrol discs
+def get_score(trees, patrol, cx, cy, fdict):
+    # trees  : dictionary of the per-class KD-trees
+    # patrol : positioners patrol discs (see fba_sv1.get_patrol())
+    # cx, cy : candidate centre, in the focal plane of the nominal centre [mm]
+    # fdict  : dictionary with the flavor settings
+    xys = np.array([patrol["X"] + cx, patrol["Y"] + cy]).T
+    npos = {
+        key: trees[key].query_ball_point(xys, patrol["R"], return_length=True)
+        for key in trees
+    }
+    score = {"NPOS_{}".format(key): (npos[key] > 0).sum() for key in npos}
+    sci = np.zeros(len(xys), dtype=bool)
+    for msk in fdict["msks"].split(","):
+        sci |= npos[msk] > 0
+    score["SCORE"] = sci.sum()
+    petals = np.unique(patrol["PETAL"])
+    score["OK"] = True
+    for key, nmin in [("STD", fdict["nstdpet"]), ("SKY", fdict["nskypet"])]:
+        if key in npos:
+            minpet = np.min(
+                [(npos[key][patrol["PETAL"] == petal] > 0).sum() for petal in petals]
+            )
+            score["MINPET_{}".format(key)] = minpet
+            score["OK"] &= minpet >= int(nmin)
+    return score
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--gridsize",
+        help="half-size [deg] of the grid of tile centres around --tilera,--tiledec (default=0, i.e. only --tilera,--tiledec)",
+        type=float,
+        default=0.0,
+        required=False,
+        metavar="GRIDSIZE",
+    )
+    parser.add_argument(
+        "--gridstep",
+        help="step [deg] of the grid of tile centres (default=0.05)",
+        type=float,
+        default=0.05,
+        required=False,
+        metavar="GRIDSTEP",
+    )
+    parser.add_argument(
+        "--ntop",
+        help="number of best candidates printed (default=10)",
+        type=int,
+        default=10,
+        required=False,
+        metavar="NTOP",
+    )
+    parser.add_argument(
+        "--outfn",
+        help="output ecsv file with all the candidates (default=OUTDIR/estimate-TILERA-TILEDEC.ecsv)",
+        type=str,
+        default=None,
+        required=False,
+        metavar="OUTFN",
+    )
+    eargs, fbaargs = parser.parse_known_args()
+
+    # AR fba_sv1.py globals
+    args = fba_sv1.get_parser().parse_args(fbaargs + ["--tileid", "999999"])
+    if args.outdir[-1] != "/":
+        args.outdir += "/"
+    if not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+    if args.tilecachedir is None:
+        args.tilecachedir = os.path.join(args.outdir, "tile-cache")
+    fba_sv1.args = args
+    fba_sv1.log = log
+    fba_sv1.start = start = time()
+    tcat = fba_sv1.get_tilecat(args.tilecachedir)
+    if (args.tilera is None) | (args.tiledec is None):
+        ras, decs, _ = fba_sv1.get_tile_radecs(tcat, [args.intileid])
+        args.tilera, args.tiledec = ras[0], decs[0]
+    tile_in_desi = fba_sv1.is_in_desi(tcat, args.tilera, args.tiledec)[0].astype(int)
+    fdict = fba_sv1.get_fdict(args.flavor, tile_in_desi, args.seed)
+    mydirs = None
+    for path in fba_sv1.get_data_roots(args.datacfg)["targets"]:
+        tmpdirs = fba_sv1.get_mydirs(path, fdict)
+        if np.all([os.path.isdir(d) for d in tmpdirs.values()]):
+            mydirs = tmpdirs
+            break
+    if mydirs is None:
+        log.error("no catalogues found; exiting")
+        sys.exit(1)
+
+    # AR candidate centres
+    offs = np.arange(-eargs.gridsize, eargs.gridsize + 1e-6, eargs.gridstep)
+    if eargs.gridsize == 0:
+        offs = np.zeros(1)
+    doffs, roffs = [o.flatten() for o in np.meshgrid(offs, offs)]
+    cdecs = args.tiledec + doffs
+    cras = (args.tilera + roffs / np.cos(np.radians(cdecs))) % 360
+    log.info(
+        "{:.1f}s\t{:.0f} candidate centres within {:.2f} deg".format(
+            time() - start, len(cras), eargs.gridsize
+        )
+    )
+
+    # AR targets read once, in the disc around --tilera,--tiledec reaching the farthest candidate field
+    seps = np.degrees(
+        np.arccos(
+            np.clip(
+                np.sin(np.radians(args.tiledec)) * np.sin(np.radians(cdecs))
+                + np.cos(np.radians(args.tiledec))
+                * np.cos(np.radians(cdecs))
+                * np.cos(np.radians(cras - args.tilera)),
+                -1,
+                1,
+            )
+        )
+    )
+    radecrad = [args.tilera, args.tiledec, get_tile_radius_deg() + seps.max()]
+    log.info(
+        "{:.1f}s\treading the targets within {:.2f} deg".format(
+            time() - start, radecrad[2]
+        )
+    )
+    classes = get_classes(mydirs, radecrad, fdict)
+
+    # AR KD-trees over the focal plane positions at the nominal centre (positioners in a good state)
+    patrol = fba_sv1.get_patrol(args.rundate)
+    sel = (patrol["DEVICE_TYPE"] == "POS") & patrol["GOOD"]
+    patrol = {key: patrol[key][sel] for key in patrol}
+    trees = {}
+    for key in classes:
+        xs, ys = radec2xy(args.tilera, args.tiledec, classes[key][0], classes[key][1])
+        trees[key] = cKDTree(np.array([xs, ys]).T)
+        log.info(
+            "{:.1f}s\t{}: {:.0f} targets".format(time() - start, key, len(xs))
+        )
+    cxs, cys = radec2xy(args.tilera, args.tiledec, cras, cdecs)
+
+    # AR scoring the candidates
+    t0 = time()
+    with ThreadPoolExecutor(max_workers=args.nthread) as pool:
+        scores = list(
+            pool.map(
+                lambda i: get_score(trees, patrol, cxs[i], cys[i], fdict),
+                range(len(cras)),
+            )
+        )
+    log.info(
+        "{:.1f}s\t{:.0f} candidates scored in {:.1f}s ({:.1f} ms per candidate, {} threads)".format(
+            time() - start,
+            len(cras),
+            time() - t0,
+            1e3 * (time() - t0) / len(cras),
+            args.nthread,
+        )
+    )
+    t = Table()
+    t["RA"], t["DEC"] = cras, cdecs
+    for key in scores[0]:
+        t[key] = [score[key] for score in scores]
+    t = t[np.lexsort([-t["SCORE"], ~t["OK"]])]
+    for i in range(min(eargs.ntop, len(t))):
+        print(
+            "--tilera {:.4f} --tiledec {:.4f}\tSCORE={}\tOK={}\t{}".format(
+                t["RA"][i],
+                t["DEC"][i],
+                t["SCORE"][i],
+                t["OK"][i],
+                " ".join(
+                    "{}={}".format(key, t[key][i])
+                    for key in t.colnames
+                    if key not in ["RA", "DEC", "SCORE", "OK"]
+                ),
+            )
+        )
+    if eargs.outfn is None:
+        eargs.outfn = "{}estimate-{:.3f}-{:.3f}.ecsv".format(
+            args.outdir, args.tilera, args.tiledec
+        )
+    t.write(eargs.outfn, overwrite=True)
+    log.info("{:.1f}s\t{} written".format(time() - start, eargs.outfn))
+
+
+log = Logger.get()
+
+
+if __name__ == "__main__":
+    main()
@@ -4,23 +4,45 @@
 
 import os
 import sys
+import json
+import fcntl
+import hashlib
+import shutil
+import subprocess
+import threading
 import numpy as np
 from glob import glob
 from astropy.io import fits
 from astropy.table import Table
 import fitsio
-from desitarget.io import read_targets_in_tiles, write_targets, write_mtl
+from desitarget.io import (
+    read_targets_in_tiles,
+    write_targets,
+    write_mtl,
+    check_hp_target_dir,
+)
 from desitarget.cmx.cmx_targetmask import cmx_mask
 from desitarget.targetmask import obsconditions
 from desitarget.targets import set_obsconditions
-from desimodel.footprint import is_point_in_desi
+from desimodel.footprint import (
+    is_point_in_desi,
+    radec2pix,
+    tiles2pix,
+    get_tile_radius_deg,
+)
+from desimodel.focalplane import radec2xy
+from desimodel.focalplane.gfa import on_gfa
+import healpy as hp
 import desimodel.io as dmio
 from fiberassign.scripts.assign import parse_assign, run_assign_bytile, run_assign_full
 from fiberassign.scripts.merge import parse_merge, run_merge
 from fiberassign.utils import Logger
 import fiberassign
-from time import time
-from datetime import datetime
+from time import time, sleep
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import get_context
+from scipy.spatial import cKDTree
 import matplotlib.pyplot as plt
 from matplotlib import gridspec
 import matplotlib
@@ -28,9 +50,14 @@ from astropy import units
 from astropy.coordinates import SkyCoord, Distance
 from astropy.time import Time
 from argparse import ArgumentParser
-from collections import Counter
 from desiutil.redirect import stdouterr_redirected
 
+# AR optional, for --intermediate-format arrow
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
 
 # AR copied from make_mtl()
 mtldatamodel = np.array(
@@ -65,17 +92,559 @@ mtldatamodel = np.array(
 
 # AR extra-hdu for dithering
 extradatamodel = np.array(
-    [], dtype=[("UNDITHER_RA", ">f8"), ("UNDITHER_DEC", ">f8"), ("TARGETID", ">i8")]
+    [],
+    dtype=[
+        ("UNDITHER_RA", ">f8"),
+        ("UNDITHER_DEC", ">f8"),
+        ("TARGETID", ">i8"),
+        ("DITHER_CLASS", "i1"),
+    ],
+)
+
+# AR summary index (fba-summary.fits)
+summarydatamodel = np.array(
+    [],
+    dtype=[
+        ("TILEID", ">i4"),
+        ("FLAVOR", "S10"),
+        ("PETAL", ">i2"),
+        ("CLASS", "S20"),
+        ("NASSIGN", ">i4"),
+        ("NAVAIL", ">i4"),
+        ("COMPLETENESS", ">f4"),
+        ("FATIME", ">f4"),
+        ("TIMESTAMP", "S19"),
+    ],
 )
 
+# AR DITHER_CLASS values
+dither_classes = {"none": 0, "gauss": 1, "box": 2}
 
-# AR ! not using make_mtl !
-# AR for commissioning, Adam says we should not use make_mtl, assign mtl columns by hand [email Oct, 17 2020]
+
+# AR nside (nested) of the cache of GFA positions propagated to --epoch
+gfa_cache_nside = 64
+
+# AR tile catalogue (see get_tilecat()), loaded once per process
+tilecat = {}
+tilecat_nside = 256
+
+# AR multi-tile MTL ledger (--batch): NUMOBS_MORE, PRIORITY of the targets
+# AR assigned on the previous tiles of the batch, arrays sorted by TARGETID
+# AR None if not running a batch
+ledger = None
+# AR PRIORITY of the targets with NUMOBS_MORE=0 (as DONE in desitarget)
+ledger_done_priority = 2
+# AR MTL bookkeeping columns ignored by the incremental comparison (--incremental):
+# AR TIMESTAMP, VERSION change at each run; NUMOBS, Z, ZWARN are not initialized (np.empty)
+incr_ignored_cols = ["TIMESTAMP", "VERSION", "TARGET_STATE", "NUMOBS", "Z", "ZWARN"]
+
+# AR concurrent catalogue reads (--nthread > 1): futures of read_hpdir(), per mydirs key
+# AR filled in main(), awaited by the stages through read_mydir()
+catreads = {}
+
+# AR margin [arcsec] around the GFA chips for the GFA footprint filter (--gfafilter)
+# AR larger than the 100 arcsec buffer of fiberassign, to allow for the PM propagation
+gfa_margin_arcsec = 120
+
+# AR positioner patrol discs (see get_patrol()), per rundate, loaded once per process
+patrols = {}
+# AR margin [mm] added to the patrol radius for the reachability prefilter (--prefilter),
+# AR absorbing the approximations (outer disc, no field rotation) w.r.t. fiberassign
+prefilter_margin = 0.5
+
+# AR run manifest (--resume): completed steps (stages, tiles, plots), in order
+# AR saved to {root}-manifest.json after each step (see init_manifest())
+manifest = {"fn": None, "steps": []}
+
+
+# AR settings common to all flavors (can be overwritten in flavors)
+fdict_default = {
+    # AR allowing all observing conditions for the cmx tiles, whatever the flavor
+    "obscon": "DARK|GRAY|BRIGHT",
+    # AR minimum number of sky/std fibres per petal
+    "nskypet": "40",
+    "nstdpet": "10",
+    # AR (no) dithering initialisation
+    "seed": -1,  # AR random seed
+    "ndither": 0,  # AR number of dithered tiles
+    "gfrac": 0.0,  # AR fraction of assigned stars that are dithered with a Gaussian
+    "gwidth": 0.0,  # AR offset [arcsec] per coordinate normal distribution
+    "bfrac": 0.0,  # AR fraction of assigned stars  that are dithered within a box for the dithlost-in-space case
+    "bwidth": 0.0,  # AR box width [arcsec] of the dithering for the dithlost-in-space case
+    # AR flavor behaviour
+    "dither": False,  # AR dithering flavor (seed=args.seed, dithered tiles, extra-hdu)
+    "addstd": False,  # AR adding a std star file (without the science targets)
+    "indesi": False,  # AR tile required to be in the desi footprint
+}
+
+
+# AR settings proper to each flavor, see DJS email Oct,15 2020
+# AR msks        : CMX_TARGET masks of the targets
+# AR msksoutdesi : msks for a tile outside the desi footprint (also read from the gaiadr2 supp targets)
+# AR None        : flavor not implemented yet
+flavors = {
+    "dithprec": {
+        "msks": "STD_DITHER",
+        "msksoutdesi": "STD_DITHER_GAIA",
+        "dither": True,
+        "ndither": 12,
+        "gfrac": 1.0,
+        "gwidth": 0.7,
+    },
+    "dithlost": {
+        "msks": "STD_DITHER",
+        "msksoutdesi": "STD_DITHER_GAIA",
+        "dither": True,
+        "ndither": 1,
+        "gfrac": 0.5,
+        "gwidth": 2.0,
+        "bfrac": 0.5,
+        "bwidth": 10.0,
+    },
+    "starfaint": {"msks": "STD_FAINT,SV0_WD", "nskypet": "100"},
+    "scidark": {
+        # "msks": "SV0_WD,MINI_SV_LRG,MINI_SV_ELG,MINI_SV_QSO",
+        "msks": "SV0_WD,SV0_LRG,SV0_ELG,SV0_QSO",
+        "nskypet": "80",
+        "nstdpet": "20",
+        "addstd": True,
+        "indesi": True,
+    },
+    "scibright": {
+        # "msks": "SV0_WD,MINI_SV_BGS_BRIGHT,SV0_MWS_FAINT",
+        "msks": "SV0_WD,SV0_BGS,SV0_MWS_FAINT",
+        "addstd": True,
+        "indesi": True,
+    },
+    # AR focus dither sequences -- M. Lampton, E. Schlafly figuring this out
+    "focus": None,
+}
+
+
+# AR std masks, per obscon
+std_msks_obscon = {
+    "DARK|GRAY|BRIGHT": "SV0_WD,STD_FAINT,STD_BRIGHT",
+    "DARK|GRAY": "SV0_WD,STD_FAINT",
+    "BRIGHT": "SV0_WD,STD_BRIGHT",
+}
+
+
+# AR single bitmask combining the cmx_mask bits of comma-separated msks
+def get_cmx_bitmask(msks):
+    bitmask = 0
+    for msk in msks.split(","):
+        bitmask |= cmx_mask[msk]
+    return bitmask
+
+
+# AR tile catalogue: desi-tiles.fits indexed by TILEID, and a HEALPix map of the desi footprint
+# AR cached on disk (tilecachedir), and loaded once in memory (tilecat)
+# AR footmap values: 0 = pixel outside the footprint, 1 = inside, 2 = on the edge (exact test)
+def get_tilecat(cachedir):
+    # cachedir : cache folder
+    fn = os.path.join(os.getenv("DESIMODEL"), "data", "footprint", "desi-tiles.fits")
+    cachefn = os.path.join(
+        cachedir,
+        "desi-tiles-{:.0f}-{:.0f}-{}.fits".format(
+            os.path.getmtime(fn), os.path.getsize(fn), tilecat_nside
+        ),
+    )
+    if tilecat.get("fn") == cachefn:
+        return tilecat
+    if not os.path.isfile(cachefn):
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir, exist_ok=True)
+        d = fitsio.read(fn, columns=["TILEID", "RA", "DEC"])
+        d = d[np.argsort(d["TILEID"])]
+        desitiles = dmio.load_tiles()
+        dtiles = np.zeros(len(desitiles), dtype=[("RA", ">f8"), ("DEC", ">f8")])
+        dtiles["RA"], dtiles["DEC"] = desitiles["RA"], desitiles["DEC"]
+        footmap = np.zeros(hp.nside2npix(tilecat_nside), dtype="i1")
+        radius = np.radians(get_tile_radius_deg())
+        vecs = hp.ang2vec(dtiles["RA"], dtiles["DEC"], lonlat=True)
+        for vec in vecs:
+            footmap[
+                hp.query_disc(tilecat_nside, vec, radius, inclusive=True, nest=True)
+            ] = 2
+        for vec in vecs:
+            footmap[
+                hp.query_disc(
+                    tilecat_nside,
+                    vec,
+                    radius - hp.max_pixrad(tilecat_nside),
+                    inclusive=False,
+                    nest=True,
+                )
+            ] = 1
+        tmpfn = cachefn.replace(".fits", "-{}-tmp.fits".format(os.getpid()))
+        fitsio.write(tmpfn, d, extname="TILES", clobber=True)
+        fitsio.write(tmpfn, dtiles, extname="DESITILES")
+        fitsio.write(tmpfn, footmap, extname="FOOTMAP")
+        os.rename(tmpfn, cachefn)
+        log.info(
+            "{:.1f}s\t{} written (from {})".format(time() - start, cachefn, fn)
+        )
+    tilecat["fn"] = cachefn
+    for extname in ["TILES", "DESITILES", "FOOTMAP"]:
+        tilecat[extname] = fitsio.read(cachefn, ext=extname)
+    return tilecat
+
+
+# AR tile centres of tileids (vectorized, via the sorted TILEID index)
+# AR returns ras, decs, and a boolean array (False for tileids not in desi-tiles.fits)
+def get_tile_radecs(tilecat, tileids):
+    # tilecat : output of get_tilecat()
+    # tileids : tileids
+    d = tilecat["TILES"]
+    ii = np.clip(np.searchsorted(d["TILEID"], tileids), 0, len(d) - 1)
+    return d["RA"][ii], d["DEC"][ii], d["TILEID"][ii] == tileids
+
+
+# AR are (ras, decs) in the desi footprint? (vectorized, via the footmap)
+# AR the exact is_point_in_desi() test is only run for the edge pixels
+def is_in_desi(tilecat, ras, decs):
+    # tilecat    : output of get_tilecat()
+    # ras, decs  : positions
+    ras, decs = np.atleast_1d(ras), np.atleast_1d(decs)
+    states = tilecat["FOOTMAP"][
+        hp.ang2pix(tilecat_nside, ras, decs, nest=True, lonlat=True)
+    ]
+    isin = states == 1
+    edge = states == 2
+    if edge.sum() > 0:
+        isin[edge] = is_point_in_desi(tilecat["DESITILES"], ras[edge], decs[edge])
+    return isin
+
+
+# AR number of objects per msk, with a single pass on bits (np.unique on the values)
+def get_msk_counts(bits, msks):
+    # bits : CMX_TARGET values
+    # msks : comma-separated msks
+    vals, counts = np.unique(bits, return_counts=True)
+    return {
+        msk: counts[(vals & cmx_mask[msk]) > 0].sum() for msk in msks.split(",")
+    }
+
+
+# AR number of objects per cmx_mask bit, with a single pass on bits:
+# AR np.unique on the values, then a (nvalue, 64) bit-decomposition matrix
+# AR returns a dictionary with the non-zero counts, keyed by the bit names
+def get_cmx_bit_counts(bits):
+    # bits : CMX_TARGET values
+    vals, counts = np.unique(np.asarray(bits, dtype=np.int64), return_counts=True)
+    bitcounts = counts @ ((vals[:, None] >> np.arange(64)) & 1)
+    return {
+        cmx_mask.names(1 << int(bit))[0]: bitcounts[bit]
+        for bit in np.flatnonzero(bitcounts)
+    }
+
+
+# AR all the STD* bits
+std_cmx_bit = get_cmx_bitmask(
+    ",".join([msk for msk in cmx_mask.names() if "STD" in msk])
+)
+
+
+# AR dictionary with settings proper to a flavor
+# AR msksbit (and stdbit if addstd) : precomputed bitmasks for the target (and std) selection
+def get_fdict(flavor, tile_in_desi, seed):
+    # flavor       : flavor name (key of flavors)
+    # tile_in_desi : is the tile in the desi footprint? (0 or 1)
+    # seed         : random seed, used for dithering flavors
+    fdict = fdict_default.copy()
+    fdict.update(flavors[flavor])
+    # AR targets outside the desi footprint
+    fdict["targsupp"] = (tile_in_desi == 0) and ("msksoutdesi" in fdict)
+    if fdict["targsupp"]:
+        fdict["msks"] = fdict["msksoutdesi"]
+    fdict.pop("msksoutdesi", None)
+    if fdict["dither"]:
+        fdict["seed"] = seed
+    fdict["msksbit"] = get_cmx_bitmask(fdict["msks"])
+    if fdict["addstd"]:
+        if fdict["obscon"] not in std_msks_obscon:
+            log.error(
+                '{:.1f}s\tfdict["obscon"] not in {}; exiting'.format(
+                    time() - start, ",".join(std_msks_obscon.keys())
+                )
+            )
+            sys.exit(1)
+        fdict["stdmsks"] = std_msks_obscon[fdict["obscon"]]
+        fdict["stdbit"] = get_cmx_bitmask(fdict["stdmsks"])
+    return fdict
+
+
+# AR search roots for the target catalogues, the svn tiles and the local cache
+# AR in that order:
+# AR - config file (datacfg or $FBA_SV1_DATACFG), with "<key> <path>" lines (key=targets,svntiles,localcache)
+# AR - $FBA_SV1_TARGETS, $FBA_SV1_SVNTILES, $FBA_SV1_LOCALCACHE (os.pathsep-separated lists)
+# AR - defaults: KPNO/desi (/data/...), then NERSC/cori ($DESI_TARGET)
+def get_data_roots(datacfg):
+    # datacfg : config file (can be None)
+    roots = {"targets": [], "svntiles": [], "localcache": []}
+    if datacfg is None:
+        datacfg = os.getenv("FBA_SV1_DATACFG")
+    if datacfg is not None:
+        for line in open(datacfg).readlines():
+            words = line.split("#")[0].split()
+            if (len(words) == 2) and (words[0] in roots):
+                roots[words[0]].append(os.path.expandvars(words[1]))
+    for key in roots:
+        if os.getenv("FBA_SV1_{}".format(key.upper())) is not None:
+            roots[key] += os.getenv("FBA_SV1_{}".format(key.upper())).split(os.pathsep)
+    roots["targets"].append("/data/target/catalogs")
+    roots["svntiles"].append("/data/tiles/SVN_tiles")
+    if os.getenv("DESI_TARGET") is not None:
+        roots["targets"].append(os.path.join(os.getenv("DESI_TARGET"), "catalogs"))
+        roots["svntiles"].append(
+            os.path.join(os.getenv("DESI_TARGET"), "fiberassign/tiles/trunk")
+        )
+    return roots
+
+
+# AR catalogue directories
+def get_mydirs(path_to_targets, fdict):
+    # path_to_targets : root folder of the catalogues
+    # fdict           : dictionary with the flavor settings
+    mydirs = {}
+    if fdict["targsupp"]:
+        mydirs["targ"] = os.path.join(
+            path_to_targets, "gaiadr2", args.dtver, "targets/cmx/resolve/supp"
+        )
+    else:
+        mydirs["targ"] = os.path.join(
+            path_to_targets, args.dr, args.dtver, "targets/cmx/resolve/no-obscon"
+        )
+    mydirs["sky"] = os.path.join(path_to_targets, args.dr, args.dtver, "skies")
+    mydirs["skysupp"] = os.path.join(
+        path_to_targets, "gaiadr2", args.dtver, "skies-supp"
+    )
+    mydirs["gfa"] = os.path.join(path_to_targets, args.dr, args.dtver, "gfas")
+    return mydirs
+
+
+# AR HEALPix files of hpdir overlapping tiles
+# AR relies on the desitarget naming (*-hp-{pix}.fits), otherwise reads all headers
+def get_hpdir_fns(hpdir, tdict):
+    # hpdir : HEALPix-split catalogue folder
+    # tdict : dictionary with the tile context (see get_tdict())
+    fns = glob(os.path.join(hpdir, "*-hp-*.fits"))
+    if len(fns) > 0:
+        nside = fitsio.read_header(fns[0], 1)["FILENSID"]
+        filedict = {
+            int(os.path.basename(fn).split("-hp-")[1].replace(".fits", "")): fn
+            for fn in fns
+        }
+    else:
+        nside, filedict = check_hp_target_dir(hpdir)
+    pixs = get_tile_pixs(tdict, nside)
+    return sorted(set([filedict[pix] for pix in pixs if pix in filedict]))
+
+
+# AR copying the HEALPix files of hpdir overlapping tiles to the local cache
+# AR mirroring the full path: {localcache}/{hpdir}
+# AR files already in the local cache (same size) are not copied again
+# AR returns the local folder, to be read instead of hpdir
+def stage_hpdir(hpdir, tdict, localcache):
+    # hpdir      : HEALPix-split catalogue folder
+    # tdict      : dictionary with the tile context (see get_tdict())
+    # localcache : local cache root folder
+    localdir = os.path.join(localcache, os.path.abspath(hpdir).lstrip("/"))
+    if not os.path.isdir(localdir):
+        os.makedirs(localdir, exist_ok=True)
+    nstage = 0
+    for fn in get_hpdir_fns(hpdir, tdict):
+        localfn = os.path.join(localdir, os.path.basename(fn))
+        if (not os.path.isfile(localfn)) or (
+            os.path.getsize(localfn) != os.path.getsize(fn)
+        ):
+            tmpfn = "{}-{}.tmp".format(localfn, os.getpid())
+            shutil.copyfile(fn, tmpfn)
+            os.rename(tmpfn, localfn)
+            nstage += 1
+        else:
+            # AR marking as recently used (see prefetch_fba_sv1.py)
+            os.utime(localfn)
+    log.info(
+        "{:.1f}s\t{} : {:.0f} HEALPix files staged to {}".format(
+            time() - start, hpdir, nstage, localdir
+        )
+    )
+    return localdir
+
+
+# AR reading the targets of hpdir in tiles
+# AR from the local cache, if args.localcache is set
+# AR with a filepool, the HEALPix files are read concurrently, in separate processes
+# AR (fitsio holds the GIL while reading, so threads would serialize the reads)
+def read_hpdir(hpdir, tdict, header=False, filepool=None):
+    # hpdir    : HEALPix-split catalogue folder
+    # tdict    : dictionary with the tile context (see get_tdict())
+    # header   : also return the header? (see read_targets_in_tiles())
+    # filepool : ProcessPoolExecutor for the per-file reads (default=None)
+    if args.localcache is not None:
+        hpdir = stage_hpdir(hpdir, tdict, args.localcache)
+    fns = []
+    if filepool is not None:
+        fns = get_hpdir_fns(hpdir, tdict)
+    if len(fns) == 0:
+        return read_targets_in_tiles(hpdir, tiles=tdict["tile"], header=header)
+    futures = [
+        filepool.submit(read_targets_in_tiles, fn, tiles=tdict["tile"], header=True)
+        for fn in fns
+    ]
+    ds, hdrs = zip(*[future.result() for future in futures])
+    log.info(
+        "{:.1f}s\t{}: {:.0f} HEALPix files read".format(time() - start, hpdir, len(fns))
+    )
+    if header:
+        return np.concatenate(ds), hdrs[0]
+    return np.concatenate(ds)
+
+
+# AR reading the targets of mydirs[key] in tiles
+# AR awaiting the concurrent read if issued in main() (--nthread > 1)
+def read_mydir(mydirs, key, tdict, header=False):
+    # mydirs : dictionary with the catalogue directories
+    # key    : key of mydirs
+    # tdict  : dictionary with the tile context (see get_tdict())
+    # header : also return the header? (see read_targets_in_tiles())
+    if key in catreads:
+        d, hdr = catreads[key].result()
+        if header:
+            return d, hdr
+        return d
+    return read_hpdir(mydirs[key], tdict, header=header)
+
+
+# AR arrow copy of a stage product (--intermediate-format arrow): {fn} -> {fn without .fits}.arrow
+# AR native-endian columns, uncompressed arrow ipc file, i.e. memory-mappable with zero-copy reads
+# AR string columns stored as fixed-size binaries, also read with zero copy
+# AR the fits file is still written, as it is read by fiberassign
+def get_arrow_fn(fn):
+    # fn : fits file
+    return fn.replace(".fits", ".arrow")
+
+
+def write_arrow(fn, d):
+    # fn : fits file of the stage product
+    # d  : stage product (structured array)
+    arrays, dtypes = [], {}
+    for name in d.dtype.names:
+        col = np.ascontiguousarray(d[name]).astype(d[name].dtype.newbyteorder("="))
+        dtypes[name] = col.dtype.str
+        if col.dtype.kind == "U":
+            col = col.astype("S{}".format(col.dtype.itemsize // 4))
+        if col.dtype.kind == "S":
+            arrays.append(pa.array(col, type=pa.binary(col.dtype.itemsize)))
+        elif col.ndim == 1:
+            arrays.append(pa.array(col))
+        else:
+            # AR multi-dimensional columns: fixed-size lists, reshaped when read
+            dtypes[name] += "x{}".format(",".join(str(n) for n in col.shape[1:]))
+            arrays.append(
+                pa.FixedSizeListArray.from_arrays(
+                    pa.array(col.ravel()), int(np.prod(col.shape[1:]))
+                )
+            )
+    table = pa.Table.from_arrays(
+        arrays, names=list(d.dtype.names), metadata={"dtypes": json.dumps(dtypes)}
+    )
+    outfn = get_arrow_fn(fn)
+    tmpfn = "{}-{}.tmp".format(outfn, os.getpid())
+    with pa.OSFile(tmpfn, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.rename(tmpfn, outfn)
+    log.info("{:.1f}s\t{} written".format(time() - start, outfn))
+
+
+# AR reading columns of a stage product, as a dictionary of arrays
+# AR from the memory-mapped arrow copy, if --intermediate-format arrow and not older than fn
+# AR otherwise from the fits file
+def read_product(fn, columns=None):
+    # fn      : fits file of the stage product
+    # columns : list of columns (default=None, i.e. all)
+    afn = get_arrow_fn(fn)
+    if (
+        (args.intermediate_format == "arrow")
+        and os.path.isfile(afn)
+        and (os.path.getmtime(afn) >= os.path.getmtime(fn))
+    ):
+        table = pa.ipc.open_file(pa.memory_map(afn)).read_all()
+        dtypes = json.loads(table.schema.metadata[b"dtypes"])
+        if columns is None:
+            columns = table.column_names
+        d = {}
+        for name in columns:
+            dtype = dtypes[name].split("x")[0]
+            if pa.types.is_fixed_size_binary(table[name].type):
+                col = table[name].combine_chunks()
+                n = col.type.byte_width
+                d[name] = np.frombuffer(
+                    col.buffers()[1],
+                    dtype="S{}".format(n),
+                    count=len(col),
+                    offset=col.offset * n,
+                ).astype(dtype, copy=False)
+            elif (
+                table[name].type.equals(pa.binary())
+                | pa.types.is_string(table[name].type)
+                | pa.types.is_list(table[name].type)
+                | pa.types.is_fixed_size_list(table[name].type)
+            ):
+                col = table[name].combine_chunks()
+                if pa.types.is_fixed_size_list(col.type):
+                    shape = [int(n) for n in dtypes[name].split("x")[1].split(",")]
+                    d[name] = col.flatten().to_numpy().reshape([len(col)] + shape)
+                else:
+                    d[name] = np.array(col.to_pylist(), dtype=dtype)
+            else:
+                d[name] = table[name].to_numpy()
+        return d
+    d = fitsio.read(fn, ext=1, columns=columns)
+    return {name: d[name] for name in d.dtype.names}
+
+
+# AR copy of rows of a stage product, e.g. the targets files passed to fiberassign
+# AR rows read with read_product(), headers copied from fn
+def write_product_rows(fn, outfn, rows, cols=None, keys=None):
+    # fn    : fits file of the stage product
+    # outfn : written fits file
+    # rows  : indexes (or boolean mask) of the copied rows
+    # cols  : dictionary of new values for some columns of the copied rows (default=None)
+    # keys  : dictionary of keywords added to the table header (default=None)
+    d = read_product(fn)
+    names = list(d.keys())
+    # AR unicode columns (fitsio, arrow strings) written as bytes
+    dtypes = []
+    for name in names:
+        dtype = d[name].dtype
+        if dtype.kind == "U":
+            dtype = np.dtype("S{}".format(dtype.itemsize // 4))
+        dtypes.append((name, dtype, d[name].shape[1:]))
+    out = np.zeros(len(d[names[0]][rows]), dtype=dtypes)
+    for name in names:
+        out[name] = d[name][rows]
+    if cols is not None:
+        for name in cols:
+            out[name] = cols[name]
+    hdu = fits.BinTableHDU(out, header=fits.getheader(fn, 1))
+    if keys is not None:
+        for key in keys:
+            hdu.header[key] = keys[key]
+    fits.HDUList([fits.PrimaryHDU(header=fits.getheader(fn, 0)), hdu]).writeto(
+        outfn, overwrite=True
+    )
+
+
+# AR ! not using make_mtl !, Adam says we should not use make_mtl, assign mtl columns by hand [email Oct, 17 2020]
 # AR by default, we propagate {PRIORITY,NUMOBS}_INIT to {PRIORITY,NUMOBS_MORE}
 # AR mtl (reproducing steps of make_mtl())
-def cmx_make_mtl(d, outfn):
+def cmx_make_mtl(d, outfn, extra=None):
     # d     : output of read_targets_in_tiles()
     # outfn : written fits file
+    # extra : dictionary of additional keywords written in the MTL header
     mtl = Table(d)
     mtl.meta["EXTNAME"] = "MTL"
     for col in [
@@ -90,6 +659,7 @@ def cmx_make_mtl(d, outfn):
         mtl[col] = np.empty(len(mtl), dtype=mtldatamodel[col].dtype)
     mtl["NUMOBS_MORE"] = mtl["NUMOBS_INIT"]
     mtl["PRIORITY"] = mtl["PRIORITY_INIT"]
+    mtl = ledger_apply(mtl)
     mtl["TARGET_STATE"] = "UNOBS"
     mtl["TIMESTAMP"] = datetime.utcnow().isoformat(timespec="seconds")
     mtl["VERSION"] = fiberassign.__version__
@@ -98,7 +668,12 @@ def cmx_make_mtl(d, outfn):
     )  # AR : TBD : do we want to set obsconmask to 1? (see Ted s email)
     mtl["OBSCONDITIONS"] = obsconmask
     n, tmpfn = write_mtl(
-        args.outdir, mtl.as_array(), indir=args.outdir, survey="cmx", ecsv=False
+        args.outdir,
+        mtl.as_array(),
+        indir=args.outdir,
+        survey="cmx",
+        ecsv=False,
+        extra=extra,
     )
     if n:
         os.rename(tmpfn, outfn)
@@ -107,6 +682,8 @@ def cmx_make_mtl(d, outfn):
                 time() - start, tmpfn, outfn
             )
         )
+        if args.intermediate_format == "arrow":
+            write_arrow(outfn, mtl.as_array())
     else:
         log.info(
             "{:.1f}s\tmtl targets NOT written to {} (0 targets to write)".format(
@@ -116,6 +693,165 @@ def cmx_make_mtl(d, outfn):
     return True
 
 
+# AR ledger: setting NUMOBS_MORE, PRIORITY of the mtl rows already in the ledger
+def ledger_apply(mtl):
+    # mtl : MTL Table
+    if (ledger is None) or (len(ledger["TARGETID"]) == 0):
+        return mtl
+    ii = np.searchsorted(ledger["TARGETID"], mtl["TARGETID"])
+    ii[ii == len(ledger["TARGETID"])] = 0
+    sel = ledger["TARGETID"][ii] == mtl["TARGETID"]
+    mtl["NUMOBS_MORE"][sel] = ledger["NUMOBS_MORE"][ii[sel]]
+    mtl["PRIORITY"][sel] = ledger["PRIORITY"][ii[sel]]
+    log.info(
+        "{:.1f}s\tNUMOBS_MORE, PRIORITY updated from the ledger for {:.0f}/{:.0f} targets".format(
+            time() - start, sel.sum(), len(mtl)
+        )
+    )
+    return mtl
+
+
+# AR ledger: one more observation for the targets assigned in fafn
+# AR NUMOBS_MORE decremented, PRIORITY set to ledger_done_priority if NUMOBS_MORE=0
+def ledger_update(fafn, mtlfns):
+    # fafn   : fiberassign-{tileid}.fits file
+    # mtlfns : list of the MTL files used for fafn
+    d = fits.open(fafn)[1].data
+    tids = d["TARGETID"][d["OBJTYPE"] == "TGT"]
+    for mtlfn in mtlfns:
+        m = read_product(mtlfn, ["TARGETID", "NUMOBS_MORE", "PRIORITY"])
+        sel = np.in1d(m["TARGETID"], tids)
+        m = {key: m[key][sel] for key in m}
+        numobs_more = np.clip(m["NUMOBS_MORE"] - 1, 0, None)
+        priority = np.where(numobs_more == 0, ledger_done_priority, m["PRIORITY"])
+        # AR new values first, so that they supersede the ledger ones
+        _, ii = np.unique(
+            np.concatenate([m["TARGETID"], ledger["TARGETID"]]), return_index=True
+        )
+        for key, new in zip(
+            ["TARGETID", "NUMOBS_MORE", "PRIORITY"],
+            [m["TARGETID"], numobs_more, priority],
+        ):
+            ledger[key] = np.concatenate([new, ledger[key]]).astype(
+                mtldatamodel[key].dtype
+            )[ii]
+        log.info(
+            "{:.1f}s\t{}: {:.0f} assigned targets from {} added to the ledger ({:.0f} targets)".format(
+                time() - start,
+                fafn,
+                len(m["TARGETID"]),
+                mtlfn,
+                len(ledger["TARGETID"]),
+            )
+        )
+
+
+# AR provenance keywords for the PRIMARY header of fiberassign-{tileid}.fits
+# AR gathered in one dictionary, so that they are written with a single header update
+def fba_provenance(mydirs, fdict, isdith):
+    # mydirs : dictionary with the catalogue directories
+    # fdict  : dictionary with the flavor settings
+    # isdith : is the tile a dithered one?
+    prov = {}
+    for key in sorted(mydirs.keys()):
+        prov[key] = mydirs[key]
+    for kwargs in args._get_kwargs():
+        if kwargs[0].lower() in [
+            "outdir",
+            "intileid",
+            "flavor",
+            "rundate",
+            "seed",
+            "epoch",
+        ]:
+            if kwargs[1] is not None:
+                prov[kwargs[0]] = kwargs[1]
+    # AR adding a ISDITH keyword
+    prov["ISDITH"] = int(isdith)
+    prov["obscon"] = fdict["obscon"]
+    return prov
+
+
+# AR epoch for the GFA targets positions
+# AR epoch : jyear (e.g. 2020.95) or any astropy Time string (e.g. 2020-12-14T00:00:00)
+# AR         if None, we use Time.now() (not reproducible)
+def get_epoch(epoch):
+    if epoch is None:
+        return Time.now()
+    try:
+        return Time(float(epoch), format="jyear")
+    except ValueError:
+        return Time(epoch)
+
+
+# AR computing positions at epoch using Gaia PMRA, PMDEC
+def gfa_propagate(d, epoch):
+    # d     : GFA targets (output of read_targets_in_tiles())
+    # epoch : astropy Time
+    # AR clipping Gaia PARALLAX to >1e-3 (setting distance at <1Mpc)
+    parallax = d["PARALLAX"].copy()
+    parallax[(~np.isfinite(d["PARALLAX"])) | (d["PARALLAX"] < 1e-3)] = 1e-3
+    c = SkyCoord(
+        ra=d["RA"] * units.degree,
+        dec=d["DEC"] * units.degree,
+        pm_ra_cosdec=d["PMRA"] * units.mas / units.yr,
+        pm_dec=d["PMDEC"] * units.mas / units.yr,
+        frame="icrs",
+        obstime=Time(d["REF_EPOCH"], format="jyear"),
+        distance=Distance(parallax=parallax * units.mas),
+    )
+    epochc = c.apply_space_motion(new_obstime=epoch)
+    return epochc.ra.value, epochc.dec.value
+
+
+# AR same as gfa_propagate(), but with positions cached per HEALPix pixel (nested)
+# AR cache files: {cachedir}/gfa-{dr}-{dtver}-{epoch}-hp-{pix}.fits, with TARGETID,RA,DEC
+# AR the pixel is computed from the catalogue RA,DEC, so that it does not depend on epoch
+# AR targets not in the cache are propagated and added to the cache
+def gfa_propagate_cached(d, epoch, cachedir):
+    # d        : GFA targets (output of read_targets_in_tiles())
+    # epoch    : astropy Time
+    # cachedir : cache folder
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir, exist_ok=True)
+    ras, decs = np.zeros(len(d)), np.zeros(len(d))
+    incache = np.zeros(len(d), dtype=bool)
+    pixs = radec2pix(gfa_cache_nside, d["RA"], d["DEC"])
+    fns, caches = {}, {}
+    for pix in np.unique(pixs):
+        fns[pix] = os.path.join(
+            cachedir,
+            "gfa-{}-{}-{:.6f}-hp-{}.fits".format(args.dr, args.dtver, epoch.jyear, pix),
+        )
+        if os.path.isfile(fns[pix]):
+            caches[pix] = fitsio.read(fns[pix])
+            ii = np.where(pixs == pix)[0]
+            jj, kk = unq_searchsorted(d["TARGETID"][ii], caches[pix]["TARGETID"])
+            ras[ii[jj]] = caches[pix]["RA"][kk]
+            decs[ii[jj]] = caches[pix]["DEC"][kk]
+            incache[ii[jj]] = True
+    log.info(
+        "{:.1f}s\tGFA targets: {:.0f}/{:.0f} positions at epoch={:.6f} read from {}".format(
+            time() - start, incache.sum(), len(d), epoch.jyear, cachedir
+        )
+    )
+    if (~incache).sum() > 0:
+        ras[~incache], decs[~incache] = gfa_propagate(d[~incache], epoch)
+        # AR updating the cache for the pixels with new targets (write-then-rename)
+        for pix in np.unique(pixs[~incache]):
+            ii = np.where((pixs == pix) & (~incache))[0]
+            c = np.zeros(
+                len(ii), dtype=[("TARGETID", ">i8"), ("RA", ">f8"), ("DEC", ">f8")]
+            )
+            c["TARGETID"], c["RA"], c["DEC"] = d["TARGETID"][ii], ras[ii], decs[ii]
+            if pix in caches:
+                c = np.concatenate([caches[pix].astype(c.dtype), c])
+            tmpfn = "{}-{}.tmp".format(fns[pix], os.getpid())
+            fitsio.write(tmpfn, c, extname="GFACACHE", clobber=True)
+            os.rename(tmpfn, fns[pix])
+    return ras, decs
+
+
 # AR get matching index for two np arrays, those should be arrays with unique values, like id
 # AR https://stackoverflow.com/questions/32653441/find-indices-of-common-values-in-two-arrays
 # AR we get: A[maskA] = B[maskB]
@@ -134,6 +870,120 @@ def unq_searchsorted(A, B):
     return np.argsort(A)[maskA], np.argsort(B)[maskB]
 
 
+# AR incremental re-assignment: rows of the (new) targets file to pass to fiberassign
+# AR - targets reachable in the previous run (previous POTENTIAL_ASSIGNMENTS)
+# AR - new targets, and targets with any column changed (matched by TARGETID)
+# AR the other targets were not reachable and are unchanged, hence cannot change the assignment
+# AR the incr_ignored_cols columns are not compared (set at each cmx_make_mtl() call, not used by fiberassign)
+# AR returns the boolean array of rows to keep, and the numbers of new, changed, removed targets
+def get_incr_rows(prevtargfn, targfn, prevfafn):
+    # prevtargfn : targets file of the previous run
+    # targfn     : targets file of this run
+    # prevfafn   : fiberassign file of the previous run
+    dprev = read_product(prevtargfn)
+    d = read_product(targfn)
+    # AR ii, iiprev: both sorted by TARGETID
+    ii, iiprev = unq_searchsorted(d["TARGETID"], dprev["TARGETID"])
+    isnew = np.ones(len(d["TARGETID"]), dtype=bool)
+    isnew[ii] = False
+    ischanged = np.zeros(len(d["TARGETID"]), dtype=bool)
+    for key in d:
+        if key in incr_ignored_cols:
+            continue
+        if key not in dprev:
+            ischanged[ii] = True
+            continue
+        a, aprev = d[key][ii], dprev[key][iiprev]
+        diff = a != aprev
+        if a.dtype.kind == "f":
+            diff &= ~(np.isnan(a) & np.isnan(aprev))
+        ischanged[ii] |= diff.reshape(len(ii), -1).any(axis=1)
+    nremoved = len(dprev["TARGETID"]) - len(iiprev)
+    pot = fitsio.read(prevfafn, ext="POTENTIAL_ASSIGNMENTS", columns=["TARGETID"])
+    keep = isnew | ischanged | np.in1d(d["TARGETID"], pot["TARGETID"])
+    return keep, isnew.sum(), ischanged.sum(), nremoved
+
+
+# AR incremental re-assignment: digests of the other fiberassign inputs (tiles, sky, gfa, std files)
+# AR and of the options changing the assignment (focalplane rundate, epoch, seed, per-petal numbers, ...)
+# AR file digests over the columns, except incr_ignored_cols
+def get_incr_inputs(fns, fdict):
+    # fns   : dictionary of the fiberassign input files, other than the targets
+    # fdict : dictionary with the flavor settings
+    inputs = {}
+    for key in fns:
+        h = hashlib.sha1()
+        d = read_product(fns[key])
+        for name in d:
+            if name in incr_ignored_cols:
+                continue
+            col = d[name].astype(d[name].dtype.newbyteorder("="))
+            h.update(name.encode())
+            h.update(np.ascontiguousarray(col).tobytes())
+        inputs[key] = h.hexdigest()
+    for key in ["flavor", "rundate", "epoch", "seed"]:
+        inputs[key] = str(getattr(args, key))
+    for key in ["nskypet", "nstdpet"]:
+        inputs[key] = str(fdict[key])
+    inputs["fiberassign"] = fiberassign.__version__
+    return inputs
+
+
+# AR incremental re-assignment: recording the inputs of the assignment, for the next run
+def write_incr_inputs(fn, inputs):
+    # fn     : json file
+    # inputs : output of get_incr_inputs()
+    with open(fn + ".tmp", "w") as f:
+        json.dump(inputs, f)
+    os.rename(fn + ".tmp", fn)
+
+
+# AR incremental re-assignment of a tile: returns the plan, and the rows of targfn to keep
+# AR - "full" : no previous outputs, or other inputs changed (see get_incr_inputs())
+# AR - "skip" : nothing changed, the previous outputs are kept
+# AR - "incr" : only the targets changed, keep rows passed to fiberassign (see get_incr_rows())
+def get_incr_plan(tileid, prevtargfn, targfn, prevfafn, inputs, inputsfn):
+    # tileid     : tileid
+    # prevtargfn : targets file of the previous run
+    # targfn     : targets file of this run
+    # prevfafn   : fiberassign file of the previous run
+    # inputs     : output of get_incr_inputs() for this run
+    # inputsfn   : json file with the get_incr_inputs() of the previous run
+    for fn in [prevtargfn, prevfafn, inputsfn]:
+        if not os.path.isfile(fn):
+            log.info(
+                "{:.1f}s\ttileid={:06d}: no previous {}: running the full assignment".format(
+                    time() - start, tileid, fn
+                )
+            )
+            return "full", None
+    previnputs = json.load(open(inputsfn))
+    changed = [key for key in inputs if previnputs.get(key) != inputs[key]]
+    if len(changed) > 0:
+        log.info(
+            "{:.1f}s\ttileid={:06d}: {} changed w.r.t. {}: running the full assignment".format(
+                time() - start, tileid, ",".join(changed), inputsfn
+            )
+        )
+        return "full", None
+    keep, nnew, nchanged, nremoved = get_incr_rows(prevtargfn, targfn, prevfafn)
+    log.info(
+        "{:.1f}s\ttileid={:06d}: {:.0f} new, {:.0f} changed, {:.0f} removed targets w.r.t. {}; passing {:.0f}/{:.0f} targets to fiberassign".format(
+            time() - start,
+            tileid,
+            nnew,
+            nchanged,
+            nremoved,
+            prevtargfn,
+            keep.sum(),
+            len(keep),
+        )
+    )
+    if nnew + nchanged + nremoved == 0:
+        return "skip", keep
+    return "incr", keep
+
+
 # AR https://lmfit.github.io/lmfit-py/builtin_models.html#lmfit.models.GaussianModel
 def gaussian(x, amp, cen, wid):
     return amp / (wid * np.sqrt(2 * np.pi)) * np.exp(-0.5 * ((x - cen) / wid) ** 2)
@@ -189,6 +1039,977 @@ def plot_hist(ax, x, xp, bins, xlabel):
     return
 
 
+# AR per-run tile context, built once in memory and passed to the stages:
+# AR    "tiles" : tiles array, one row per tileid (same RA,DEC)
+# AR    "tile"  : first row, used for the catalogue reads
+# AR    "tsky"  : SkyCoord of the tile centre
+# AR    "pixs"  : HEALPix pixels (nested) overlapping the tile, per nside (see get_tile_pixs())
+def get_tdict(tileids, fdict):
+    # tileids : list of tileids
+    # fdict   : dictionary with the flavor settings
+    d = np.zeros(
+        len(tileids),
+        dtype=[
+            ("TILEID", "i4"),
+            ("RA", "f8"),
+            ("DEC", "f8"),
+            ("OBSCONDITIONS", "i4"),
+            ("IN_DESI", "i2"),
+            ("PROGRAM", "S6"),
+        ],
+    )
+    d["TILEID"] = tileids
+    d["RA"] = args.tilera
+    d["DEC"] = args.tiledec
+    d["IN_DESI"] = 1  # AR forcing 1; otherwise the default onlydesi=True option in
+    # AR desimodel.io.load_tiles() discards tiles outside the desi footprint,
+    # AR so return no tiles for the dithered tiles outside desi
+    d["PROGRAM"] = "CMX"  # AR custom...
+    d["OBSCONDITIONS"] = obsconditions.mask(
+        fdict["obscon"]
+    )  # AR we force the obsconditions to fdict["obscon"]
+    return {
+        "tiles": d,
+        "tile": d[:1],
+        "tsky": SkyCoord(
+            ra=args.tilera * units.deg, dec=args.tiledec * units.deg, frame="icrs"
+        ),
+        "pixs": {},
+    }
+
+
+# AR HEALPix pixels (nested) overlapping the tile, computed once per nside
+def get_tile_pixs(tdict, nside):
+    # tdict : dictionary with the tile context (see get_tdict())
+    # nside : HEALPix nside
+    if nside not in tdict["pixs"]:
+        tdict["pixs"][nside] = tiles2pix(nside, tiles=tdict["tile"])
+    return tdict["pixs"][nside]
+
+
+# AR patrol discs of the fibre positioners at rundate, in the focal plane [mm]
+# AR all the devices of type POS (positioners) or ETC (sky monitor), as considered by fiberassign
+# AR GOOD: is the device in a good state (STATE=0)?
+# AR the patrol region is approximated by its outer disc, of radius LENGTH_R1+LENGTH_R2
+def get_patrol(rundate):
+    # rundate : rundate for the focalplane (e.g., 2020-03-06T00:00:00)
+    if rundate not in patrols:
+        fp, _, state, tmstr = dmio.load_focalplane(Time(rundate).datetime)
+        good = np.in1d(fp["LOCATION"], state["LOCATION"][state["STATE"] == 0])
+        sel = np.in1d(fp["DEVICE_TYPE"], ["POS", "ETC"])
+        patrols[rundate] = {
+            "LOCATION": np.array(fp["LOCATION"][sel]),
+            "PETAL": np.array(fp["PETAL"][sel]),
+            "DEVICE_TYPE": np.array(fp["DEVICE_TYPE"][sel]).astype(str),
+            "GOOD": good[sel],
+            "X": np.array(fp["OFFSET_X"][sel]),
+            "Y": np.array(fp["OFFSET_Y"][sel]),
+            "R": np.array(fp["LENGTH_R1"][sel] + fp["LENGTH_R2"][sel]),
+        }
+        log.info(
+            "{:.1f}s\tfocalplane {}: {:.0f}/{:.0f} POS,ETC devices, {:.0f} in a good state".format(
+                time() - start, tmstr, sel.sum(), len(fp), (good & sel).sum()
+            )
+        )
+    return patrols[rundate]
+
+
+# AR targets in the patrol disc of each device, for a tile centre
+# AR KD-tree over the focal plane (tangent-plane) positions of the targets
+# AR returns one array of target indexes per device
+def get_patrol_inds(patrol, tilera, tiledec, ras, decs):
+    # patrol          : output of get_patrol() (or a subset)
+    # tilera, tiledec : tile centre
+    # ras, decs       : target positions
+    if len(ras) == 0:
+        return [np.zeros(0, dtype=int) for i in range(len(patrol["X"]))]
+    xs, ys = radec2xy(tilera, tiledec, ras, decs)
+    tree = cKDTree(np.array([xs, ys]).T)
+    return [
+        np.array(inds, dtype=int)
+        for inds in tree.query_ball_point(
+            np.array([patrol["X"], patrol["Y"]]).T, patrol["R"]
+        )
+    ]
+
+
+# AR reachability prefilter: writing to outfn the rows of fn that are in the patrol disc
+# AR of at least one device of devtypes, for the tile centre
+# AR returns outfn
+def prefilter_reach(fn, outfn, devtypes, tilera, tiledec):
+    # fn              : targets file (std, sky, targ)
+    # outfn           : output file
+    # devtypes        : list of DEVICE_TYPE (POS: positioners, ETC: sky monitor)
+    # tilera, tiledec : tile centre
+    patrol = get_patrol(args.rundate)
+    sel = np.in1d(patrol["DEVICE_TYPE"], devtypes)
+    patrol = {key: patrol[key][sel] for key in patrol}
+    patrol["R"] = patrol["R"] + prefilter_margin
+    h = fits.open(fn)
+    d = h[1].data
+    keep = np.zeros(len(d), dtype=bool)
+    inds = get_patrol_inds(patrol, tilera, tiledec, d["RA"], d["DEC"])
+    if len(inds) > 0:
+        keep[np.concatenate(inds)] = True
+    h[1].data = d[keep]
+    h.writeto(outfn, overwrite=True)
+    log.info(
+        "{:.1f}s\t{}: keeping {:.0f}/{:.0f} rows reachable by {} devices ({:.0f}% cut), written to {}".format(
+            time() - start,
+            fn,
+            keep.sum(),
+            len(keep),
+            ",".join(devtypes),
+            100.0 * (1 - keep.mean()) if len(keep) > 0 else 0.0,
+            outfn,
+        )
+    )
+    log_progress(
+        "prefilter", fn=os.path.basename(fn), nrows=len(keep), nkeep=int(keep.sum())
+    )
+    return outfn
+
+
+# AR tiles files, one per tileid (only read by fiberassign and for the provenance)
+def make_tiles(tdict):
+    # tdict : dictionary with the tile context (see get_tdict())
+    hdr = fitsio.FITSHDR()
+    for i, tileid in enumerate(tdict["tiles"]["TILEID"]):
+        fn = "{}{:06d}-tiles.fits".format(args.outdir, tileid)
+        tmpfn = "{}-{}.tmp".format(fn, os.getpid())
+        fitsio.write(
+            tmpfn, tdict["tiles"][i : i + 1], extname="TILES", header=hdr, clobber=True
+        )
+        os.rename(tmpfn, fn)
+        log.info(
+            "{:.1f}s\t{}{:06d}-tiles.fits written".format(
+                time() - start, args.outdir, tileid
+            )
+        )
+
+
+# AR merging the sky and skies-supp targets
+def merge_skies(d, dsupp):
+    # d     : sky targets
+    # dsupp : skies-supp targets
+    # JEFR we have to check for duplicates before merging
+    dmerged = np.concatenate([d, dsupp])
+    if len(dmerged["TARGETID"]) != len(set(dmerged["TARGETID"])):
+        log.info("Duplicated TARGETID in sky")
+        _, ii_unique = np.unique(dmerged["TARGETID"], return_index=True)
+        dmerged = dmerged[ii_unique]
+    return dmerged
+
+
+# AR sky thinning: keeping, per petal, the first ceil(skythin * nskypet) reachable sky positions
+# AR ranking per device (positioners and ETC fibres): larger BLOBDIST (if available), then reachable by more devices
+# AR ranking per petal: round-robin on its devices (all the devices first choices, then the second ones, ...),
+# AR    to spread the kept sky positions over the petal
+# AR the sky positions reachable by no device are discarded
+def thin_skies(d, fdict, tilera, tiledec, skythin):
+    # d               : sky targets
+    # fdict           : dictionary with the flavor settings
+    # tilera, tiledec : tile centre
+    # skythin         : multiple of fdict["nskypet"]
+    patrol = get_patrol(args.rundate)
+    inds = get_patrol_inds(patrol, tilera, tiledec, d["RA"], d["DEC"])
+    # AR (device, sky) pairs
+    devs = np.repeat(np.arange(len(inds)), [len(i) for i in inds])
+    skys = np.concatenate(inds)
+    nreach = np.bincount(skys, minlength=len(d))
+    quality = np.zeros(len(d))
+    if "BLOBDIST" in d.dtype.names:
+        quality = d["BLOBDIST"]
+    # AR sorting the pairs by device, then by decreasing quality, nreach
+    ii = np.lexsort([-nreach[skys], -quality[skys], devs])
+    devs, skys = devs[ii], skys[ii]
+    # AR rank of each pair within its device
+    _, first, counts = np.unique(devs, return_index=True, return_counts=True)
+    ranks = np.arange(len(devs)) - np.repeat(first, counts)
+    # AR sorting the pairs by petal, then by rank within the device, decreasing quality, nreach
+    petals = patrol["PETAL"][devs]
+    ii = np.lexsort([-nreach[skys], -quality[skys], ranks, petals])
+    petals, skys = petals[ii], skys[ii]
+    # AR first occurrence of each sky position in each petal, and its rank within the petal
+    _, first = np.unique(petals * len(d) + skys, return_index=True)
+    first = np.sort(first)
+    petals, skys = petals[first], skys[first]
+    _, first, counts = np.unique(petals, return_index=True, return_counts=True)
+    ranks = np.arange(len(skys)) - np.repeat(first, counts)
+    kpet = int(np.ceil(skythin * int(fdict["nskypet"])))
+    keep = np.zeros(len(d), dtype=bool)
+    keep[skys[ranks < kpet]] = True
+    log.info(
+        "{:.1f}s\tsky thinning: keeping {:.0f}/{:.0f} sky targets ({:.0f} unreachable), up to {} per petal ({}x{})".format(
+            time() - start,
+            keep.sum(),
+            len(d),
+            (nreach == 0).sum(),
+            kpet,
+            skythin,
+            fdict["nskypet"],
+        )
+    )
+    return d[keep]
+
+
+# AR sky
+def make_sky(mydirs, tdict, fdict):
+    # mydirs : dictionary with the catalogue directories
+    # tdict  : dictionary with the tile context (see get_tdict())
+    # fdict  : dictionary with the flavor settings
+    d = read_mydir(mydirs, "sky", tdict)
+    dsupp = read_mydir(mydirs, "skysupp", tdict)
+    dmerged = merge_skies(d, dsupp)
+    if args.skythin > 0:
+        dmerged = thin_skies(
+            dmerged,
+            fdict,
+            tdict["tile"]["RA"][0],
+            tdict["tile"]["DEC"][0],
+            args.skythin,
+        )
+    n, tmpfn = write_targets(
+        args.outdir,
+        dmerged,
+        indir=mydirs["sky"],
+        indir2=mydirs["skysupp"],
+        survey="cmx",
+    )
+    os.rename(tmpfn, "{}-sky.fits".format(root))
+    log.info("{:.1f}s\t{}-sky.fits written".format(time() - start, root))
+
+
+# AR gfa
+def make_gfa(mydirs, tdict):
+    # mydirs : dictionary with the catalogue directories
+    # tdict  : dictionary with the tile context (see get_tdict())
+    d = read_mydir(mydirs, "gfa", tdict)
+    # AR GFA footprint filter: keeping the stars on one of the 10 GFA chips (+margin)
+    if args.gfafilter == "y":
+        keep = (
+            on_gfa(
+                tdict["tile"]["RA"][0],
+                tdict["tile"]["DEC"][0],
+                d["RA"],
+                d["DEC"],
+                buffer_arcsec=gfa_margin_arcsec,
+            )
+            >= 0
+        )
+        log.info(
+            "{:.1f}s\tGFA targets: keeping {:.0f}/{:.0f} on the GFA chips (margin={} arcsec)".format(
+                time() - start, keep.sum(), len(keep), gfa_margin_arcsec
+            )
+        )
+        d = d[keep]
+    # targets passing the AEN criterion
+    # https://github.com/desihub/desitarget/blob/801f1a1ac9041080f8062b84aec3634b1a9c1763/py/desitarget/gfa.py#L71-L77
+    g = d["GAIA_PHOT_G_MEAN_MAG"]
+    aen = d["GAIA_ASTROMETRIC_EXCESS_NOISE"]
+    keep = np.logical_or(
+        (g <= 19.0) * (aen < 10.0 ** 0.5),
+        (g >= 19.0) * (aen < 10.0 ** (0.5 + 0.2 * (g - 19.0))),
+    )
+    # AR computing positions at epoch using Gaia PMRA, PMDEC
+    # AR updating positions to epoch for targets passing the AEN criterion
+    epoch = get_epoch(args.epoch)
+    if args.epoch is None:
+        ras, decs = gfa_propagate(d[keep], epoch)
+    else:
+        ras, decs = gfa_propagate_cached(d[keep], epoch, args.gfacachedir)
+    d["RA"][keep] = ras
+    d["DEC"][keep] = decs
+    log.info(
+        "{:.1f}s\tGFA targets: updating RA,DEC with PM to epoch={:.6f} for {:.0f} targets passing AEN".format(
+            time() - start, epoch.jyear, keep.sum()
+        )
+    )
+    # AR updating REF_EPOCH for *all* objects (for PlateMaker)
+    d["REF_EPOCH"] = epoch.jyear
+    log.info(
+        "{:.1f}s\tGFA targets: updating REF_EPOCH to {} for all targets".format(
+            time() - start, d["REF_EPOCH"][0]
+        )
+    )
+    # AR header infos, written along with the targets
+    gfaprov = {
+        "PMUPDATE": "RA,DEC updated with PM for AEN objects",
+        "EPUPDATE": "REF_EPOCH updated for all objects",
+    }
+    n, tmpfn = write_targets(
+        args.outdir, d, indir=mydirs["gfa"], survey="cmx", extra=gfaprov
+    )
+    os.rename(tmpfn, "{}-gfa.fits".format(root))
+    log.info("{:.1f}s\t{}-gfa.fits written".format(time() - start, root))
+
+
+# AR selecting the std, removing the overlap with science targets
+def select_std(d, fdict):
+    # d     : output of read_targets_in_tiles()
+    # fdict : dictionary with the flavor settings
+    # AR single pass with the precomputed bitmasks
+    keep = (d["CMX_TARGET"] & fdict["stdbit"]) > 0
+    counts = get_msk_counts(d["CMX_TARGET"][keep], fdict["stdmsks"])
+    for msk in fdict["stdmsks"].split(","):
+        log.info(
+            "{:.1f}s\tkeeping {:.0f} {} stds".format(time() - start, counts[msk], msk)
+        )
+    # AR removing overlap with science targets
+    keep &= (d["CMX_TARGET"] & fdict["msksbit"]) == 0
+    log.info(
+        "{:.1f}s\tkeeping {:.0f}/{:.0f} stds after having cut on {} and removed {}".format(
+            time() - start, keep.sum(), len(keep), fdict["stdmsks"], fdict["msks"]
+        )
+    )
+    return d[keep]
+
+
+# AR std
+def make_std(mydirs, tdict, fdict):
+    # mydirs : dictionary with the catalogue directories
+    # tdict  : dictionary with the tile context (see get_tdict())
+    # fdict  : dictionary with the flavor settings
+    d = read_mydir(mydirs, "targ", tdict, header=False)
+    d = select_std(d, fdict)
+    # AR custom mtl
+    _ = cmx_make_mtl(d, "{}-std.fits".format(root))
+
+
+# AR selecting the targets
+def select_targ(d, fdict):
+    # d     : output of read_targets_in_tiles()
+    # fdict : dictionary with the flavor settings
+    # AR single pass with the precomputed bitmask
+    keep = (d["CMX_TARGET"] & fdict["msksbit"]) > 0
+    counts = get_msk_counts(d["CMX_TARGET"][keep], fdict["msks"])
+    for msk in fdict["msks"].split(","):
+        log.info(
+            "{:.1f}s\tkeeping {:.0f} {} targets".format(
+                time() - start, counts[msk], msk
+            )
+        )
+    log.info(
+        "{:.1f}s\tkeeping {:.0f}/{:.0f} targets after having cut on {}".format(
+            time() - start, keep.sum(), len(keep), fdict["msks"]
+        )
+    )
+    return d[keep]
+
+
+# AR (undithered) targets
+# AR ! not using make_mtl !
+def make_targ(mydirs, tdict, fdict):
+    # mydirs : dictionary with the catalogue directories
+    # tdict  : dictionary with the tile context (see get_tdict())
+    # fdict  : dictionary with the flavor settings
+    d, hdr = read_mydir(mydirs, "targ", tdict, header=True)
+    d = select_targ(d, fdict)
+    # AR DITHER : tweaking PRIORITY and NUMOBS_MORE + header infos
+    targprov = None
+    if fdict["dither"]:
+        d["PRIORITY_INIT"] = 1210 - np.clip(
+            d["GAIA_PHOT_RP_MEAN_MAG"] * 10, 100, 210
+        ).astype("i4")
+        d["NUMOBS_INIT"] = 1
+        targprov = {
+            "TWKPRIO": "PRIORITY_INIT = 1210-np.clip(GAIA_PHOT_RP_MEAN_MAG*10,100,210)",
+            "TWKNOBS": "NUMOBS_INIT = 1",
+        }
+        log.info(
+            "{:.1f}s\tPRIORITY_INIT and NUMOBS_INIT tweaked for dithering".format(
+                time() - start
+            )
+        )
+    # AR custom mtl
+    _ = cmx_make_mtl(d, "{}-targ.fits".format(root), extra=targprov)
+
+
+# AR splitmix64 finalizer (uint64 arrays, wrapping arithmetic)
+def splitmix64(x):
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+# AR counter-based random numbers for the dithering: hash of (seed, tileid, targetid, counter)
+# AR each target draws do not depend on the other targets (nor on their order),
+# AR so that any dithered tile can be re-generated alone, with one vectorized pass
+def get_dither_hashes(fdict, tileid, targetids, counter):
+    # fdict     : dictionary with the flavor settings
+    # tileid    : tileid
+    # targetids : TARGETIDs
+    # counter   : draw number
+    h = np.full(len(targetids), fdict["seed"], dtype=np.int64).view(np.uint64)
+    for x in [tileid, np.asarray(targetids, dtype=np.int64), counter]:
+        h = splitmix64(h ^ np.asarray(x, dtype=np.int64).view(np.uint64))
+    return h
+
+
+# AR uniform draws in [0, 1), from the 53 upper bits of the hashes
+def get_dither_uniforms(fdict, tileid, targetids, counter):
+    # same arguments as get_dither_hashes()
+    h = get_dither_hashes(fdict, tileid, targetids, counter)
+    return (h >> np.uint64(11)).astype(np.float64) * 2.0 ** -53
+
+
+# AR indexes of the assigned targets to be dithered
+# AR one random permutation of the assigned targets (ordered by their hashes), split in:
+# AR ginds : targets to be offset by a Gaussian
+# AR linds : targets to be offset within a box (dithlost-in-space)
+# AR also returns dithclass, the DITHER_CLASS of all the targets
+def get_dither_inds(targetids, tids, fdict, tileid):
+    # targetids : TARGETID of the (undithered) targets
+    # tids      : TARGETID of the assigned targets
+    # fdict     : dictionary with the flavor settings
+    # tileid    : undithered tileid
+    inds = np.flatnonzero(np.in1d(targetids, tids))
+    inds = inds[
+        np.argsort(get_dither_hashes(fdict, tileid, targetids[inds], 0), kind="stable")
+    ]
+    ng = int(fdict["gfrac"] * len(inds))
+    if fdict["gfrac"] + fdict["bfrac"] == 1:
+        nl = len(inds) - ng
+    else:
+        nl = int(fdict["bfrac"] * len(inds))
+    ginds, linds = inds[:ng], inds[ng : ng + nl]
+    dithclass = np.full(len(targetids), dither_classes["none"], dtype="i1")
+    dithclass[ginds] = dither_classes["gauss"]
+    dithclass[linds] = dither_classes["box"]
+    return ginds, linds, dithclass
+
+
+# AR dithered positions
+# AR two uniform draws per target (counters 1, 2), Box-Muller transformed for the Gaussian offsets
+def get_dither_radecs(ras, decs, targetids, ginds, linds, fdict, tileid):
+    # ras, decs    : undithered positions
+    # targetids    : TARGETID of the (undithered) targets
+    # ginds, linds : outputs of get_dither_inds()
+    # fdict        : dictionary with the flavor settings
+    # tileid       : dithered tileid
+    raoffs, decoffs = ras.copy(), decs.copy()
+    # AR Gaussian offset computation
+    if len(ginds) > 0:
+        u1, u2 = [
+            get_dither_uniforms(fdict, tileid, targetids[ginds], counter)
+            for counter in [1, 2]
+        ]
+        r = np.sqrt(-2.0 * np.log1p(-u1))
+        draws = np.array([r * np.cos(2 * np.pi * u2), r * np.sin(2 * np.pi * u2)]).T
+        raoffs[ginds] += (
+            draws[:, 0]
+            * fdict["gwidth"]
+            / 3600.0
+            / np.cos(np.radians(decs[ginds]))
+        )
+        decoffs[ginds] += draws[:, 1] * fdict["gwidth"] / 3600.0
+    # AR dithlost-in-space offset within a box
+    if len(linds) > 0:
+        draws = np.array(
+            [
+                get_dither_uniforms(fdict, tileid, targetids[linds], counter)
+                for counter in [1, 2]
+            ]
+        ).T
+        raoffs[linds] += (
+            (1 - 2 * draws[:, 0])
+            * fdict["bwidth"]
+            / 2.0
+            / 3600.0
+            / np.cos(np.radians(decs[linds]))
+        )
+        decoffs[linds] += (1 - 2 * draws[:, 1]) * fdict["bwidth"] / 2.0 / 3600.0
+    return raoffs, decoffs
+
+
+# AR undithered tile: targets assigned in fafn, to be offset on the dithered tiles
+# AR returns ras, decs, targetids of targfn, and the outputs of get_dither_inds()
+# AR + dithinds, the sorted indexes of the dithered targets
+def get_dither_targets(fafn, targfn, fdict, tileid):
+    # fafn   : fiberassign file of the undithered tile
+    # targfn : targets file of the undithered tile
+    # fdict  : dictionary with the flavor settings
+    # tileid : undithered tileid
+    d = fits.open(fafn)[1].data
+    # AR removing sky fibres
+    tids = d["TARGETID"][d["OBJTYPE"] == "TGT"]
+    log.info(
+        "{:.1f}s\t{}: {:.0f} {} assigned".format(
+            time() - start, fafn, len(tids), fdict["msks"]
+        )
+    )
+    d = read_product(targfn, ["RA", "DEC", "TARGETID"])
+    ras, decs, targetids = d["RA"], d["DEC"], d["TARGETID"]
+    # AR targets to be offset
+    ginds, linds, dithclass = get_dither_inds(targetids, tids, fdict, tileid)
+    dithinds = np.sort(np.concatenate([ginds, linds]))
+    return ras, decs, targetids, ginds, linds, dithclass, dithinds
+
+
+# AR compact dither sequence (--dithformat compact), written to outfn, with:
+# AR - TARGETS     : base table of the dithered targets (TARGETID, RA, DEC, DITHER_CLASS)
+# AR - DRA, DDEC   : (ndither, ntarget) float32 offsets [arcsec], i.e. RA = RA + DRA / 3600.
+# AR - FIBERASSIGN : (ndither, nfiber) TARGETID assigned to each FIBER (FIBER=column index, -1 if none)
+# AR - DITHERS     : TILEID of each dither
+def write_dither_compact(outfn, d, dithclass, dithtileids, dras, ddecs, fassigns, prov):
+    # outfn       : output fits file
+    # d           : undithered TARGETID, RA, DEC, restricted to the dithered ones
+    # dithclass   : DITHER_CLASS of d
+    # dithtileids : tileids of the dithers
+    # dras, ddecs : lists of the ndither RA, DEC offsets of d [arcsec]
+    # fassigns    : list of the ndither FASSIGN (FIBER, TARGETID) arrays
+    # prov        : dictionary of the provenance keywords for the PRIMARY header
+    base = np.zeros(
+        len(d["TARGETID"]),
+        dtype=[
+            ("TARGETID", ">i8"),
+            ("RA", ">f8"),
+            ("DEC", ">f8"),
+            ("DITHER_CLASS", "i1"),
+        ],
+    )
+    for key in ["TARGETID", "RA", "DEC"]:
+        base[key] = d[key]
+    base["DITHER_CLASS"] = dithclass
+    nfiber = 1 + np.max([fassign["FIBER"].max() for fassign in fassigns])
+    fibassign = np.full((len(fassigns), nfiber), -1, dtype=">i8")
+    for i, fassign in enumerate(fassigns):
+        fibassign[i, fassign["FIBER"]] = fassign["TARGETID"]
+    dithers = np.zeros(len(dithtileids), dtype=[("TILEID", ">i4")])
+    dithers["TILEID"] = dithtileids
+    hdr = fitsio.FITSHDR()
+    for key in prov.keys():
+        hdr[key] = prov[key]
+    tmpfn = outfn.replace(".fits", "-tmp.fits")
+    fd = fitsio.FITS(tmpfn, "rw", clobber=True)
+    fd.write(None, header=hdr, extname="PRIMARY")
+    fd.write(base, extname="TARGETS")
+    fd.write(np.array(dras, dtype=">f4"), extname="DRA")
+    fd.write(np.array(ddecs, dtype=">f4"), extname="DDEC")
+    fd.write(fibassign, extname="FIBERASSIGN")
+    fd.write(dithers, extname="DITHERS")
+    fd.close()
+    os.rename(tmpfn, outfn)
+    log.info(
+        "{:.1f}s\t{}: {:.0f} dithers of {:.0f} targets, {:.0f} fibers written".format(
+            time() - start, outfn, len(dithtileids), len(base), nfiber
+        )
+    )
+
+
+# AR summary index: counts per tile, per petal (PETAL=-1 for the whole tile), per class
+# AR CLASS: SKY, BAD, TGT, STD (any STD* bit), each msk of fdict["msks"] (and fdict["stdmsks"]),
+# AR    and any other assigned or reachable cmx_mask bit
+# AR NAVAIL: reachable targets of the class (POTENTIAL_ASSIGNMENTS), -1 for SKY, BAD
+# AR COMPLETENESS = NASSIGN / NAVAIL
+def get_summary(tileid, fafn, mtlfns, fdict, fatime):
+    # tileid : tileid
+    # fafn   : fiberassign-{tileid}.fits file
+    # mtlfns : list of the MTL files used for fafn
+    # fdict  : dictionary with the flavor settings
+    # fatime : time spent for the tile fiber assignment [s]
+    fa = fitsio.read(fafn, ext="FIBERASSIGN")
+    objtypes = np.char.strip(fa["OBJTYPE"].astype(str))
+    pot = fitsio.read(
+        fafn, ext="POTENTIAL_ASSIGNMENTS", columns=["TARGETID", "LOCATION"]
+    )
+    # AR CMX_TARGET of the reachable targets, from the MTL files
+    ms = [read_product(mtlfn, ["TARGETID", "CMX_TARGET"]) for mtlfn in mtlfns]
+    mtids, iim = np.unique(
+        np.concatenate([m["TARGETID"] for m in ms]), return_index=True
+    )
+    mbits = np.concatenate([m["CMX_TARGET"] for m in ms])[iim]
+    ii = np.searchsorted(mtids, pot["TARGETID"])
+    ii[ii == len(mtids)] = 0
+    found = mtids[ii] == pot["TARGETID"]
+    avbits = np.zeros(len(pot), dtype=int)
+    avbits[found] = mbits[ii[found]]
+    msks = fdict["msks"]
+    if fdict["addstd"]:
+        msks += "," + fdict["stdmsks"]
+    rows = []
+    for petal in [-1] + list(range(10)):
+        sel = np.ones(len(fa), dtype=bool)
+        avsel = np.ones(len(pot), dtype=bool)
+        if petal != -1:
+            sel = fa["PETAL_LOC"] == petal
+            avsel = pot["LOCATION"] // 1000 == petal
+        # AR reachable targets counted once per petal
+        _, iiav = np.unique(pot["TARGETID"][avsel], return_index=True)
+        avpetbits = avbits[avsel][iiav]
+        istgt = sel & (objtypes == "TGT")
+        counts = {key: ((objtypes == key) & sel).sum() for key in ["SKY", "BAD"]}
+        avcounts = {key: -1 for key in ["SKY", "BAD"]}
+        counts["TGT"], avcounts["TGT"] = istgt.sum(), len(avpetbits)
+        counts["STD"] = ((fa["CMX_TARGET"][istgt] & std_cmx_bit) > 0).sum()
+        avcounts["STD"] = ((avpetbits & std_cmx_bit) > 0).sum()
+        # AR flavor msks, and any other assigned or reachable bit
+        bitcounts = get_cmx_bit_counts(fa["CMX_TARGET"][istgt])
+        avbitcounts = get_cmx_bit_counts(avpetbits)
+        for msk in msks.split(",") + sorted(set(bitcounts) | set(avbitcounts)):
+            if msk in ["SKY", "BAD", "TGT", "STD"]:
+                continue
+            counts[msk] = bitcounts.get(msk, 0)
+            avcounts[msk] = avbitcounts.get(msk, 0)
+        for key in counts:
+            rows.append(
+                (
+                    tileid,
+                    args.flavor,
+                    petal,
+                    key,
+                    counts[key],
+                    avcounts[key],
+                    counts[key] / avcounts[key] if avcounts[key] > 0 else np.nan,
+                    fatime,
+                    datetime.utcnow().isoformat(timespec="seconds"),
+                )
+            )
+    return np.array(rows, dtype=summarydatamodel.dtype)
+
+
+# AR appending the summary rows of a tile to the run summary index
+# AR (previous rows of the same tileid are replaced; file locked for parallel calls)
+def append_summary(fn, d):
+    # fn : summary index fits file
+    # d  : output of get_summary()
+    with open(fn + ".lock", "w") as lockf:
+        fcntl.flock(lockf, fcntl.LOCK_EX)
+        if os.path.isfile(fn):
+            prev = fitsio.read(fn, ext="SUMMARY")
+            prev = prev[~np.in1d(prev["TILEID"], d["TILEID"])]
+            d = np.concatenate([prev.astype(summarydatamodel.dtype), d])
+        tmpfn = fn.replace(".fits", "-tmp.fits")
+        fitsio.write(tmpfn, d, extname="SUMMARY", clobber=True)
+        os.rename(tmpfn, fn)
+        fcntl.flock(lockf, fcntl.LOCK_UN)
+    log.info(
+        "{:.1f}s\t{}: rows for tileid={} appended ({:.0f} rows)".format(
+            time() - start, fn, d["TILEID"][-1], len(d)
+        )
+    )
+
+
+# AR control plot for a tile
+def plot_tile(tileid, d, dp, skyp, tsky, fdict, tile_in_desi, ntiles):
+    # tileid       : tileid
+    # d            : FIBERASSIGN extension of fiberassign-{tileid}.fits
+    # dp           : parent targets
+    # skyp         : SkyCoord of the parent targets
+    # tsky         : SkyCoord of the tile centre
+    # fdict        : dictionary with the flavor settings
+    # tile_in_desi : is the tile in the desi footprint? (0 or 1)
+    # ntiles       : number of processed tiles (for the assigned densities)
+    cm = mycmap("jet_r", 10, 0, 1)
+    tra, tdec = tsky.ra.value, tsky.dec.value
+    mydict = {}
+    for key in ["SKY", "BAD", "TGT"]:
+        mydict["N" + key] = (d["OBJTYPE"] == key).sum()
+    keys = [
+        "TARGETID",
+        "PETAL_LOC",
+        "CMX_TARGET",
+        "FLUX_G",
+        "FLUX_R",
+        "FLUX_Z",
+        "TARGET_RA",
+        "TARGET_DEC",
+        "GAIA_PHOT_RP_MEAN_MAG",
+        "PRIORITY",
+    ]
+    # AR arrays following the parent ordering
+    d = d[d["OBJTYPE"] == "TGT"]
+    iip, ii = unq_searchsorted(dp["TARGETID"], d["TARGETID"])
+    for key in keys:
+        if key == "CMX_TARGET":
+            mydict[key] = np.zeros(len(dp["TARGETID"]), dtype=int)
+        else:
+            mydict[key] = np.nan + np.zeros(len(dp["TARGETID"]))
+        mydict[key][iip] = d[key][ii]
+
+    # JEFR counts of assigned targets per class
+    # AR per-bit counts, vectorized (see get_cmx_bit_counts())
+    std_total = ((d["CMX_TARGET"] & std_cmx_bit) > 0).sum()
+    # AR only taking a class into account if it has more than 20 instances
+    assigned_names = {
+        msk: n for msk, n in get_cmx_bit_counts(d["CMX_TARGET"]).items() if n > 20
+    }
+
+    sky = SkyCoord(
+        ra=mydict["TARGET_RA"] * units.deg,
+        dec=mydict["TARGET_DEC"] * units.deg,
+        frame="icrs",
+    )
+    #
+    fig = plt.figure(figsize=(25, 15))
+    title = "flavor={}    TILEID={:06d} at RA,DEC={:.1f},{:.1f}   obscon={}\n".format(
+        args.flavor, tileid, tra, tdec, fdict["obscon"]
+    )
+    title += "SKY={:.0f} , BAD={:.0f} , TGT={:.0f} , STD={:.0f} (".format(
+        mydict["NSKY"], mydict["NBAD"], mydict["NTGT"], std_total
+    )
+    title += " , ".join(
+        [
+            "{}={:.0f}".format(
+                msk, ((mydict["CMX_TARGET"] & cmx_mask[msk]) > 0).sum()
+            )
+            for msk in fdict["msks"].split(",")
+        ]
+    )
+    title += ")"
+    fig.text(
+        0.5, 0.9, title, ha="center", fontsize=15, transform=fig.transFigure
+    )
+    gs = gridspec.GridSpec(4, 4, wspace=0.3, hspace=0.2)
+
+    # AR grz-mags
+    for ip, key in enumerate(["FLUX_G", "FLUX_R", "FLUX_Z"]):
+        ax = plt.subplot(gs[0, ip])
+        # AR handling outside desi cases
+        if tile_in_desi == 1:
+            keep = dp[key] > 0
+            xp = 22.5 - 2.5 * np.log10(dp[key][keep])
+            bitp = dp["CMX_TARGET"][keep]
+            keep = mydict[key] > 0
+            x = 22.5 - 2.5 * np.log10(mydict[key][keep])
+            bit = mydict["CMX_TARGET"][keep]
+            bins = np.linspace(xp.min(), xp.max(), 51)
+            plot_hist(ax, x, xp, bins, "22.5 - 2.5 * log10({})".format(key))
+            _, ymax = ax.get_ylim()
+            ax.set_ylim(0.8, 100 * ymax)
+            ax.set_yscale("log")
+        else:
+            ax.set_xlabel("22.5 - 2.5*log1(" + key + ")")
+
+    # AR grz-diagram
+    ax = plt.subplot(gs[0, 3])
+    grp = -2.5 * np.log10(dp["FLUX_G"] / dp["FLUX_R"])
+    rzp = -2.5 * np.log10(dp["FLUX_R"] / dp["FLUX_Z"])
+    gr = -2.5 * np.log10(mydict["FLUX_G"] / mydict["FLUX_R"])
+    rz = -2.5 * np.log10(mydict["FLUX_R"] / mydict["FLUX_Z"])
+    ax.scatter(rzp, grp, c="k", s=2, alpha=0.1, rasterized=True, label="parent")
+    ax.scatter(rz, gr, c="r", s=2, alpha=1.0, rasterized=True, label="assigned")
+    ax.set_xlabel("-2.5 * log10(FLUX_R / FLUX_Z)")
+    ax.set_ylabel("-2.5 * log10(FLUX_G / FLUX_R)")
+    ax.set_xlim(-0.5, 2.5)
+    ax.set_ylim(-0.5, 2.5)
+    ax.grid(True)
+    ax.legend(loc=4)
+
+    # AR position in tile
+    ax = plt.subplot(gs[1, 0])  # AR will be over-written
+    xlim, ylim, gridsize = (2, -2), (-2, 2), 50
+    plot_area = (xlim[0] - xlim[1]) * (
+        ylim[1] - ylim[0]
+    )  # AR area of the plotting window in deg2
+    # AR parent
+    spho = tsky.spherical_offsets_to(skyp)  # AR in degrees
+    drap = spho[0].value
+    ddecp = spho[1].value
+    hbp = ax.hexbin(
+        drap,
+        ddecp,
+        C=None,
+        gridsize=gridsize,
+        extent=(xlim[1], xlim[0], ylim[0], ylim[1]),
+        mincnt=0,
+        visible=False,
+    )
+    # AR assigned
+    spho = tsky.spherical_offsets_to(sky)  # AR in degrees
+    dra = spho[0].value
+    ddec = spho[1].value
+    hb = ax.hexbin(
+        dra,
+        ddec,
+        C=None,
+        gridsize=gridsize,
+        extent=(xlim[1], xlim[0], ylim[0], ylim[1]),
+        mincnt=0,
+        visible=False,
+    )
+    #
+    tmpx = hb.get_offsets()[:, 0]
+    tmpy = hb.get_offsets()[:, 1]
+    keep = hbp.get_array() > 0
+    carea = plot_area / len(hbp.get_array())  # AR plt.hexbin "cell" area
+    area = carea * keep.sum()  # AR ~desi fov area in deg2
+    #
+    for ip, c, clab in zip(
+        [0, 1, 2],
+        [
+            hbp.get_array() / carea,
+            hb.get_array() / ntiles / carea,
+            (hb.get_array() / hbp.get_array()) / ntiles,
+        ],
+        [
+            r"parent density [deg$^{-2}$]",
+            r"assigned density [deg$^{-2}$]",
+            "parent fraction assigned",
+        ],
+    ):
+        cmin = c[keep].mean() - 3 * c[keep].std()
+        cmin = np.max([0, cmin])
+        cmax = c[keep].mean() + 3 * c[keep].std()
+        if ip == 2:
+            cmax = np.min([1, cmax])
+            txt = r"mean = {:.2f}".format(c[keep].mean())
+        else:
+            txt = (
+                r"mean = {:.0f}".format(c[keep].sum() * carea / area)
+                + " deg$^{-2}$"
+            )
+        ax = plt.subplot(gs[1, ip])
+        SC = ax.scatter(
+            tmpx[keep],
+            tmpy[keep],
+            c=c[keep],
+            s=15,
+            vmin=cmin,
+            vmax=cmax,
+            alpha=0.5,
+            cmap=cm,
+        )
+        ax.set_xlabel(r"$\Delta$RA = Angular distance to TILE_RA [deg.]")
+        ax.set_ylabel(r"$\Delta$DEC = Angular distance to TILE_DEC [deg.]")
+        ax.set_xlim(xlim)
+        ax.set_ylim(ylim)
+        ax.grid(True)
+        ax.text(
+            0.02,
+            0.93,
+            txt,
+            color="k",
+            fontweight="bold",
+            fontsize=15,
+            transform=ax.transAxes,
+        )
+        cbar = plt.colorbar(SC)
+        cbar.set_label(clab)
+        cbar.mappable.set_clim(cmin, cmax)
+
+    # AR dithering positions
+    if fdict["dither"]:
+        xmax = 5 * fdict["gwidth"]
+        if fdict["bfrac"] > 0:
+            xmax = np.max([xmax, 1.5 * fdict["bwidth"] / 2.0])
+        # AR positions
+        spho = skyp.spherical_offsets_to(sky)  # AR in degrees
+        dra = spho[0].value.flatten() * 3600.0  # AR in arcsec
+        ddec = spho[1].value.flatten() * 3600.0  # AR in arcsec
+        keep = (np.isfinite(dra)) & (np.isfinite(ddec))
+        dra, ddec = dra[keep], ddec[keep]
+        ax = plt.subplot(gs[2, 0])
+        ax.scatter(dra, ddec, c="k", s=5, alpha=0.2)
+        axx = ax.twinx()
+        axx.hist(
+            dra,
+            bins=100,
+            histtype="stepfilled",
+            alpha=0.3,
+            color="k",
+            density=True,
+        )
+        axx.set_ylim(0, 5)
+        axx.axis("off")
+        axy = ax.twiny()
+        axy.hist(
+            ddec,
+            bins=100,
+            histtype="stepfilled",
+            alpha=0.3,
+            color="k",
+            density=True,
+            orientation="horizontal",
+        )
+        axy.set_xlim(0, 5)
+        axy.axis("off")
+        ax.set_xlabel("$\Delta$RA = Angular offset in R.A. [arcsec]")
+        ax.set_ylabel("$\Delta$DEC = Angular offset in Dec. [arcsec]")
+        ax.set_xlim(-xmax, xmax)
+        ax.set_ylim(-xmax, xmax)
+        ax.grid(True)
+        txt = r"$\Delta$RA ={:.3f}$\pm${:.3f} arcsec".format(
+            dra.mean(), dra.std()
+        )
+        ax.text(
+            0.02,
+            0.93,
+            txt,
+            color="k",
+            fontweight="bold",
+            fontsize=10,
+            transform=ax.transAxes,
+        )
+        txt = r"$\Delta$DEC={:.3f}$\pm${:.3f} arcsec".format(
+            ddec.mean(), ddec.std()
+        )
+        ax.text(
+            0.02,
+            0.89,
+            txt,
+            color="k",
+            fontweight="bold",
+            fontsize=10,
+            transform=ax.transAxes,
+        )
+        # AR gaussian / box
+        if fdict["gfrac"] > 0:
+            tmpx = np.linspace(-xmax, xmax, 1000)
+            tmpy = gaussian(tmpx, 1.0, 0.0, fdict["gwidth"])
+            axx.plot(
+                tmpx,
+                tmpy,
+                color="k",
+                label="Gaussian(0," + "%.2f" % fdict["gwidth"] + ")",
+            )
+            axy.plot(tmpy, tmpx, color="k")
+            axx.legend(loc=1)
+        if fdict["bfrac"] > 0:
+            ax.axhline(
+                +fdict["bwidth"] / 2.0,
+                ls="--",
+                color="k",
+                label="box of " + "%.2f" % fdict["bwidth"] + " width",
+            )
+            ax.axhline(-fdict["bwidth"] / 2.0, ls="--", color="k")
+            ax.axvline(+fdict["bwidth"] / 2.0, ls="--", color="k")
+            ax.axvline(-fdict["bwidth"] / 2.0, ls="--", color="k")
+            ax.legend(loc=4)
+
+    # AR rmag
+    ax = plt.subplot(gs[2, 1])
+    xp = dp["GAIA_PHOT_RP_MEAN_MAG"]
+    x = mydict["GAIA_PHOT_RP_MEAN_MAG"]
+    x = x[np.isfinite(x)]
+    bins = np.linspace(xp.min(), xp.max(), 51)
+    plot_hist(ax, x, xp, bins, "GAIA_PHOT_RP_MEAN_MAG")
+
+    # AR priority
+    ax = plt.subplot(gs[2, 2])
+    xp = dp["PRIORITY"]
+    x = mydict["PRIORITY"]
+    bins = np.linspace(xp.min(), xp.max(), xp.max() - xp.min() + 1)
+    plot_hist(ax, x, xp, bins, "PRIORITY")
+
+    # JEFR count assigned targets per class
+    ax = plt.subplot(gs[3, 2])
+    names = np.array(list(assigned_names.keys()))
+    values = np.array(list(assigned_names.values()))
+    ii = np.argsort(values)
+    plt.barh(names[ii], values[ii], align="center", alpha=0.5)
+    for i, v in enumerate(values[ii]):
+        plt.text(v + 3, i - 0.25, str(v))
+
+    #  AR saving plot
+    outfn = "{}fiberassign-{:06d}.png".format(args.outdir, tileid)
+    tmpfn = "{}-{}.tmp".format(outfn, os.getpid())
+    plt.savefig(tmpfn, bbox_inches="tight", format="png")
+    os.rename(tmpfn, outfn)
+    plt.close()
+
+
 def main():
     #
     start = time()
@@ -202,22 +2023,22 @@ def main():
                     time() - start
                 )
             )
-            sys.exit()
+            sys.exit(1)
         else:
-            fn = os.getenv("DESIMODEL") + "/data/footprint/desi-tiles.fits"
-            d = fits.open(fn)[1].data
-            keep = d["TILEID"] == args.intileid
-            if keep.sum() > 0:
-                args.tilera = d["RA"][keep][0]
+            tcat = get_tilecat(args.tilecachedir)
+            fn = tcat["fn"]
+            tras, tdecs, found = get_tile_radecs(tcat, [args.intileid])
+            if found[0]:
+                args.tilera = tras[0]
                 log.info(
                     "{:.1f}s\t{:.0f} in {} -> setting args.tilera ={}".format(
-                        time() - start, args.intileid, fn, d["RA"][keep][0]
+                        time() - start, args.intileid, fn, tras[0]
                     )
                 )
-                args.tiledec = d["DEC"][keep][0]
+                args.tiledec = tdecs[0]
                 log.info(
                     "{:.1f}s\t{:.0f} in {} -> setting args.tiledec={}".format(
-                        time() - start, args.intileid, fn, d["DEC"][keep][0]
+                        time() - start, args.intileid, fn, tdecs[0]
                     )
                 )
             else:
@@ -226,123 +2047,60 @@ def main():
                         time() - start, fn
                     )
                 )
-                sys.exit()
+                sys.exit(1)
     # AR safe: flavor
-    if args.flavor not in [
-        "dithprec",
-        "dithlost",
-        "starfaint",
-        "scidark",
-        "scibright",
-        "focus",
-    ]:
+    if args.flavor not in flavors:
         log.error(
-            "args.flavor not in dithprec,dithlost,starfaint,scidark,scibright,focus; exiting"
+            "args.flavor not in {}; exiting".format(",".join(flavors.keys()))
         )
-        sys.exit()
-    # AR safe: hostname
-    if ("desi" not in os.getenv("HOSTNAME")) & ("cori" not in os.getenv("HOSTNAME")):
-        log.error("code needs to be run either on NERSC/cori or KPNO/desi; exiting")
-        sys.exit()
-
+        sys.exit(1)
+    if flavors[args.flavor] is None:
+        log.error("flavor=={} not implemented yet; exiting".format(args.flavor))
+        sys.exit(1)
+    # AR safe: pyarrow, for --intermediate-format arrow
+    if (args.intermediate_format == "arrow") & (pa is None):
+        log.error("--intermediate-format arrow requires pyarrow; exiting")
+        sys.exit(1)
     # AR is tile in the desi footprint?
     # AR -> if not, special msk and targdir for dithering
-    tile_in_desi = is_point_in_desi(
-        dmio.load_tiles(), args.tilera, args.tiledec
-    ).astype(int)
+    tile_in_desi = is_in_desi(
+        get_tilecat(args.tilecachedir), args.tilera, args.tiledec
+    )[0].astype(int)
+
+    # AR dictionary with settings proper to each flavor
+    fdict = get_fdict(args.flavor, tile_in_desi, args.seed)
 
-    if (not tile_in_desi) and (args.flavor in ["scidark", "scibright"]):
+    if (not tile_in_desi) and (fdict["indesi"]):
         log.error(
             "requested tile is not in DESI and requested flavor=={}; exiting".format(
                 args.flavor
             )
         )
-        sys.exit()
-
-    # AR dictionary with settings proper to each flavor
-    fdict = {}
-    # AR allowing all observing conditions for the cmx tiles, whatever the flavor
-    fdict["obscon"] = "DARK|GRAY|BRIGHT"
-    # AR minimum number of sky fibres per petal
-    fdict["nskypet"] = "40"  # AR default
-    fdict["nstdpet"] = "10" # default
-    # AR (no) dithering initialisation
-    fdict["seed"] = -1  # AR random seed
-    fdict["ndither"] = 0  # AR number of dithered tiles
-    fdict[
-        "gfrac"
-    ] = 0.0  # AR fraction of assigned stars that are dithered with a Gaussian
-    fdict["gwidth"] = 0.0  # AR offset [arcsec] per coordinate normal distribution
-    fdict[
-        "bfrac"
-    ] = 0.0  # AR fraction of assigned stars  that are dithered within a box for the dithlost-in-space case
-    fdict[
-        "bwidth"
-    ] = 0.0  # AR box width [arcsec] of the dithering for the dithlost-in-space case
-
-    # AR flavor settings
-    if args.flavor == "dithprec":
-        if tile_in_desi == 0:
-            fdict["msks"] = "STD_DITHER_GAIA"
-        else:
-            fdict["msks"] = "STD_DITHER"
-        fdict["seed"] = args.seed
-        fdict["ndither"] = 12
-        fdict["gfrac"] = 1.0
-        fdict["gwidth"] = 0.7
-    elif args.flavor == "dithlost":
-        if tile_in_desi == 0:
-            fdict["msks"] = "STD_DITHER_GAIA"
-        else:
-            fdict["msks"] = "STD_DITHER"
-        fdict["seed"] = args.seed
-        fdict["ndither"] = 1
-        fdict["gfrac"] = 0.5
-        fdict["gwidth"] = 2.0
-        fdict["bfrac"] = 0.5
-        fdict["bwidth"] = 10.0
-    elif args.flavor == "starfaint":
-        fdict["msks"] = "STD_FAINT,SV0_WD"
-        fdict["nskypet"] = "100"
-    elif args.flavor == "scidark":
-        # fdict['msks'] = 'SV0_WD,MINI_SV_LRG,MINI_SV_ELG,MINI_SV_QSO'
-        fdict["msks"] = "SV0_WD,SV0_LRG,SV0_ELG,SV0_QSO"
-        fdict["nskypet"] = "80"
-        fdict["nstdpet"] = "20"
-    elif args.flavor == "scibright":
-        # fdict['msks'] = 'SV0_WD,MINI_SV_BGS_BRIGHT,SV0_MWS_FAINT'
-        fdict["msks"] = "SV0_WD,SV0_BGS,SV0_MWS_FAINT"
-    elif args.flavor == "focus":
-        log.error("flavor==focus not implemented yet; exiting")
-        sys.exit()
-    if fdict["seed"] != -1:
-        np.random.seed(fdict["seed"])
-
-    # AR directories (already checked for desi or cori only)
-    hostname = os.getenv("HOSTNAME")
-    if "desi" in hostname:
-        path_to_targets = "/data/target/catalogs"
-        path_to_svn_tiles = "/data/tiles/SVN_tiles"
-    if "cori" in hostname:
-        path_to_targets = os.path.join(os.getenv("DESI_TARGET"), "catalogs")
-        path_to_svn_tiles = os.path.join(
-            os.getenv("DESI_TARGET"), "fiberassign/tiles/trunk"
-        )
-
-    mydirs = {}
-    if (args.flavor in ["dithprec", "dithlost"]) & (tile_in_desi == 0):
-        mydirs["targ"] = os.path.join(
-            path_to_targets, "gaiadr2", args.dtver, "targets/cmx/resolve/supp"
-        )
-    else:
-        mydirs["targ"] = os.path.join(
-            path_to_targets, args.dr, args.dtver, "targets/cmx/resolve/no-obscon"
+        sys.exit(1)
+
+    # AR directories: first search root with all the catalogues
+    roots = get_data_roots(args.datacfg)
+    path_to_targets = None
+    for path in roots["targets"]:
+        if np.all([os.path.isdir(d) for d in get_mydirs(path, fdict).values()]):
+            path_to_targets = path
+            break
+    if path_to_targets is None:
+        log.error(
+            "{:.1f}s\tno catalogues for dr={} dtver={} in {}; exiting".format(
+                time() - start, args.dr, args.dtver, ",".join(roots["targets"])
+            )
         )
-    mydirs["sky"] = os.path.join(path_to_targets, args.dr, args.dtver, "skies")
-    mydirs["skysupp"] = os.path.join(
-        path_to_targets, "gaiadr2", args.dtver, "skies-supp"
-    )
-    mydirs["gfa"] = os.path.join(path_to_targets, args.dr, args.dtver, "gfas")
+        sys.exit(1)
+    path_to_svn_tiles = None
+    for path in roots["svntiles"]:
+        if os.path.isdir(path):
+            path_to_svn_tiles = path
+            break
+    if (args.localcache is None) & (len(roots["localcache"]) > 0):
+        args.localcache = roots["localcache"][0]
+
+    mydirs = get_mydirs(path_to_targets, fdict)
     for key in mydirs.keys():
         log.info(
             "{:.1f}s\tdirectory for {}: {}".format(time() - start, key, mydirs[key])
@@ -350,9 +2108,17 @@ def main():
     log.info(
         "{:.1f}s\tdirectory for svn tiles: {}".format(time() - start, path_to_svn_tiles)
     )
+    log.info("{:.1f}s\tlocal cache: {}".format(time() - start, args.localcache))
 
     # AR extra tileid if ndither>0; switching to np.array() in all cases
+    if fdict["dither"] & (args.ndither is not None):
+        fdict["ndither"] = args.ndither
     tileids = np.array([args.tileid + i for i in range(1 + fdict["ndither"])])
+    # AR fatileids: tileids with per-tile files
+    # AR (with --dithformat compact, the dithers are gathered in {root}-dither.fits)
+    fatileids = tileids
+    if fdict["dither"] & (args.dithformat == "compact"):
+        fatileids = tileids[:1]
     log.info(
         "{:.1f}s\twill process {} tiles with tileid={}".format(
             time() - start,
@@ -364,10 +2130,21 @@ def main():
     # AR ! only checking for the official naming/storing convention !
     # AR ! will fail to detect duplicates tileids if files are organized differently !
     # AR ! may also fail if two similar tileids are requested in a given parallel call!
-    prev_fns = [
-        fn.split("/")[-1]
-        for fn in glob(os.path.join(path_to_svn_tiles, "???/fiberassign-??????.fits"))
-    ]
+    # AR ! skipped (with a warning) if no svn tiles folder is found !
+    prev_fns = []
+    if path_to_svn_tiles is None:
+        log.warning(
+            "{:.1f}s\tno svn tiles folder in {}: not checking for duplicate tileids".format(
+                time() - start, ",".join(roots["svntiles"])
+            )
+        )
+    else:
+        prev_fns = [
+            fn.split("/")[-1]
+            for fn in glob(
+                os.path.join(path_to_svn_tiles, "???/fiberassign-??????.fits")
+            )
+        ]
 
     new_fns = ["fiberassign-{:06d}.fits".format(tid) for tid in tileids]
     if np.in1d(new_fns, prev_fns).sum() > 0:
@@ -376,7 +2153,7 @@ def main():
                 time() - start, ",".join(new_fns)
             )
         )
-        sys.exit()
+        sys.exit(1)
 
     # AR printing settings
     tmpstr = " , ".join(
@@ -386,208 +2163,134 @@ def main():
     tmpstr = " , ".join([key + "=" + str(fdict[key]) for key in fdict.keys()])
     log.info("{:.1f}s\tfdict: {}".format(time() - start, tmpstr))
 
+    # AR run manifest (--resume y: continuing from the first incomplete step)
+    init_manifest(root + "-manifest.json", args.resume == "y")
+
+    # AR tile context, passed to the stages
+    tdict = get_tdict(fatileids, fdict)
+
     # AR tiles
     if dotile:
-        hdr = fitsio.FITSHDR()
-        for tileid in tileids:
-            d = np.zeros(
-                1,
-                dtype=[
-                    ("TILEID", "i4"),
-                    ("RA", "f8"),
-                    ("DEC", "f8"),
-                    ("OBSCONDITIONS", "i4"),
-                    ("IN_DESI", "i2"),
-                    ("PROGRAM", "S6"),
-                ],
+        run_stage("tiles", make_tiles, (tdict,), root + "-tiles.fits")
+
+    # AR catalogue reads, issued concurrently, awaited by the stages
+    # AR dirpool threads only dispatch the per-file reads to the filepool processes and gather them
+    # AR forkserver: the workers are not forked from this (multi-threaded) process,
+    # AR and only import desitarget.io (not this script)
+    catreads.clear()
+    if args.nthread > 1:
+        dirpool = ThreadPoolExecutor(max_workers=len(mydirs))
+        mpctx = get_context("forkserver")
+        mpctx.set_forkserver_preload(["desitarget.io"])
+        filepool = ProcessPoolExecutor(max_workers=args.nthread, mp_context=mpctx)
+        keys = []
+        if dosky & (not is_done("sky")):
+            keys += ["sky", "skysupp"]
+        if dogfa & (not is_done("gfa")):
+            keys += ["gfa"]
+        if (dostd & fdict["addstd"] & (not is_done("std"))) | (
+            dotarg & (not is_done("targ"))
+        ):
+            keys += ["targ"]
+        for key in keys:
+            catreads[key] = dirpool.submit(
+                read_hpdir, mydirs[key], tdict, header=True, filepool=filepool
             )
-            d["TILEID"] = tileid
-            d["RA"] = args.tilera
-            d["DEC"] = args.tiledec
-            d[
-                "IN_DESI"
-            ] = 1  # AR forcing 1; otherwise the default onlydesi=True option in
-            # AR desimodel.io.load_tiles() discards tiles outside the desi footprint,
-            # AR so return no tiles for the dithered tiles outside desi
-            d["PROGRAM"] = "CMX"  # AR custom...
-            d["OBSCONDITIONS"] = obsconditions.mask(
-                fdict["obscon"]
-            )  # AR we force the obsconditions to fdict["obscon"]
-            fitsio.write(
-                "{}{:06d}-tiles.fits".format(args.outdir, tileid),
-                d,
-                extname="TILES",
-                header=hdr,
-                clobber=True,
-            )
-            log.info(
-                "{:.1f}s\t{}{:06d}-tiles.fits written".format(
-                    time() - start, args.outdir, tileid
-                )
+        log.info(
+            "{:.1f}s\tconcurrent reads issued for {} ({} processes)".format(
+                time() - start, ",".join(keys), args.nthread
             )
+        )
 
     # AR sky
     if dosky:
-        tiles = fits.open("{}-tiles.fits".format(root))[1].data
-        d = read_targets_in_tiles(mydirs["sky"], tiles=tiles)
-        dsupp = read_targets_in_tiles(mydirs["skysupp"], tiles=tiles)
-        # JEFR we have to check for duplicates before merging
-        dmerged = np.concatenate([d, dsupp])
-        if len(dmerged["TARGETID"]) != len(set(dmerged["TARGETID"])):
-            log.info("Duplicated TARGETID in sky")
-            _, ii_unique = np.unique(dmerged["TARGETID"], return_index=True)
-            dmerged = dmerged[ii_unique]
-
-        n, tmpfn = write_targets(
-            args.outdir,
-            dmerged,
-            indir=mydirs["sky"],
-            indir2=mydirs["skysupp"],
-            survey="cmx",
+        run_stage(
+            "sky",
+            make_sky,
+            (mydirs, tdict, fdict),
+            root + "-sky.fits",
         )
-        os.rename(tmpfn, "{}-sky.fits".format(root))
-        log.info("{:.1f}s\t{}-sky.fits written".format(time() - start, root))
 
     # AR gfa
     if dogfa:
-        tiles = fits.open("{}-tiles.fits".format(root))[1].data
-        d = read_targets_in_tiles(mydirs["gfa"], tiles=tiles)
-        # AR clipping Gaia PARALLAX to >1e-3 (setting distance at <1Mpc)
-        parallax = d["PARALLAX"].copy()
-        parallax[(~np.isfinite(d["PARALLAX"])) | (d["PARALLAX"] < 1e-3)] = 1e-3
-        # AR computing positions at Time.now() using Gaia PMRA, PMDEC
-        c = SkyCoord(
-            ra=d["RA"] * units.degree,
-            dec=d["DEC"] * units.degree,
-            pm_ra_cosdec=d["PMRA"] * units.mas / units.yr,
-            pm_dec=d["PMDEC"] * units.mas / units.yr,
-            frame="icrs",
-            obstime=Time(d["REF_EPOCH"], format="jyear"),
-            distance=Distance(parallax=parallax * units.mas),
-        )
-        nowc = c.apply_space_motion(new_obstime=Time.now())
-        # targets passing the AEN criterion
-        # https://github.com/desihub/desitarget/blob/801f1a1ac9041080f8062b84aec3634b1a9c1763/py/desitarget/gfa.py#L71-L77
-        g = d["GAIA_PHOT_G_MEAN_MAG"]
-        aen = d["GAIA_ASTROMETRIC_EXCESS_NOISE"]
-        keep = np.logical_or(
-            (g <= 19.0) * (aen < 10.0 ** 0.5),
-            (g >= 19.0) * (aen < 10.0 ** (0.5 + 0.2 * (g - 19.0))),
-        )
-        # AR updating positions to Time.now() for targets passing the AEN criterion
-        d["RA"][keep] = nowc.ra.value[keep]
-        d["DEC"][keep] = nowc.dec.value[keep]
-        log.info(
-            "{:.1f}s\tGFA targets: updating RA,DEC with PM for {:.0f} targets passing AEN".format(
-                time() - start, keep.sum()
-            )
-        )
-        # AR updating REF_EPOCH for *all* objects (for PlateMaker)
-        d["REF_EPOCH"] = Time.now().jyear
-        log.info(
-            "{:.1f}s\tGFA targets: updating REF_EPOCH to {} for all targets".format(
-                time() - start, d["REF_EPOCH"][0]
-            )
+        run_stage(
+            "gfa",
+            make_gfa,
+            (mydirs, tdict),
+            root + "-gfa.fits",
         )
-        n, tmpfn = write_targets(args.outdir, d, indir=mydirs["gfa"], survey="cmx")
-        os.rename(tmpfn, "{}-gfa.fits".format(root))
-        # AR update header
-        fd = fitsio.FITS("{}-gfa.fits".format(root), "rw")
-        fd["TARGETS"].write_key("COMMENT", "RA,DEC updated with PM for AEN objects")
-        fd["TARGETS"].write_key("COMMENT", "REF_EPOCH updated for all objects")
-        fd.close()
-        log.info("{:.1f}s\t{}-gfa.fits written".format(time() - start, root))
 
-    # AR std (if flavor=scidark,scibright)
+    # AR std (if fdict["addstd"], i.e. flavor=scidark,scibright)
     if dostd:
-        if args.flavor in ["scidark", "scibright"]:
-            tiles = fits.open("{}-tiles.fits".format(root))[1].data
-            d = read_targets_in_tiles(mydirs["targ"], tiles=tiles, header=False)
-            if fdict["obscon"] == "DARK|GRAY|BRIGHT":
-                std_msks = ["SV0_WD", "STD_FAINT", "STD_BRIGHT"]
-            elif fdict["obscon"] == "DARK|GRAY":
-                std_msks = ["SV0_WD", "STD_FAINT"]
-            elif fdict["obscon"] == "BRIGHT":
-                std_msks = ["SV0_WD", "STD_BRIGHT"]
-            else:
-                log.error(
-                    '{:.1f}s\tfdict["obscon"] not in DARK|GRAY|BRIGHT,DARK|GRAY,BRIGHT; exiting'.format(
-                        time() - start
-                    )
-                )
-                sys.exit()
+        if fdict["addstd"]:
+            run_stage(
+                "std",
+                make_std,
+                (mydirs, tdict, fdict),
+                root + "-std.fits",
+            )
 
-            keep = np.zeros(len(d), dtype=bool)
-            for msk in std_msks:
-                keep |= (d["CMX_TARGET"] & cmx_mask[msk]) > 0
-                log.info(
-                    "{:.1f}s\tkeeping {:.0f} {} stds".format(
-                        time() - start,
-                        ((d["CMX_TARGET"] & cmx_mask[msk]) > 0).sum(),
-                        msk,
-                    )
-                )
-            # AR removing overlap with science targets
-            isscience = np.zeros(len(d), dtype=bool)
-            for msk in fdict["msks"].split(","):
-                isscience |= (d["CMX_TARGET"] & cmx_mask[msk]) > 0
-            keep[isscience] = False
-            d = d[keep]
-            log.info(
-                "{:.1f}s\tkeeping {:.0f}/{:.0f} stds after having cut on {} and removed {}".format(
-                    time() - start, keep.sum(), len(keep), std_msks, fdict["msks"]
+    # AR incremental re-assignment: keeping the previous targets file
+    if dotarg & (args.incremental == "y") & (not fdict["dither"]):
+        if os.path.isfile(root + "-targ.fits") & (not is_done("targ")):
+            os.rename(root + "-targ.fits", root + "-targ-prev.fits")
+            if os.path.isfile(get_arrow_fn(root + "-targ.fits")):
+                os.rename(
+                    get_arrow_fn(root + "-targ.fits"),
+                    get_arrow_fn(root + "-targ-prev.fits"),
                 )
-            )
-            # AR custom mtl
-            _ = cmx_make_mtl(d, "{}-std.fits".format(root))
 
     # AR (undithered) targets
-    # AR ! not using make_mtl !
     if dotarg:
-        tiles = fits.open("{}-tiles.fits".format(root))[1].data
-        d, hdr = read_targets_in_tiles(mydirs["targ"], tiles=tiles, header=True)
-        keep = np.zeros(len(d), dtype=bool)
-        for msk in fdict["msks"].split(","):
-            keep |= (d["CMX_TARGET"] & cmx_mask[msk]) > 0
-            log.info(
-                "{:.1f}s\tkeeping {:.0f} {} targets".format(
-                    time() - start, ((d["CMX_TARGET"] & cmx_mask[msk]) > 0).sum(), msk
-                )
-            )
-        d = d[keep]
-        log.info(
-            "{:.1f}s\tkeeping {:.0f}/{:.0f} targets after having cut on {}".format(
-                time() - start, keep.sum(), len(keep), fdict["msks"]
-            )
+        run_stage(
+            "targ",
+            make_targ,
+            (mydirs, tdict, fdict),
+            root + "-targ.fits",
         )
-        # AR DITHER : tweaking PRIORITY and NUMOBS_MORE + updating the header
-        if args.flavor in ["dithprec", "dithlost"]:
-            d["PRIORITY_INIT"] = 1210 - np.clip(
-                d["GAIA_PHOT_RP_MEAN_MAG"] * 10, 100, 210
-            ).astype("i4")
-            d["NUMOBS_INIT"] = 1
-            log.info(
-                "{:.1f}s\tPRIORITY_INIT and NUMOBS_INIT tweaked for dithering".format(
-                    time() - start
-                )
-            )
-        # AR custom mtl
-        _ = cmx_make_mtl(d, "{}-targ.fits".format(root))
-        # AR DITHER: update header
-        if args.flavor in ["dithprec", "dithlost"]:
-            fd = fitsio.FITS("{}-targ.fits".format(root), "rw")
-            fd["MTL"].write_key(
-                "COMMENT",
-                "tweak : PRIORITY_INIT = 1210-np.clip(GAIA_PHOT_RP_MEAN_MAG*10,100,210)",
-            )
-            fd["MTL"].write_key("COMMENT", "tweak : NUMOBS_INIT = 1")
-            fd.close()
+
+    # AR releasing the concurrent reads
+    if args.nthread > 1:
+        catreads.clear()
+        dirpool.shutdown()
+        filepool.shutdown()
 
     # AR fiberassign
     if dofa:
 
+        # AR incremental re-assignment (non-dither flavors, i.e. only tileids[0])
+        # AR incrkeeps: rows of the targets file passed to fiberassign
+        # AR incrskips: nothing changed, the previous outputs are kept
+        # AR incrinputs: the other inputs, recorded in {root}-incr.json once assigned
+        incrkeeps, incrskips, incrinputs = {}, [], None
+        if (args.incremental == "y") & (not fdict["dither"]):
+            prevfafn = "{}fiberassign-{:06d}.fits".format(args.outdir, tileids[0])
+            if not os.path.isfile(prevfafn):
+                prevfafn += ".gz"
+            incrfns = {
+                key: "{}-{}.fits".format(root, key) for key in ["tiles", "sky", "gfa"]
+            }
+            if fdict["addstd"]:
+                incrfns["std"] = root + "-std.fits"
+            incrinputs = get_incr_inputs(incrfns, fdict)
+            plan, keep = get_incr_plan(
+                tileids[0],
+                root + "-targ-prev.fits",
+                root + "-targ.fits",
+                prevfafn,
+                incrinputs,
+                root + "-incr.json",
+            )
+            if plan == "skip":
+                incrskips.append(tileids[0])
+            if plan == "incr":
+                incrkeeps[tileids[0]] = keep
+
         # AR safe: delete possibly existing fba-{tileid}.fits and fiberassign-{tileid_}.fits
-        for tileid in tileids:
+        # AR (except for the tiles completed in the resumed run)
+        for tileid in fatileids:
+            if (tileid in incrskips) | is_done("fa-{:06d}".format(tileid)):
+                continue
             fba_file = os.path.join(args.outdir, "fba-{:06d}.fits".format(tileid))
             fiberassign_file = os.path.join(
                 args.outdir, "fiberassign-{:06d}.fits".format(tileid)
@@ -597,63 +2300,131 @@ def main():
             if os.path.isfile(fiberassign_file):
                 os.remove(fiberassign_file)
 
-        for tileid in tileids:
+        # AR reachability prefilter: std, sky cut once, the targets cut per tile
+        stdfn, skyfn = root + "-std.fits", root + "-sky.fits"
+        if args.prefilter == "y":
+            if fdict["addstd"]:
+                stdfn = prefilter_reach(
+                    stdfn, root + "-std-reach.fits", ["POS"], args.tilera, args.tiledec
+                )
+            skyfn = prefilter_reach(
+                skyfn, root + "-sky-reach.fits", ["POS", "ETC"], args.tilera, args.tiledec
+            )
+
+        # AR progress: reporting at each tile start, and after the last tile
+        fastart = time()
+        for i, tileid in enumerate(tileids):
+            log_progress("fa_progress", **get_eta(i, len(tileids), fastart))
+            tilestart = time()
             # AR first case:  undithered -> after  running fiberassign, we get the ras, decs, and the indexes to be dithered
             # AR other cases: dithered-??-> before running fiberassign, we compute/apply the dithering offsets
             troot = "{}{:06d}".format(args.outdir, tileid)
             #
-            if (args.flavor in ["dithprec", "dithlost"]) & (tileid != tileids[0]):
-                #
-                raoffs, decoffs = ras.copy(), decs.copy()
-                # AR Gaussian offset computation
-                if len(ginds) > 0:
-                    raoffs[ginds] += (
-                        np.random.randn(len(ginds))
-                        * fdict["gwidth"]
-                        / 3600.0
-                        / np.cos(np.radians(decs[ginds]))
-                    )
-                    decoffs[ginds] += (
-                        np.random.randn(len(ginds)) * fdict["gwidth"] / 3600.0
-                    )
-                # AR dithlost-in-space offset within a box
-                if len(linds) > 0:
-                    raoffs[linds] += (
-                        (1 - 2 * np.random.rand(len(linds)))
-                        * fdict["bwidth"]
-                        / 2.0
-                        / 3600.0
-                        / np.cos(np.radians(decs[linds]))
+            mtlfns = [troot + "-targ.fits"]
+            if fdict["addstd"]:
+                mtlfns += [root + "-std.fits"]
+            # AR resumed run: skipping the completed tiles (compact dithers: all or none)
+            # AR    the undithered tile assignment is still needed for the dithered tiles
+            fastep = "fa-{:06d}".format(tileid)
+            if tileid not in fatileids:
+                fastep = "fa-compact"
+            if is_done(fastep):
+                log.info(
+                    "{:.1f}s\ttileid={:06d}: completed in the resumed run, skipping".format(
+                        time() - start, tileid
                     )
-                    decoffs[linds] += (
-                        (1 - 2 * np.random.rand(len(linds)))
-                        * fdict["bwidth"]
-                        / 2.0
-                        / 3600.0
+                )
+                # AR (gzipped, if the zip step was completed)
+                fafn = "{}fiberassign-{:06d}.fits".format(args.outdir, tileid)
+                if not os.path.isfile(fafn):
+                    fafn += ".gz"
+                if (ledger is not None) & (tileid in fatileids) & (
+                    not (fdict["dither"] & (tileid != tileids[0]))
+                ):
+                    ledger_update(fafn, mtlfns)
+                # AR dithered tiles still to run: per-tile steps, or the single compact one
+                dithsteps = ["fa-{:06d}".format(t) for t in tileids[1:]]
+                if args.dithformat == "compact":
+                    dithsteps = ["fa-compact"]
+                if (
+                    fdict["dither"]
+                    & (tileid == tileids[0])
+                    & (not np.all([is_done(step) for step in dithsteps]))
+                ):
+                    (
+                        ras,
+                        decs,
+                        targetids,
+                        ginds,
+                        linds,
+                        dithclass,
+                        dithinds,
+                    ) = get_dither_targets(fafn, root + "-targ.fits", fdict, tileid)
+                    dras, ddecs, fassigns = [], [], []
+                continue
+            if tileid in incrskips:
+                log.info(
+                    "{:.1f}s\ttileid={:06d}: inputs unchanged, keeping the previous outputs".format(
+                        time() - start, tileid
                     )
-                # AR updating ra,dec + cutting on dithered targets + updating header + writing
-                h = fits.open(root + "-targ.fits")
-                h[1].data["RA"] = raoffs
-                h[1].data["DEC"] = decoffs
-                # AR cutting on dithered targets
-                h[1].data = h[1].data[np.sort(ginds + linds)]
-                # AR adding infos in the header
-                for kwargs in args._get_kwargs():
-                    h[1].header[kwargs[0]] = kwargs[1]
+                )
+                if ledger is not None:
+                    ledger_update(prevfafn, mtlfns)
+                append_summary(
+                    "{}fba-summary.fits".format(args.outdir),
+                    get_summary(tileid, prevfafn, mtlfns, fdict, 0.0),
+                )
+                write_incr_inputs(root + "-incr.json", incrinputs)
+                set_done(fastep)
+                continue
+            # AR incremental re-assignment: reduced targets file
+            targfn = troot + "-targ.fits"
+            if tileid in incrkeeps:
+                targfn = troot + "-targ-incr.fits"
+                write_product_rows(troot + "-targ.fits", targfn, incrkeeps[tileid])
+            # AR compact dithers: one temporary targets file, tileids[0] footprint, separate folder
+            tilesfn, fadir = troot + "-tiles.fits", args.outdir
+            iscompact = fdict["dither"] & (tileid not in fatileids)
+            if iscompact:
+                targfn = root + "-targ-dither.fits"
+                tilesfn, fadir = root + "-tiles.fits", root + "-dither-tmp/"
+                if not os.path.isdir(fadir):
+                    os.mkdir(fadir)
+            if fdict["dither"] & (tileid != tileids[0]):
+                #
+                raoffs, decoffs = get_dither_radecs(
+                    ras, decs, targetids, ginds, linds, fdict, tileid
+                )
+                if iscompact:
+                    dras.append((raoffs - ras)[dithinds] * 3600.0)
+                    ddecs.append((decoffs - decs)[dithinds] * 3600.0)
+                # AR cutting on dithered targets + updating ra,dec + updating header + writing
+                keys = dict(args._get_kwargs())
                 for key in fdict.keys():
-                    h[1].header[key] = str(fdict[key])
-                h.writeto(troot + "-targ.fits", overwrite=True)
+                    keys[key] = str(fdict[key])
+                write_product_rows(
+                    root + "-targ.fits",
+                    targfn,
+                    dithinds,
+                    cols={"RA": raoffs[dithinds], "DEC": decoffs[dithinds]},
+                    keys=keys,
+                )
+            # AR reachability prefilter
+            if args.prefilter == "y":
+                targfn = prefilter_reach(
+                    targfn, troot + "-targ-reach.fits", ["POS"], args.tilera, args.tiledec
+                )
             # AR running fiberassign
-            if args.flavor in ["scidark", "scibright"]:
+            if fdict["addstd"]:
                 opts = [
                     "--targets",
-                    troot + "-targ.fits",
-                    root + "-std.fits"
+                    targfn,
+                    stdfn,
                 ]
             else:
                 opts = [
                     "--targets",
-                    troot + "-targ.fits",
+                    targfn,
                 ]
             opts += [
                 "--rundate",
@@ -661,11 +2432,11 @@ def main():
                 "--overwrite",
                 "--write_all_targets",
                 "--footprint",
-                troot + "-tiles.fits",
+                tilesfn,
                 "--dir",
-                args.outdir,
+                fadir,
                 "--sky",
-                root + "-sky.fits",
+                skyfn,
                 "--sky_per_petal",
                 fdict["nskypet"],
                 "--standards_per_petal",
@@ -680,6 +2451,16 @@ def main():
             )
             ag = parse_assign(opts)
             run_assign_full(ag)
+            # AR compact dithers: only keeping the FIBER -> TARGETID assignment
+            if iscompact:
+                fassigns.append(
+                    fitsio.read(
+                        "{}fba-{:06d}.fits".format(fadir, tileids[0]),
+                        ext="FASSIGN",
+                        columns=["FIBER", "TARGETID"],
+                    )
+                )
+                continue
             # AR merging
             opts = [
                 "--skip_raw",
@@ -690,7 +2471,7 @@ def main():
                 "--targets",
                 root + "-gfa.fits",
             ]
-            if args.flavor in ["scidark", "scibright"]:
+            if fdict["addstd"]:
                 opts += [
                     troot + "-targ.fits",
                     root + "-std.fits",
@@ -708,7 +2489,7 @@ def main():
             ag = parse_merge(opts)
             run_merge(ag)
             # AR dither flavors: temporary moving fba-{tileid}.fits file, otherwise it confuses run_merge()
-            if args.flavor in ["dithprec", "dithlost"]:
+            if fdict["dither"]:
                 fn = "{}fba-{:06d}.fits".format(args.outdir, tileid)
                 os.rename(fn, fn.replace(".fits", "-tmp.fits"))
                 log.info(
@@ -717,31 +2498,24 @@ def main():
                     )
                 )
             # AR propagating some settings into the PRIMARY header
-            fd = fitsio.FITS(
-                "{}fiberassign-{:06d}.fits".format(args.outdir, tileid), "rw"
-            )
-            for key in np.sort(list(mydirs.keys())):
-                fd["PRIMARY"].write_key(key, mydirs[key])
-            for kwargs in args._get_kwargs():
-                if kwargs[0].lower() in [
-                    "outdir",
-                    "intileid",
-                    "flavor",
-                    "rundate",
-                    "seed",
-                ]:
-                    if kwargs[1] is not None:
-                        fd["PRIMARY"].write_key(kwargs[0], kwargs[1])
-            # AR adding a ISDITH keyword
-            if (args.flavor in ["dithprec", "dithlost"]) & (tileid != tileids[0]):
-                fd["PRIMARY"].write_key("ISDITH", 1)
-            else:
-                fd["PRIMARY"].write_key("ISDITH", 0)
-            fd["PRIMARY"].write_key("obscon", fdict["obscon"])
-            fd.close()
+            # AR dithered tiles: done when copying the file for the extra-hdu
+            isdith = fdict["dither"] & (tileid != tileids[0])
+            prov = fba_provenance(mydirs, fdict, isdith)
+            if not isdith:
+                fd = fitsio.FITS(
+                    "{}fiberassign-{:06d}.fits".format(args.outdir, tileid), "rw"
+                )
+                fd["PRIMARY"].write_keys(prov)
+                fd.close()
+                # AR batch: updating the ledger for the next tiles
+                if ledger is not None:
+                    ledger_update(
+                        "{}fiberassign-{:06d}.fits".format(args.outdir, tileid),
+                        mtlfns,
+                    )
             # AR adding an extra-hdu for the dithering
             # AR ~copied from https://github.com/desihub/fiberassign/blob/52cb99424d8a1d4e5366e6a200636ab02cb71bb9/py/fiberassign/assign.py#L1141-L1208
-            if (args.flavor in ["dithprec", "dithlost"]) & (tileid != tileids[0]):
+            if isdith:
                 dithfn = "{}fiberassign-{:06d}.fits".format(args.outdir, tileid)
                 undithfn = "{}{:06d}-targ.fits".format(args.outdir, tileids[0])
                 tmpfn = dithfn.replace(".fits", "-tmp.fits")
@@ -767,23 +2541,24 @@ def main():
                             troot,
                             ",".join(extnames),
                         )
-                        sys.exit()
+                        sys.exit(1)
                     if extname == "PRIMARY":
-                        fd.write(
-                            None, header=fdin[extname].read_header(), extname=extname
-                        )
+                        hdr0 = fdin[extname].read_header()
+                        for key in prov.keys():
+                            hdr0[key] = prov[key]
+                        fd.write(None, header=hdr0, extname=extname)
                     else:
                         fd.write(
                             fdin[extname].read(),
                             header=fdin[extname].read_header(),
                             extname=extname,
                         )
-                # AR extra-hdu with UNDITHERED_RA, UNDITHERED_DEC
+                # AR extra-hdu with UNDITHERED_RA, UNDITHERED_DEC, DITHER_CLASS
                 # AR reading *-fiberassign.fits, and updating TARGET_RA,TARGET_DEC
                 # AR with the undithered positions for TARGETID matched with root+'-targ.fits'
                 d = fits.open(dithfn)[1].data
-                dundith = fits.open(undithfn)[1].data
-                ii, iiundith = unq_searchsorted(d["TARGETID"], dundith["targetid"])
+                dundith = read_product(undithfn, ["TARGETID", "RA", "DEC"])
+                ii, iiundith = unq_searchsorted(d["TARGETID"], dundith["TARGETID"])
                 d["TARGET_RA"][ii] = dundith["RA"][iiundith]
                 d["TARGET_DEC"][ii] = dundith["DEC"][iiundith]
                 dextra = Table()
@@ -792,7 +2567,8 @@ def main():
                 dextra["TARGETID"] = d["TARGETID"]
                 dextra["UNDITHER_RA"] = d["TARGET_RA"]
                 dextra["UNDITHER_DEC"] = d["TARGET_DEC"]
-                hdr0 = fdin[0].read_header()
+                dextra["DITHER_CLASS"][:] = dither_classes["none"]
+                dextra["DITHER_CLASS"][ii] = dithclass[iiundith]
                 hdr = {}
                 for key in hdr0.keys():
                     if key not in [
@@ -816,49 +2592,78 @@ def main():
                         time() - start, dithfn
                     )
                 )
+            # AR summary index
+            append_summary(
+                "{}fba-summary.fits".format(args.outdir),
+                get_summary(
+                    tileid,
+                    "{}fiberassign-{:06d}.fits".format(args.outdir, tileid),
+                    mtlfns,
+                    fdict,
+                    time() - tilestart,
+                ),
+            )
             # AR identifiying assigned targets (=STD_DITHER) on the undithered tile
-            if (args.flavor in ["dithprec", "dithlost"]) & (tileid == tileids[0]):
-                d = fits.open("{}fiberassign-{:06d}.fits".format(args.outdir, tileid))[
-                    1
-                ].data
-                # AR removing sky fibres
-                tids = d["TARGETID"][d["OBJTYPE"] == "TGT"]
-                log.info(
-                    "{:.1f}s\t{}: {:.0f} {} assigned".format(
-                        time() - start, troot, len(tids), fdict["msks"]
-                    )
+            if fdict["dither"] & (tileid == tileids[0]):
+                (
+                    ras,
+                    decs,
+                    targetids,
+                    ginds,
+                    linds,
+                    dithclass,
+                    dithinds,
+                ) = get_dither_targets(
+                    "{}fiberassign-{:06d}.fits".format(args.outdir, tileid),
+                    root + "-targ.fits",
+                    fdict,
+                    tileid,
                 )
-                # AR
-                h = fits.open(root + "-targ.fits")
-                ras, decs = h[1].data["RA"], h[1].data["DEC"]
-                # AR targets to be offset
-                inds = np.where(np.in1d(h[1].data["TARGETID"], tids))[
-                    0
-                ]  # AR indexes of assigned targets
-                if fdict["gfrac"] > 0:  # AR targets to be offset by a Gaussian
-                    ginds = np.random.choice(
-                        inds, size=int(fdict["gfrac"] * len(inds)), replace=False
-                    ).tolist()
-                else:
-                    ginds = []
-                # AR targets to be offset within a box (dithlost-in-space)
-                tmpinds = inds[
-                    ~np.in1d(inds, ginds)
-                ]  # AR targets not offset by a Gaussian
-                if fdict["bfrac"] > 0:
-                    if fdict["gfrac"] + fdict["bfrac"] == 1:
-                        tmpn = len(inds) - len(ginds)
-                    else:
-                        tmpn = int(fdict["bfrac"] * len(inds))
-                    linds = np.random.choice(
-                        tmpinds, size=tmpn, replace=False
-                    ).tolist()  # AR targets to be offset within a box
-                else:
-                    linds = []
+                dras, ddecs, fassigns = [], [], []
+            if incrinputs is not None:
+                write_incr_inputs(root + "-incr.json", incrinputs)
+            set_done(fastep)
+        log_progress("fa_progress", **get_eta(len(tileids), len(tileids), fastart))
+        # AR incremental re-assignment, reachability prefilter: cleaning
+        for fn in [
+            root + "-targ-prev.fits",
+            get_arrow_fn(root + "-targ-prev.fits"),
+            root + "-targ-incr.fits",
+        ] + [
+            "{}{:06d}-{}-reach.fits".format(args.outdir, tileid, ext)
+            for tileid in tileids
+            for ext in ["targ", "std", "sky"]
+        ]:
+            if os.path.isfile(fn):
+                os.remove(fn)
+        # AR compact dithers: writing {root}-dither.fits + cleaning
+        if (
+            fdict["dither"]
+            & (args.dithformat == "compact")
+            & (not is_done("fa-compact"))
+        ):
+            prov = fba_provenance(mydirs, fdict, True)
+            prov["DITHFMT"] = "compact"
+            d = read_product(root + "-targ.fits", ["TARGETID", "RA", "DEC"])
+            write_dither_compact(
+                root + "-dither.fits",
+                {key: d[key][dithinds] for key in d},
+                dithclass[dithinds],
+                tileids[1:],
+                dras,
+                ddecs,
+                fassigns,
+                prov,
+            )
+            os.remove(root + "-targ-dither.fits")
+            shutil.rmtree(root + "-dither-tmp/")
+            set_done("fa-compact")
         # AR dither flavors: re-naming fba-{tileid}.fits files
-        if args.flavor in ["dithprec", "dithlost"]:
-            for tileid in tileids:
+        if fdict["dither"]:
+            for tileid in fatileids:
                 fn = "{}fba-{:06d}.fits".format(args.outdir, tileid)
+                if not os.path.isfile(fn.replace(".fits", "-tmp.fits")):
+                    continue
                 os.rename(fn.replace(".fits", "-tmp.fits"), fn)
                 log.info(
                     "{:.1f}s\trenaming {} to {}".format(
@@ -866,34 +2671,33 @@ def main():
                     )
                 )
 
-    if dozip:  # gzip all fiberassign files
+    if dozip & (not is_done("zip")):  # gzip all fiberassign files
         files_to_zip = glob(os.path.join(args.outdir, "fiberassign-*.fits"))
         for file_to_zip in files_to_zip:
             print(file_to_zip, files_to_zip)
             log.info("gzipping file {}".format(file_to_zip))
             os.system("gzip -f {}".format(file_to_zip))
+        set_done("zip")
 
     if doplot:
 
-        cm = mycmap("jet_r", 10, 0, 1)
-
         # AR tile ra,dec
-        tiles = fits.open(root + "-tiles.fits")[1].data
-        tra, tdec = tiles["RA"][0], tiles["DEC"][0]
-        tsky = SkyCoord(ra=tra * units.deg, dec=tdec * units.deg, frame="icrs")
+        tsky = tdict["tsky"]
 
         # AR control plots
         # AR parent
         if os.path.isfile(root + "-targ.fits"):
-            dp = fits.open(root + "-targ.fits")[1].data
+            dp = read_product(root + "-targ.fits")
         else:
-            dp = fits.open(root + "-std.fits")[1].data
+            dp = read_product(root + "-std.fits")
 
         skyp = SkyCoord(
             ra=dp["RA"] * units.deg, dec=dp["DEC"] * units.deg, frame="icrs"
         )
         #
-        for tileid in tileids:
+        for tileid in fatileids:
+            if is_done("plot-{:06d}".format(tileid)):
+                continue
             try:
                 d = fits.open("{}fiberassign-{:06d}.fits".format(args.outdir, tileid))[
                     1
@@ -902,360 +2706,390 @@ def main():
                 d = fits.open(
                     "{}fiberassign-{:06d}.fits.gz".format(args.outdir, tileid)
                 )[1].data
-            mydict = {}
-            for key in ["SKY", "BAD", "TGT"]:
-                mydict["N" + key] = (d["OBJTYPE"] == key).sum()
-            keys = [
-                "TARGETID",
-                "PETAL_LOC",
-                "CMX_TARGET",
-                "FLUX_G",
-                "FLUX_R",
-                "FLUX_Z",
-                "TARGET_RA",
-                "TARGET_DEC",
-                "GAIA_PHOT_RP_MEAN_MAG",
-                "PRIORITY",
-            ]
-            # AR arrays following the parent ordering
-            d = d[d["OBJTYPE"] == "TGT"]
-            iip, ii = unq_searchsorted(dp["TARGETID"], d["TARGETID"])
-            for key in keys:
-                if key == "CMX_TARGET":
-                    mydict[key] = np.zeros(len(dp), dtype=int)
-                else:
-                    mydict[key] = np.nan + np.zeros(len(dp))
-                mydict[key][iip] = d[key][ii]
-
-            # JEFR counts of assigned targets per class
-            available_counts = Counter(mydict["CMX_TARGET"])
-            assigned_counts = Counter(d["CMX_TARGET"])
-            assigned_names = {}
-            std_masks = []
-            std_total = 0
-            for k in assigned_counts.keys():
-                mask_names = " ".join(cmx_mask.names(k))
-                if "STD" in mask_names:
-                    std_masks.append(mask_names)
-                    std_total += assigned_counts[k]
-                if (
-                    assigned_counts[k] > 20
-                ):  # only take this class into account if it has more than 20 instances
-                    assigned_names[mask_names] = assigned_counts[k]
-
-            sky = SkyCoord(
-                ra=mydict["TARGET_RA"] * units.deg,
-                dec=mydict["TARGET_DEC"] * units.deg,
-                frame="icrs",
-            )
-            #
-            fig = plt.figure(figsize=(25, 15))
-            title = "flavor={}    TILEID={:06d} at RA,DEC={:.1f},{:.1f}   obscon={}\n".format(
-                args.flavor, tileid, tra, tdec, fdict["obscon"]
-            )
-            title += "SKY={:.0f} , BAD={:.0f} , TGT={:.0f} , STD={:.0f} (".format(
-                mydict["NSKY"], mydict["NBAD"], mydict["NTGT"], std_total
-            )
-            title += " , ".join(
-                [
-                    "{}={:.0f}".format(
-                        msk, ((mydict["CMX_TARGET"] & cmx_mask[msk]) > 0).sum()
-                    )
-                    for msk in fdict["msks"].split(",")
-                ]
-            )
-            title += ")"
-            fig.text(
-                0.5, 0.9, title, ha="center", fontsize=15, transform=fig.transFigure
-            )
-            gs = gridspec.GridSpec(4, 4, wspace=0.3, hspace=0.2)
-
-            # AR grz-mags
-            for ip, key in enumerate(["FLUX_G", "FLUX_R", "FLUX_Z"]):
-                ax = plt.subplot(gs[0, ip])
-                # AR handling outside desi cases
-                if tile_in_desi == 1:
-                    keep = dp[key] > 0
-                    xp = 22.5 - 2.5 * np.log10(dp[key][keep])
-                    bitp = dp["CMX_TARGET"][keep]
-                    keep = mydict[key] > 0
-                    x = 22.5 - 2.5 * np.log10(mydict[key][keep])
-                    bit = mydict["CMX_TARGET"][keep]
-                    bins = np.linspace(xp.min(), xp.max(), 51)
-                    plot_hist(ax, x, xp, bins, "22.5 - 2.5 * log10({})".format(key))
-                    _, ymax = ax.get_ylim()
-                    ax.set_ylim(0.8, 100 * ymax)
-                    ax.set_yscale("log")
-                else:
-                    ax.set_xlabel("22.5 - 2.5*log1(" + key + ")")
-
-            # AR grz-diagram
-            ax = plt.subplot(gs[0, 3])
-            grp = -2.5 * np.log10(dp["FLUX_G"] / dp["FLUX_R"])
-            rzp = -2.5 * np.log10(dp["FLUX_R"] / dp["FLUX_Z"])
-            gr = -2.5 * np.log10(mydict["FLUX_G"] / mydict["FLUX_R"])
-            rz = -2.5 * np.log10(mydict["FLUX_R"] / mydict["FLUX_Z"])
-            ax.scatter(rzp, grp, c="k", s=2, alpha=0.1, rasterized=True, label="parent")
-            ax.scatter(rz, gr, c="r", s=2, alpha=1.0, rasterized=True, label="assigned")
-            ax.set_xlabel("-2.5 * log10(FLUX_R / FLUX_Z)")
-            ax.set_ylabel("-2.5 * log10(FLUX_G / FLUX_R)")
-            ax.set_xlim(-0.5, 2.5)
-            ax.set_ylim(-0.5, 2.5)
-            ax.grid(True)
-            ax.legend(loc=4)
-
-            # AR position in tile
-            ax = plt.subplot(gs[1, 0])  # AR will be over-written
-            xlim, ylim, gridsize = (2, -2), (-2, 2), 50
-            plot_area = (xlim[0] - xlim[1]) * (
-                ylim[1] - ylim[0]
-            )  # AR area of the plotting window in deg2
-            # AR parent
-            spho = tsky.spherical_offsets_to(skyp)  # AR in degrees
-            drap = spho[0].value
-            ddecp = spho[1].value
-            hbp = ax.hexbin(
-                drap,
-                ddecp,
-                C=None,
-                gridsize=gridsize,
-                extent=(xlim[1], xlim[0], ylim[0], ylim[1]),
-                mincnt=0,
-                visible=False,
-            )
-            # AR assigned
-            spho = tsky.spherical_offsets_to(sky)  # AR in degrees
-            dra = spho[0].value
-            ddec = spho[1].value
-            hb = ax.hexbin(
-                dra,
-                ddec,
-                C=None,
-                gridsize=gridsize,
-                extent=(xlim[1], xlim[0], ylim[0], ylim[1]),
-                mincnt=0,
-                visible=False,
-            )
-            #
-            tmpx = hb.get_offsets()[:, 0]
-            tmpy = hb.get_offsets()[:, 1]
-            keep = hbp.get_array() > 0
-            carea = plot_area / len(hbp.get_array())  # AR plt.hexbin "cell" area
-            area = carea * keep.sum()  # AR ~desi fov area in deg2
-            #
-            for ip, c, clab in zip(
-                [0, 1, 2],
-                [
-                    hbp.get_array() / carea,
-                    hb.get_array() / len(tileids) / carea,
-                    (hb.get_array() / hbp.get_array()) / len(tileids),
-                ],
-                [
-                    r"parent density [deg$^{-2}$]",
-                    r"assigned density [deg$^{-2}$]",
-                    "parent fraction assigned",
-                ],
-            ):
-                cmin = c[keep].mean() - 3 * c[keep].std()
-                cmin = np.max([0, cmin])
-                cmax = c[keep].mean() + 3 * c[keep].std()
-                if ip == 2:
-                    cmax = np.min([1, cmax])
-                    txt = r"mean = {:.2f}".format(c[keep].mean())
-                else:
-                    txt = (
-                        r"mean = {:.0f}".format(c[keep].sum() * carea / area)
-                        + " deg$^{-2}$"
-                    )
-                ax = plt.subplot(gs[1, ip])
-                SC = ax.scatter(
-                    tmpx[keep],
-                    tmpy[keep],
-                    c=c[keep],
-                    s=15,
-                    vmin=cmin,
-                    vmax=cmax,
-                    alpha=0.5,
-                    cmap=cm,
-                )
-                ax.set_xlabel(r"$\Delta$RA = Angular distance to TILE_RA [deg.]")
-                ax.set_ylabel(r"$\Delta$DEC = Angular distance to TILE_DEC [deg.]")
-                ax.set_xlim(xlim)
-                ax.set_ylim(ylim)
-                ax.grid(True)
-                ax.text(
-                    0.02,
-                    0.93,
-                    txt,
-                    color="k",
-                    fontweight="bold",
-                    fontsize=15,
-                    transform=ax.transAxes,
-                )
-                cbar = plt.colorbar(SC)
-                cbar.set_label(clab)
-                cbar.mappable.set_clim(cmin, cmax)
-
-            # AR dithering positions
-            if args.flavor in ["dithprec", "dithlost"]:
-                xmax = 5 * fdict["gwidth"]
-                if fdict["bfrac"] > 0:
-                    xmax = np.max([xmax, 1.5 * fdict["bwidth"] / 2.0])
-                # AR positions
-                spho = skyp.spherical_offsets_to(sky)  # AR in degrees
-                dra = spho[0].value.flatten() * 3600.0  # AR in arcsec
-                ddec = spho[1].value.flatten() * 3600.0  # AR in arcsec
-                keep = (np.isfinite(dra)) & (np.isfinite(ddec))
-                dra, ddec = dra[keep], ddec[keep]
-                ax = plt.subplot(gs[2, 0])
-                ax.scatter(dra, ddec, c="k", s=5, alpha=0.2)
-                axx = ax.twinx()
-                axx.hist(
-                    dra,
-                    bins=100,
-                    histtype="stepfilled",
-                    alpha=0.3,
-                    color="k",
-                    density=True,
-                )
-                axx.set_ylim(0, 5)
-                axx.axis("off")
-                axy = ax.twiny()
-                axy.hist(
-                    ddec,
-                    bins=100,
-                    histtype="stepfilled",
-                    alpha=0.3,
-                    color="k",
-                    density=True,
-                    orientation="horizontal",
-                )
-                axy.set_xlim(0, 5)
-                axy.axis("off")
-                ax.set_xlabel("$\Delta$RA = Angular offset in R.A. [arcsec]")
-                ax.set_ylabel("$\Delta$DEC = Angular offset in Dec. [arcsec]")
-                ax.set_xlim(-xmax, xmax)
-                ax.set_ylim(-xmax, xmax)
-                ax.grid(True)
-                txt = r"$\Delta$RA ={:.3f}$\pm${:.3f} arcsec".format(
-                    dra.mean(), dra.std()
-                )
-                ax.text(
-                    0.02,
-                    0.93,
-                    txt,
-                    color="k",
-                    fontweight="bold",
-                    fontsize=10,
-                    transform=ax.transAxes,
-                )
-                txt = r"$\Delta$DEC={:.3f}$\pm${:.3f} arcsec".format(
-                    ddec.mean(), ddec.std()
-                )
-                ax.text(
-                    0.02,
-                    0.89,
-                    txt,
-                    color="k",
-                    fontweight="bold",
-                    fontsize=10,
-                    transform=ax.transAxes,
-                )
-                # AR gaussian / box
-                if fdict["gfrac"] > 0:
-                    tmpx = np.linspace(-xmax, xmax, 1000)
-                    tmpy = gaussian(tmpx, 1.0, 0.0, fdict["gwidth"])
-                    axx.plot(
-                        tmpx,
-                        tmpy,
-                        color="k",
-                        label="Gaussian(0," + "%.2f" % fdict["gwidth"] + ")",
-                    )
-                    axy.plot(tmpy, tmpx, color="k")
-                    axx.legend(loc=1)
-                if fdict["bfrac"] > 0:
-                    ax.axhline(
-                        +fdict["bwidth"] / 2.0,
-                        ls="--",
-                        color="k",
-                        label="box of " + "%.2f" % fdict["bwidth"] + " width",
-                    )
-                    ax.axhline(-fdict["bwidth"] / 2.0, ls="--", color="k")
-                    ax.axvline(+fdict["bwidth"] / 2.0, ls="--", color="k")
-                    ax.axvline(-fdict["bwidth"] / 2.0, ls="--", color="k")
-                    ax.legend(loc=4)
-
-            # AR rmag
-            ax = plt.subplot(gs[2, 1])
-            xp = dp["GAIA_PHOT_RP_MEAN_MAG"]
-            x = mydict["GAIA_PHOT_RP_MEAN_MAG"]
-            x = x[np.isfinite(x)]
-            bins = np.linspace(xp.min(), xp.max(), 51)
-            plot_hist(ax, x, xp, bins, "GAIA_PHOT_RP_MEAN_MAG")
-
-            # AR priority
-            ax = plt.subplot(gs[2, 2])
-            xp = dp["PRIORITY"]
-            x = mydict["PRIORITY"]
-            bins = np.linspace(xp.min(), xp.max(), xp.max() - xp.min() + 1)
-            plot_hist(ax, x, xp, bins, "PRIORITY")
-
-            # JEFR count assigned targets per class
-            ax = plt.subplot(gs[3, 2])
-            names = np.array(list(assigned_names.keys()))
-            values = np.array(list(assigned_names.values()))
-            ii = np.argsort(values)
-            plt.barh(names[ii], values[ii], align="center", alpha=0.5)
-            for i, v in enumerate(values[ii]):
-                plt.text(v + 3, i - 0.25, str(v))
-
-            #  AR saving plot
-            plt.savefig(
-                "{}fiberassign-{:06d}.png".format(args.outdir, tileid),
-                bbox_inches="tight",
-            )
-            plt.close()
+            plot_tile(tileid, d, dp, skyp, tsky, fdict, tile_in_desi, len(tileids))
+            set_done("plot-{:06d}".format(tileid))
 
     # AR do clean?
     if args.doclean == "y":
         for tileid in tileids:
             for ext in ["tiles", "sky", "gfa", "std", "targ"]:
                 fn = "{}{:06d}-{}.fits".format(args.outdir, tileid, ext)
-                if os.path.isfile(fn):
-                    log.info("{:.1f}s\tremoving {}".format(time() - start, fn))
-                    os.remove(fn)
+                for fn in [fn, get_arrow_fn(fn)]:
+                    if os.path.isfile(fn):
+                        log.info("{:.1f}s\tremoving {}".format(time() - start, fn))
+                        os.remove(fn)
+
+
+# AR progress events, one json per line appended to args.progressfn (if not None)
+def log_progress(event, **kwargs):
+    # event  : event name (e.g., stage_start, stage_end, fa_progress)
+    # kwargs : additional event fields
+    if args.progressfn is None:
+        return
+    ev = {
+        "time": datetime.utcnow().isoformat(timespec="seconds"),
+        "elapsed": round(time() - start, 1),
+        "tileid": args.tileid,
+        "event": event,
+    }
+    ev.update(kwargs)
+    with open(args.progressfn, "a") as f:
+        f.write(json.dumps(ev) + "\n")
+
+
+# AR progress of a loop of ntot items started at t0: rate [items/s] and projected completion
+def get_eta(ndone, ntot, t0):
+    # ndone : number of items done
+    # ntot  : total number of items
+    # t0    : start time of the loop
+    eta = {"ndone": ndone, "nremaining": ntot - ndone}
+    if ndone > 0:
+        dt = time() - t0
+        eta["rate"] = round(ndone / dt, 4)
+        eta["eta"] = round(dt / ndone * (ntot - ndone), 1)
+        eta["eta_utc"] = (datetime.utcnow() + timedelta(seconds=eta["eta"])).isoformat(
+            timespec="seconds"
+        )
+    return eta
 
 
-if __name__ == "__main__":
+# AR run manifest: reading the previous one (resume=True), or starting a new one
+def init_manifest(fn, resume):
+    # fn     : manifest file ({root}-manifest.json)
+    # resume : continue from the completed steps of fn? (bool)
+    manifest["fn"], manifest["steps"] = fn, []
+    if resume & os.path.isfile(fn):
+        with open(fn) as f:
+            manifest["steps"] = json.load(f)["steps"]
+        log.info(
+            "{:.1f}s\tresuming from {}: {:.0f} completed steps ({})".format(
+                time() - start, fn, len(manifest["steps"]), ",".join(manifest["steps"])
+            )
+        )
+    else:
+        write_manifest()
+
+
+# AR writing the manifest, atomically (write then rename)
+def write_manifest():
+    tmpfn = "{}-{}.tmp".format(manifest["fn"], os.getpid())
+    with open(tmpfn, "w") as f:
+        json.dump(
+            {
+                "steps": manifest["steps"],
+                "time": datetime.utcnow().isoformat(timespec="seconds"),
+            },
+            f,
+        )
+    os.rename(tmpfn, manifest["fn"])
 
-    """
-    flavor : see DJS email Oct,15 2020:
-        1) "we're lost" dither sequences
-        2) dither sequences of bright stars (including w/ no offsets)
-        3) standard star + sky tiles (these stars are fainter than the dither stars)
-        4) few tiles with a mix of all science targets (for pipeline re-commissioning)
-        5) focus dither sequences -- M. Lampton, E. Schlafly figuring this out
-    """
 
-    """
-    TBD : 
-        - validate the code for tiles outside desi footprint, for dithering => DONE
-        - add epoch as input (see Eddie email to desi-survey from Oct., 30, 2020)
-        - "starfaint" flavor: pick other targets than STD_FAINT,SV0_WD, which are not enough
-        - "scidark" flavor, dark: verify the elg-selection
-    """
+# AR has step been completed (in this run, or in the resumed one)?
+def is_done(step):
+    # step : step name
+    return step in manifest["steps"]
 
-    # AR to speed up development/debugging
-    dotile = True
-    dosky = True
-    dostd = True
-    dogfa = True
-    dotarg = True
-    dofa = True
-    dozip = True
-    doplot = True
 
-    # AR reading arguments
+# AR recording a completed step
+def set_done(step):
+    # step : step name
+    if (manifest["fn"] is None) | is_done(step):
+        return
+    manifest["steps"].append(step)
+    write_manifest()
+
+
+# AR running a stage, with its progress events
+# AR the number of processed rows is read from the stage output file
+# AR skipped if completed in the resumed run and outfn still exists
+def run_stage(stage, func, fargs, outfn):
+    # stage : stage name
+    # func  : stage function
+    # fargs : tuple of the func arguments
+    # outfn : file written by func
+    if is_done(stage) & os.path.isfile(outfn):
+        log.info(
+            "{:.1f}s\t{}: completed in the resumed run, skipping".format(
+                time() - start, stage
+            )
+        )
+        log_progress("stage_skip", stage=stage)
+        return
+    t0 = time()
+    log_progress("stage_start", stage=stage)
+    func(*fargs)
+    nrows = 0
+    if os.path.isfile(outfn):
+        nrows = fitsio.read_header(outfn, 1)["NAXIS2"]
+    dt = time() - t0
+    log_progress(
+        "stage_end",
+        stage=stage,
+        nrows=nrows,
+        duration=round(dt, 1),
+        rate=round(nrows / max(dt, 1e-3), 1),
+    )
+    set_done(stage)
+
+
+# AR work queue (worker mode), shared folder with:
+# AR    todo/{name}.args   : one tile per file, fba_sv1.py arguments (as a --batch line)
+# AR    claims/{name}.lock : claimed by a worker (host:pid), touched every --heartbeat seconds
+# AR    done/{name}.json   : result and timings, written by the worker
+# AR    done/{name}.failed-{i}.json : failed attempts, re-run (with --resume y) up to --retries times
+# AR a claim whose heartbeat is older than --stale seconds is from a dead worker:
+# AR    the tile is re-claimed and re-run with --resume y
+# AR a tile still failing after --retries retries has done/{name}.json with status=failed;
+# AR    it is re-queued by hand by removing done/{name}.json and done/{name}.failed-*.json
+def get_queue_dirs(queuedir):
+    # queuedir : work queue folder
+    qdirs = {key: os.path.join(queuedir, key) for key in ["todo", "claims", "done"]}
+    for qdir in qdirs.values():
+        os.makedirs(qdir, exist_ok=True)
+    return qdirs
+
+
+# AR adding the tiles of a --batch file or of a command.sh file to the queue
+def enqueue_tiles(queuedir, fn):
+    # queuedir : work queue folder
+    # fn       : file with one tile per line (--batch format, or "python fba_sv1.py ..." lines)
+    qdirs = get_queue_dirs(queuedir)
+    n0 = len(os.listdir(qdirs["todo"]))
+    for line in open(fn).readlines():
+        line = line.split("#")[0]
+        if "fba_sv1.py" in line:
+            line = line.split("fba_sv1.py")[1]
+        tileargs = line.split()
+        if len(tileargs) == 0:
+            continue
+        name = "{:06d}".format(n0)
+        if "--tileid" in tileargs:
+            name += "-{:06d}".format(int(tileargs[tileargs.index("--tileid") + 1]))
+        tmpfn = os.path.join(qdirs["todo"], "{}.tmp".format(name))
+        with open(tmpfn, "w") as f:
+            f.write(" ".join(tileargs) + "\n")
+        os.rename(tmpfn, os.path.join(qdirs["todo"], "{}.args".format(name)))
+        n0 += 1
+    log.info("{:.1f}s\t{:.0f} tiles in {}".format(time() - start, n0, qdirs["todo"]))
+
+
+# AR claiming a tile: exclusive creation of its lock file
+# AR a stale lock (dead worker) is first moved away, by a single worker (atomic rename)
+# AR    if the moved file is not the stale one (another worker re-claimed it in-between), it is restored
+# AR returns True if claimed, and whether it was a stale claim
+def claim_tile(lockfn, workerid, stale):
+    # lockfn   : lock file of the tile
+    # workerid : worker identifier (host:pid)
+    # stale    : heartbeat age [s] above which a claim is considered dead
+    isstale = False
+    if os.path.isfile(lockfn):
+        try:
+            mtime = os.path.getmtime(lockfn)
+            owner = open(lockfn).read()
+        except FileNotFoundError:
+            return False, False
+        if time() - mtime < stale:
+            return False, False
+        stalefn = "{}.{}.stale".format(lockfn, workerid.replace(":", "-"))
+        try:
+            os.rename(lockfn, stalefn)
+        except FileNotFoundError:
+            return False, False
+        if (os.path.getmtime(stalefn) != mtime) | (open(stalefn).read() != owner):
+            try:
+                os.link(stalefn, lockfn)
+            except FileExistsError:
+                pass
+            os.remove(stalefn)
+            return False, False
+        os.remove(stalefn)
+        isstale = True
+    try:
+        fd = os.open(lockfn, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False, False
+    os.write(fd, (workerid + "\n").encode())
+    os.close(fd)
+    return True, isstale
+
+
+# AR touching the lock file every heartbeat seconds, until stop is set
+def heartbeat(lockfn, period, stop):
+    # lockfn : lock file of the tile
+    # period : heartbeat period [s]
+    # stop   : threading.Event
+    while not stop.wait(period):
+        if os.path.isfile(lockfn):
+            os.utime(lockfn)
+
+
+# AR worker: claiming and running the queued tiles (one fba_sv1.py process per tile),
+# AR until no tile is left to claim
+# AR runargs are the arguments common to all tiles (e.g., --outdir, --dtver, --rundate)
+# AR returns the number of tiles which failed (after their retries) in this worker
+def run_worker(wargs, runargs):
+    # wargs   : worker arguments (see get_worker_parser())
+    # runargs : fba_sv1.py arguments common to all tiles
+    if wargs.enqueue is not None:
+        enqueue_tiles(wargs.queuedir, wargs.enqueue)
+    qdirs = get_queue_dirs(wargs.queuedir)
+    workerid = "{}:{}".format(os.uname().nodename, os.getpid())
+    ndone, nfailed = 0, 0
+    while True:
+        names = [
+            fn.replace(".args", "")
+            for fn in sorted(os.listdir(qdirs["todo"]))
+            if fn.endswith(".args")
+        ]
+        names = [
+            name
+            for name in names
+            if not os.path.isfile(os.path.join(qdirs["done"], name + ".json"))
+        ]
+        claimed = False
+        for name in names:
+            lockfn = os.path.join(qdirs["claims"], name + ".lock")
+            claimed, isstale = claim_tile(lockfn, workerid, wargs.stale)
+            # AR completed by another worker since the listing
+            if claimed & os.path.isfile(os.path.join(qdirs["done"], name + ".json")):
+                os.remove(lockfn)
+                claimed = False
+            if claimed:
+                break
+        if not claimed:
+            # AR tiles left, but claimed by live workers
+            if (len(names) > 0) & (wargs.wait == "y"):
+                sleep(wargs.heartbeat)
+                continue
+            break
+        tileargs = open(os.path.join(qdirs["todo"], name + ".args")).read().split()
+        nattempt = len(glob(os.path.join(qdirs["done"], name + ".failed-*.json")))
+        if isstale:
+            tileargs += ["--resume", "y"]
+            log.info(
+                "{:.1f}s\t{}: re-claimed from a dead worker, resuming".format(
+                    time() - start, name
+                )
+            )
+        elif nattempt > 0:
+            tileargs += ["--resume", "y"]
+            log.info(
+                "{:.1f}s\t{}: retry {}/{}, resuming".format(
+                    time() - start, name, nattempt, wargs.retries
+                )
+            )
+        stop = threading.Event()
+        beat = threading.Thread(
+            target=heartbeat, args=(lockfn, wargs.heartbeat, stop), daemon=True
+        )
+        beat.start()
+        tilestart = datetime.utcnow()
+        log.info(
+            "{:.1f}s\t{}: running with {}".format(
+                time() - start, name, " ".join(runargs + tileargs)
+            )
+        )
+        t0 = time()
+        proc = subprocess.run(
+            [sys.executable, os.path.abspath(__file__)] + runargs + tileargs
+        )
+        stop.set()
+        beat.join()
+        res = {
+            "name": name,
+            "worker": workerid,
+            "args": " ".join(tileargs),
+            "status": "done" if proc.returncode == 0 else "failed",
+            "returncode": proc.returncode,
+            "resumed": isstale | (nattempt > 0),
+            "attempt": nattempt,
+            "start": tilestart.isoformat(timespec="seconds"),
+            "end": datetime.utcnow().isoformat(timespec="seconds"),
+            "duration": round(time() - t0, 1),
+        }
+        # AR failed with retries left: recorded as an attempt, the tile stays to claim
+        resfn = os.path.join(qdirs["done"], name + ".json")
+        if (res["status"] == "failed") & (nattempt < wargs.retries):
+            res["status"] = "retry"
+            resfn = os.path.join(
+                qdirs["done"], "{}.failed-{}.json".format(name, nattempt)
+            )
+        with open(resfn + ".tmp", "w") as f:
+            json.dump(res, f)
+        os.rename(resfn + ".tmp", resfn)
+        os.remove(lockfn)
+        ndone += 1
+        if res["status"] == "failed":
+            nfailed += 1
+        log.info(
+            "{:.1f}s\t{}: {} in {:.1f}s".format(
+                time() - start, name, res["status"], res["duration"]
+            )
+        )
+    log.info(
+        "{:.1f}s\tworker {}: {:.0f} tiles run ({:.0f} failed), no tile left to claim in {}".format(
+            time() - start, workerid, ndone, nfailed, qdirs["todo"]
+        )
+    )
+    return nfailed
+
+
+# AR worker arguments: fba_sv1.py worker --queuedir QUEUEDIR [...] [fba_sv1.py common arguments]
+def get_worker_parser():
+    parser = ArgumentParser(prog="fba_sv1.py worker", allow_abbrev=False)
+    parser.add_argument(
+        "--queuedir",
+        help="shared work queue folder, with todo/, claims/, done/ sub-folders",
+        type=str,
+        default=None,
+        required=True,
+        metavar="QUEUEDIR",
+    )
+    parser.add_argument(
+        "--enqueue",
+        help="file with tiles to add to the queue before starting (--batch format, or command.sh lines) (default=None)",
+        type=str,
+        default=None,
+        required=False,
+        metavar="ENQUEUE",
+    )
+    parser.add_argument(
+        "--heartbeat",
+        help="period in seconds of the claim heartbeat (default=60)",
+        type=float,
+        default=60.0,
+        required=False,
+        metavar="HEARTBEAT",
+    )
+    parser.add_argument(
+        "--stale",
+        help="age in seconds of the last heartbeat above which a claim is from a dead worker, and is re-queued (default=600)",
+        type=float,
+        default=600.0,
+        required=False,
+        metavar="STALE",
+    )
+    parser.add_argument(
+        "--retries",
+        help="number of times a failed tile is re-run (with --resume y) before being recorded as failed (default=2)",
+        type=int,
+        default=2,
+        required=False,
+        metavar="RETRIES",
+    )
+    parser.add_argument(
+        "--wait",
+        help="keep polling while tiles are claimed by other workers, to re-claim them if those die (y/n)",
+        type=str,
+        default="n",
+        required=False,
+        metavar="WAIT",
+    )
+    return parser
+
+
+# AR arguments
+def get_parser():
     parser = ArgumentParser()
     parser.add_argument(
         "--outdir",
@@ -1267,10 +3101,10 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "--tileid",
-        help="output tileid (e.g., 63142); if flavor=dithprec,dithlost, will also write outputs tileid for the 12,5 next tileids",
+        help="output tileid (e.g., 63142); if flavor=dithprec,dithlost, will also write outputs tileid for the 12,5 next tileids; required, either on the command-line or in each --batch line",
         type=int,
         default=None,
-        required=True,
+        required=False,
         metavar="TILEID",
     )
     parser.add_argument(
@@ -1299,7 +3133,7 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "--flavor",
-        help="dithprec,dithlost,starfaint,scidark,scibright,focus",
+        help=",".join(flavors.keys()),
         type=str,
         default=None,
         required=True,
@@ -1331,12 +3165,141 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "--seed",
-        help="numpy random seed for dithering (default=1234)",
+        help="random seed for dithering, combined with the tileid and TARGETID (default=1234)",
         type=int,
         default=1234,
         required=False,
         metavar="SEED",
     )
+    parser.add_argument(
+        "--epoch",
+        help="epoch for the GFA targets positions, jyear (e.g., 2020.95) or isot (e.g., 2020-12-14T00:00:00); propagated positions are cached per HEALPix pixel (default=None, i.e. Time.now(), not cached)",
+        type=str,
+        default=None,
+        required=False,
+        metavar="EPOCH",
+    )
+    parser.add_argument(
+        "--gfacachedir",
+        help="cache folder for the GFA positions propagated to --epoch (default=OUTDIR/gfa-cache/)",
+        type=str,
+        default=None,
+        required=False,
+        metavar="GFACACHEDIR",
+    )
+    parser.add_argument(
+        "--tilecachedir",
+        help="folder for the cached TILEID index and desi footprint map of $DESIMODEL/data/footprint/desi-tiles.fits (default=OUTDIR/tile-cache)",
+        type=str,
+        default=None,
+        required=False,
+        metavar="TILECACHEDIR",
+    )
+    parser.add_argument(
+        "--datacfg",
+        help="config file with the search roots, '<key> <path>' lines, with key=targets,svntiles,localcache (default=None, i.e. $FBA_SV1_DATACFG, then $FBA_SV1_{TARGETS,SVNTILES,LOCALCACHE}, then KPNO and NERSC defaults)",
+        type=str,
+        default=None,
+        required=False,
+        metavar="DATACFG",
+    )
+    parser.add_argument(
+        "--localcache",
+        help="fast local folder (e.g., node-local NVMe or burst-buffer) where the read HEALPix catalogue files are staged and read from (default=None)",
+        type=str,
+        default=None,
+        required=False,
+        metavar="LOCALCACHE",
+    )
+    parser.add_argument(
+        "--progressfn",
+        help="json-lines file where the progress events (stages start/end, tiles done/remaining, eta) are appended (default=OUTDIR/TILEID-progress.jsonl, with the first TILEID for --batch)",
+        type=str,
+        default=None,
+        required=False,
+        metavar="PROGRESSFN",
+    )
+    parser.add_argument(
+        "--nthread",
+        help="number of processes for the catalogue reads; if >1, the targ, sky, skysupp, gfa folders and their HEALPix files are read concurrently (default=1)",
+        type=int,
+        default=1,
+        required=False,
+        metavar="NTHREAD",
+    )
+    parser.add_argument(
+        "--ndither",
+        help="number of dithered tiles, for flavor=dithprec,dithlost (default=None, i.e. 12,1)",
+        type=int,
+        default=None,
+        required=False,
+        metavar="NDITHER",
+    )
+    parser.add_argument(
+        "--dithformat",
+        help="dither outputs: 'tiles' (targ,tiles,fiberassign files per dithered tileid) or 'compact' (one {tileid}-dither.fits file with the offsets and the FIBER->TARGETID assignments) (default=tiles)",
+        type=str,
+        default="tiles",
+        required=False,
+        metavar="DITHFORMAT",
+    )
+    parser.add_argument(
+        "--batch",
+        help="file with one line of arguments per tile (e.g., --tileid 85000 --tilera 36.448 --tiledec -4.601 --flavor scidark), run in that order with the command-line arguments; the NUMOBS_MORE,PRIORITY of the targets assigned on a tile are updated for the next tiles (default=None)",
+        type=str,
+        default=None,
+        required=False,
+        metavar="BATCH",
+    )
+    parser.add_argument(
+        "--incremental",
+        help="re-use the previous run outputs in OUTDIR (requires --doclean n): fiberassign only run on the previously reachable and the new/changed targets, not re-run if the targets are unchanged; not for dither flavors (y/n)",
+        type=str,
+        default="n",
+        required=False,
+        metavar="INCREMENTAL",
+    )
+    parser.add_argument(
+        "--intermediate-format",
+        help="format of the stage products (std, targ) read within fba_sv1.py: 'fits', or 'arrow' (native-endian, memory-mapped {tileid}-{ext}.arrow copies, requires pyarrow); the fits files are always written, for fiberassign (default=fits)",
+        type=str,
+        default="fits",
+        choices=["fits", "arrow"],
+        required=False,
+        metavar="INTERMEDIATE_FORMAT",
+    )
+    parser.add_argument(
+        "--gfafilter",
+        help="keep only the GFA targets on the GFA chips (with a margin), before the proper-motion propagation (y/n)",
+        type=str,
+        default="n",
+        required=False,
+        metavar="GFAFILTER",
+    )
+    parser.add_argument(
+        "--skythin",
+        help="sky thinning: keeping per petal SKYTHIN x the per-petal sky requirement of reachable sky targets, the best ones of each positioner (and ETC fibre) in turn (e.g., 3); 0 keeps all the sky targets (default=0)",
+        type=float,
+        default=0.0,
+        required=False,
+        metavar="SKYTHIN",
+    )
+    parser.add_argument(
+        "--prefilter",
+        help="pass to fiberassign only the targ, std, sky rows reachable by a positioner (sky: or an ETC fibre) of the focalplane at RUNDATE, reporting the reduction (y/n)",
+        type=str,
+        default="n",
+        required=False,
+        metavar="PREFILTER",
+    )
+    parser.add_argument(
+        "--resume",
+        help="continue a failed run from its first incomplete step (stages, tiles, plots), as recorded in OUTDIR/TILEID-manifest.json; otherwise a new manifest is started (y/n)",
+        type=str,
+        default="n",
+        required=False,
+        metavar="RESUME",
+    )
     parser.add_argument(
         "--doclean",
         help="delete tileid-{tiles,sky,std,gfa,targ}.fits files (y/n)",
@@ -1345,24 +3308,103 @@ if __name__ == "__main__":
         required=False,
         metavar="DOCLEAN",
     )
-    #
-    args = parser.parse_args()
-    log = Logger.get()
-    start = time()
+    return parser
+
+
+if __name__ == "__main__":
+
+    """
+    flavor : see DJS email Oct,15 2020:
+        1) "we're lost" dither sequences
+        2) dither sequences of bright stars (including w/ no offsets)
+        3) standard star + sky tiles (these stars are fainter than the dither stars)
+        4) few tiles with a mix of all science targets (for pipeline re-commissioning)
+        5) focus dither sequences -- M. Lampton, E. Schlafly figuring this out
+    """
+
+    """
+    TBD : 
+        - validate the code for tiles outside desi footprint, for dithering => DONE
+        - add epoch as input (see Eddie email to desi-survey from Oct., 30, 2020) => DONE
+        - "starfaint" flavor: pick other targets than STD_FAINT,SV0_WD, which are not enough
+        - "scidark" flavor, dark: verify the elg-selection
+    """
 
-    # AR safe: outdir
-    if args.outdir[-1] != "/":
-        args.outdir += "/"
-    if os.path.isdir(args.outdir) == False:
-        os.mkdir(args.outdir)
+    # AR to speed up development/debugging
+    dotile = True
+    dosky = True
+    dostd = True
+    dogfa = True
+    dotarg = True
+    dofa = True
+    dozip = True
+    doplot = True
 
-    # AR: generic output filename
-    root = "{}{:06d}".format(args.outdir, args.tileid)
+    # AR worker mode: draining a shared work queue (see run_worker())
+    if (len(sys.argv) > 1) and (sys.argv[1] == "worker"):
+        log = Logger.get()
+        start = time()
+        wargs, runargs = get_worker_parser().parse_known_args(sys.argv[2:])
+        # AR exit code 1 if some tiles failed
+        if run_worker(wargs, runargs) > 0:
+            sys.exit(1)
+        sys.exit()
 
-    # AR: log filename
-    logfn = "{}.log".format(root)
-    if os.path.isfile(logfn):
-        os.remove(logfn)
+    # AR reading arguments
+    args = get_parser().parse_args()
+    log = Logger.get()
 
-    with stdouterr_redirected(to=logfn):
-        main()
+    # AR batch: one run per line of args.batch (appended to the command-line arguments)
+    # AR sharing the ledger, i.e. the targets assigned on a tile are updated for the next ones
+    batchargs = [[]]
+    if args.batch is not None:
+        batchargs = [
+            line.split("#")[0].split()
+            for line in open(args.batch).readlines()
+            if len(line.split("#")[0].split()) > 0
+        ]
+        ledger = {
+            key: np.zeros(0, dtype=mtldatamodel[key].dtype)
+            for key in ["TARGETID", "NUMOBS_MORE", "PRIORITY"]
+        }
+
+    progressfn, batchstart = None, time()
+    for ibatch, tileargs in enumerate(batchargs):
+        args = get_parser().parse_args(sys.argv[1:] + tileargs)
+        start = time()
+
+        # AR safe: tileid
+        if args.tileid is None:
+            log.error("no --tileid provided (command-line or --batch); exiting")
+            sys.exit(1)
+
+        # AR safe: outdir
+        if args.outdir[-1] != "/":
+            args.outdir += "/"
+        if os.path.isdir(args.outdir) == False:
+            os.mkdir(args.outdir)
+        if args.gfacachedir is None:
+            args.gfacachedir = os.path.join(args.outdir, "gfa-cache")
+        if args.tilecachedir is None:
+            args.tilecachedir = os.path.join(args.outdir, "tile-cache")
+
+        # AR: generic output filename
+        root = "{}{:06d}".format(args.outdir, args.tileid)
+
+        # AR: progress filename (one for the whole batch)
+        if args.progressfn is None:
+            if progressfn is None:
+                progressfn = "{}-progress.jsonl".format(root)
+                if os.path.isfile(progressfn):
+                    os.remove(progressfn)
+            args.progressfn = progressfn
+
+        # AR: log filename
+        logfn = "{}.log".format(root)
+        if os.path.isfile(logfn):
+            os.remove(logfn)
+
+        log_progress("run_start", **get_eta(ibatch, len(batchargs), batchstart))
+        with stdouterr_redirected(to=logfn):
+            main()
+        log_progress("run_end", **get_eta(ibatch + 1, len(batchargs), batchstart))
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# AR prefetch/warm-cache daemon for the fba_sv1.py designs
+# AR given tiles (fba_sv1.py arguments, e.g. the command.sh lines), resolves the HEALPix
+# AR    files of the targ, sky, skysupp, gfa catalogues overlapping each tile, and
+# AR    copies them in a node-local cache, with the fba_sv1.py --localcache layout
+# AR the cache is capped in size: the least recently used files are evicted first
+# AR fba_sv1.py then reads the warm cache with: --localcache CACHEDIR
+# AR local socket API: one json request per connection, one json answer:
+# AR    {"cmd": "prefetch", "args": "--tilera 36.448 --tiledec -4.601 --flavor scidark ..."}
+# AR    {"cmd": "commands", "fn": "command.sh"}
+# AR    {"cmd": "status"}
+# AR    {"cmd": "stop"}
+# AR e.g.: python prefetch_fba_sv1.py --cachedir /tmp/fba-cache --maxsize 100 --commands command.sh
+# AR       python prefetch_fba_sv1.py --cachedir /tmp/fba-cache --send '{"cmd": "status"}'
+
+import os
+import json
+import socket
+import threading
+import queue
+import numpy as np
+from time import time
+from argparse import ArgumentParser
+from fiberassign.utils import Logger
+import fba_sv1
+
+
+# AR fba_sv1.py arguments of the tiles listed in a command file (e.g. command.sh)
+def read_commands(fn):
+    # fn : file with "python fba_sv1.py ..." lines
+    return [
+        line.split("fba_sv1.py")[1].split()
+        for line in open(fn).readlines()
+        if "fba_sv1.py" in line.split("#")[0]
+    ]
+
+
+# AR catalogue directories and tile context for a tile, as in fba_sv1.main()
+def get_tile_dirs(tileargs, cachedir, datacfg):
+    # tileargs : list of fba_sv1.py arguments
+    # cachedir : cache folder
+    # datacfg  : config file with the search roots (can be None)
+    args = fba_sv1.get_parser().parse_args(["--outdir", cachedir] + tileargs)
+    tcat = fba_sv1.get_tilecat(os.path.join(cachedir, "tile-cache"))
+    if (args.tilera is None) | (args.tiledec is None):
+        ras, decs, _ = fba_sv1.get_tile_radecs(tcat, [args.intileid])
+        args.tilera, args.tiledec = ras[0], decs[0]
+    fba_sv1.args = args
+    tile_in_desi = fba_sv1.is_in_desi(tcat, args.tilera, args.tiledec)[0].astype(int)
+    fdict = fba_sv1.get_fdict(args.flavor, tile_in_desi, args.seed)
+    roots = fba_sv1.get_data_roots(datacfg)
+    mydirs = None
+    for path in roots["targets"]:
+        tmpdirs = fba_sv1.get_mydirs(path, fdict)
+        if np.all([os.path.isdir(d) for d in tmpdirs.values()]):
+            mydirs = tmpdirs
+            break
+    return mydirs, fba_sv1.get_tdict([0], fdict)
+
+
+# AR evicting the least recently used cached files, until the cache is below maxsize
+def evict(cachedir, maxsize):
+    # cachedir : cache folder
+    # maxsize  : maximum size [bytes]
+    fns = [
+        os.path.join(dirpath, fn)
+        for dirpath, _, fns in os.walk(cachedir)
+        for fn in fns
+        if fn.endswith(".fits")
+    ]
+    mtimes = np.array([os.path.getmtime(fn) for fn in fns])
+    sizes = np.array([os.path.getsize(fn) for fn in fns], dtype=int)
+    size = sizes.sum()
+    for i in np.argsort(mtimes):
+        if size <= maxsize:
+            break
+        os.remove(fns[i])
+        size -= sizes[i]
+        log.info("evicting {}".format(fns[i]))
+    return len(fns), int(size)
+
+
+# AR prefetching worker: staging the files of the queued tiles
+def prefetch(cachedir, maxsize, datacfg):
+    # cachedir : cache folder
+    # maxsize  : maximum size [bytes]
+    # datacfg  : config file with the search roots (can be None)
+    while True:
+        tileargs = tilequeue.get()
+        if tileargs is None:
+            break
+        try:
+            mydirs, tdict = get_tile_dirs(tileargs, cachedir, datacfg)
+            if mydirs is None:
+                log.error("no catalogues found for {}".format(" ".join(tileargs)))
+            else:
+                for key in ["targ", "sky", "skysupp", "gfa"]:
+                    fba_sv1.stage_hpdir(mydirs[key], tdict, cachedir)
+            status["nfile"], status["size"] = evict(cachedir, maxsize)
+        except Exception as e:
+            log.error("{}: {}".format(" ".join(tileargs), e))
+        status["ndone"] += 1
+        tilequeue.task_done()
+
+
+# AR answering one socket request
+def answer(req, cachedir):
+    # req      : dictionary of the json request
+    # cachedir : cache folder
+    if req["cmd"] == "prefetch":
+        tilequeue.put(req["args"].split())
+    elif req["cmd"] == "commands":
+        for tileargs in read_commands(req["fn"]):
+            tilequeue.put(tileargs)
+    elif req["cmd"] == "stop":
+        tilequeue.put(None)
+    elif req["cmd"] != "status":
+        return {"error": "unknown cmd={}".format(req["cmd"])}
+    return {
+        "cachedir": cachedir,
+        "nqueue": tilequeue.qsize(),
+        "ndone": status["ndone"],
+        "nfile": status["nfile"],
+        "size": status["size"],
+    }
+
+
+# AR sending one request to a running daemon
+def send(sockfn, req):
+    # sockfn : socket file
+    # req    : json request (string)
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(sockfn)
+    client.sendall((req + "\n").encode())
+    ans = client.makefile().readline()
+    client.close()
+    return ans
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--cachedir",
+        help="node-local cache folder (to be passed as fba_sv1.py --localcache)",
+        type=str,
+        default=None,
+        required=True,
+        metavar="CACHEDIR",
+    )
+    parser.add_argument(
+        "--maxsize",
+        help="maximum cache size in GB (default=100)",
+        type=float,
+        default=100.0,
+        required=False,
+        metavar="MAXSIZE",
+    )
+    parser.add_argument(
+        "--commands",
+        help="file with fba_sv1.py command lines (e.g. command.sh) to prefetch at start (default=None)",
+        type=str,
+        default=None,
+        required=False,
+        metavar="COMMANDS",
+    )
+    parser.add_argument(
+        "--datacfg",
+        help="config file with the search roots (see fba_sv1.py --datacfg) (default=None)",
+        type=str,
+        default=None,
+        required=False,
+        metavar="DATACFG",
+    )
+    parser.add_argument(
+        "--socket",
+        help="socket file (default=CACHEDIR/prefetch.sock)",
+        type=str,
+        default=None,
+        required=False,
+        metavar="SOCKET",
+    )
+    parser.add_argument(
+        "--send",
+        help="json request sent to the running daemon, whose answer is printed (default=None)",
+        type=str,
+        default=None,
+        required=False,
+        metavar="SEND",
+    )
+    pargs = parser.parse_args()
+    if pargs.socket is None:
+        pargs.socket = os.path.join(pargs.cachedir, "prefetch.sock")
+
+    # AR client
+    if pargs.send is not None:
+        print(send(pargs.socket, pargs.send).strip())
+        return
+
+    # AR daemon
+    if not os.path.isdir(pargs.cachedir):
+        os.makedirs(pargs.cachedir)
+    fba_sv1.log = log
+    fba_sv1.start = time()
+    maxsize = int(pargs.maxsize * 1e9)
+    status["nfile"], status["size"] = evict(pargs.cachedir, maxsize)
+    worker = threading.Thread(
+        target=prefetch, args=(pargs.cachedir, maxsize, pargs.datacfg), daemon=True
+    )
+    worker.start()
+    if pargs.commands is not None:
+        for tileargs in read_commands(pargs.commands):
+            tilequeue.put(tileargs)
+    if os.path.exists(pargs.socket):
+        os.remove(pargs.socket)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(pargs.socket)
+    server.listen()
+    log.info("listening on {}".format(pargs.socket))
+    while worker.is_alive():
+        conn, _ = server.accept()
+        try:
+            req = json.loads(conn.makefile().readline())
+            ans = answer(req, pargs.cachedir)
+        except Exception as e:
+            req, ans = {}, {"error": str(e)}
+        conn.sendall((json.dumps(ans) + "\n").encode())
+        conn.close()
+        if req.get("cmd") == "stop":
+            worker.join()
+    server.close()
+    os.remove(pargs.socket)
+
+
+log = Logger.get()
+# AR queued tiles (None stops the worker) and cache status, shared with the worker
+tilequeue = queue.Queue()
+status = {"ndone": 0, "nfile": 0, "size": 0}
+
+
+if __name__ == "__main__":
+    main()
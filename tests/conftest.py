@@ -0,0 +1,162 @@
+import os
+import sys
+import types
+import logging
+import numpy as np
+
+# AR the scripts are not a package: importing them from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# AR stand-ins for the DESI stack (desitarget, desimodel, fiberassign, desiutil)
+# AR only registered when the real package is not importable (e.g. in CI):
+# AR they provide the names imported by fba_sv1.py, so that the helpers not running
+# AR fiberassign can be unit-tested; the tests monkeypatch what else they need
+cmx_names = [
+    "STD_GAIA",
+    "SV0_STD_FAINT",
+    "SV0_STD_BRIGHT",
+    "STD_TEST",
+    "STD_CALSPEC",
+    "STD_DITHER",
+    "STD_DITHER_GAIA",
+    "STD_FAINT",
+    "STD_BRIGHT",
+    "SV0_WD",
+    "SV0_LRG",
+    "SV0_ELG",
+    "SV0_QSO",
+    "SV0_BGS",
+    "SV0_MWS_FAINT",
+    "SV0_MWS",
+    "MINI_SV_LRG",
+    "MINI_SV_ELG",
+    "MINI_SV_QSO",
+    "MINI_SV_BGS_BRIGHT",
+    "SKY",
+    "BACKUP_BRIGHT",
+]
+
+
+class CmxMask:
+    def __getitem__(self, name):
+        return 2 ** cmx_names.index(name)
+
+    def __getattr__(self, name):
+        if name not in cmx_names:
+            raise AttributeError(name)
+        return self[name]
+
+    def names(self, val=None):
+        if val is None:
+            return list(cmx_names)
+        return [name for i, name in enumerate(cmx_names) if int(val) & 2 ** i]
+
+    def bitnum(self, name):
+        return cmx_names.index(name)
+
+
+class ObsConditions:
+    def mask(self, obscon):
+        bits = {"DARK": 1, "GRAY": 2, "BRIGHT": 4}
+        return sum(bits[name] for name in obscon.split("|"))
+
+
+class Logger:
+    @staticmethod
+    def get():
+        return logging.getLogger("fba")
+
+
+def not_available(name):
+    def func(*args, **kwargs):
+        raise NotImplementedError("{} needs the DESI stack".format(name))
+
+    return func
+
+
+def add_standin(modname, **attrs):
+    mod = types.ModuleType(modname)
+    for key in attrs:
+        setattr(mod, key, attrs[key])
+    sys.modules[modname] = mod
+    if "." in modname:
+        parent, child = modname.rsplit(".", 1)
+        setattr(sys.modules[parent], child, mod)
+
+
+standins = {
+    "desitarget": [
+        ("desitarget", {}),
+        (
+            "desitarget.io",
+            {
+                name: not_available(name)
+                for name in [
+                    "read_targets_in_tiles",
+                    "read_targets_in_cap",
+                    "write_targets",
+                    "write_mtl",
+                    "check_hp_target_dir",
+                ]
+            },
+        ),
+        ("desitarget.cmx", {}),
+        ("desitarget.cmx.cmx_targetmask", {"cmx_mask": CmxMask()}),
+        ("desitarget.targetmask", {"obsconditions": ObsConditions()}),
+        (
+            "desitarget.targets",
+            {"set_obsconditions": lambda d: np.full(len(d), 7, dtype="i4")},
+        ),
+    ],
+    "desimodel": [
+        ("desimodel", {}),
+        (
+            "desimodel.footprint",
+            {
+                "is_point_in_desi": not_available("is_point_in_desi"),
+                "radec2pix": not_available("radec2pix"),
+                "tiles2pix": not_available("tiles2pix"),
+                "get_tile_radius_deg": lambda: 1.628,
+            },
+        ),
+        ("desimodel.focalplane", {"radec2xy": not_available("radec2xy")}),
+        ("desimodel.focalplane.gfa", {"on_gfa": not_available("on_gfa")}),
+        (
+            "desimodel.io",
+            {
+                "load_tiles": not_available("load_tiles"),
+                "load_focalplane": not_available("load_focalplane"),
+            },
+        ),
+    ],
+    "fiberassign": [
+        ("fiberassign", {"__version__": "standin"}),
+        ("fiberassign.scripts", {}),
+        (
+            "fiberassign.scripts.assign",
+            {
+                name: not_available(name)
+                for name in ["parse_assign", "run_assign_bytile", "run_assign_full"]
+            },
+        ),
+        (
+            "fiberassign.scripts.merge",
+            {name: not_available(name) for name in ["parse_merge", "run_merge"]},
+        ),
+        ("fiberassign.utils", {"Logger": Logger}),
+    ],
+    "desiutil": [
+        ("desiutil", {}),
+        (
+            "desiutil.redirect",
+            {"stdouterr_redirected": not_available("stdouterr_redirected")},
+        ),
+    ],
+}
+for pkg in standins:
+    try:
+        __import__(pkg)
+    except ImportError:
+        for modname, attrs in standins[pkg]:
+            add_standin(modname, **attrs)
@@ -0,0 +1,536 @@
+import os
+import json
+from argparse import Namespace
+import numpy as np
+import pytest
+import fitsio
+from astropy.table import Table
+import fba_sv1
+
+
+# AR fba_sv1 globals set in __main__
+@pytest.fixture
+def fbargs(monkeypatch):
+    args = Namespace(
+        intermediate_format="fits",
+        flavor="scidark",
+        rundate="2020-03-06T00:00:00",
+        epoch=None,
+        seed=1234,
+        progressfn=None,
+    )
+    monkeypatch.setattr(fba_sv1, "args", args, raising=False)
+    monkeypatch.setattr(fba_sv1, "log", fba_sv1.Logger.get(), raising=False)
+    monkeypatch.setattr(fba_sv1, "start", 0.0, raising=False)
+    return args
+
+
+# AR minimal MTL-like targets file
+def write_targ(fn, priorities, timestamp):
+    d = np.zeros(
+        len(priorities),
+        dtype=[("TARGETID", ">i8"), ("PRIORITY", ">i8"), ("TIMESTAMP", "S19")],
+    )
+    d["TARGETID"] = 100 + np.arange(len(d))
+    d["PRIORITY"] = priorities
+    d["TIMESTAMP"] = timestamp
+    fitsio.write(fn, d, extname="MTL", clobber=True)
+
+
+def write_fa(fn, targetids):
+    pot = np.zeros(len(targetids), dtype=[("TARGETID", ">i8")])
+    pot["TARGETID"] = targetids
+    fitsio.write(fn, pot, extname="POTENTIAL_ASSIGNMENTS", clobber=True)
+
+
+def test_get_incr_rows(tmp_path, fbargs):
+    prevtargfn, targfn, prevfafn = [
+        str(tmp_path / fn) for fn in ["prev-targ.fits", "targ.fits", "prev-fa.fits"]
+    ]
+    priorities = np.full(10, 3000)
+    write_targ(prevtargfn, priorities, "2020-12-01T00:00:00")
+    write_fa(prevfafn, [100, 101])
+    # AR new TIMESTAMP only: only the previously reachable targets are kept
+    write_targ(targfn, priorities, "2020-12-02T00:00:00")
+    keep, nnew, nchanged, nremoved = fba_sv1.get_incr_rows(
+        prevtargfn, targfn, prevfafn
+    )
+    assert (nnew, nchanged, nremoved) == (0, 0, 0)
+    assert np.flatnonzero(keep).tolist() == [0, 1]
+    # AR one PRIORITY change: exactly one changed row
+    priorities[5] = 2000
+    write_targ(targfn, priorities, "2020-12-02T00:00:00")
+    keep, nnew, nchanged, nremoved = fba_sv1.get_incr_rows(
+        prevtargfn, targfn, prevfafn
+    )
+    assert (nnew, nchanged, nremoved) == (0, 1, 0)
+    assert np.flatnonzero(keep).tolist() == [0, 1, 5]
+
+
+# AR minimal sky file
+def write_sky(fn, ras):
+    d = np.zeros(len(ras), dtype=[("TARGETID", ">i8"), ("RA", ">f8")])
+    d["TARGETID"] = 1000 + np.arange(len(d))
+    d["RA"] = ras
+    fitsio.write(fn, d, extname="SKY_TARGETS", clobber=True)
+
+
+def test_get_incr_plan(tmp_path, fbargs):
+    fdict = {"nskypet": "80", "nstdpet": "20"}
+    prevtargfn, targfn, prevfafn = [
+        str(tmp_path / fn) for fn in ["prev-targ.fits", "targ.fits", "prev-fa.fits"]
+    ]
+    skyfn, inputsfn = str(tmp_path / "sky.fits"), str(tmp_path / "incr.json")
+    priorities = np.full(10, 3000)
+    write_targ(prevtargfn, priorities, "2020-12-01T00:00:00")
+    write_targ(targfn, priorities, "2020-12-02T00:00:00")
+    write_fa(prevfafn, [100, 101])
+    write_sky(skyfn, np.linspace(10, 11, 5))
+    inputs = fba_sv1.get_incr_inputs({"sky": skyfn}, fdict)
+    # AR first run: no recorded inputs
+    assert fba_sv1.get_incr_plan(
+        0, prevtargfn, targfn, prevfafn, inputs, inputsfn
+    ) == ("full", None)
+    fba_sv1.write_incr_inputs(inputsfn, inputs)
+    assert json.load(open(inputsfn)) == inputs
+    plan, keep = fba_sv1.get_incr_plan(
+        0, prevtargfn, targfn, prevfafn, inputs, inputsfn
+    )
+    assert plan == "skip"
+    # AR only the sky file changes: the tile is re-assigned
+    write_sky(skyfn, np.linspace(10, 12, 5))
+    skyinputs = fba_sv1.get_incr_inputs({"sky": skyfn}, fdict)
+    assert fba_sv1.get_incr_plan(
+        0, prevtargfn, targfn, prevfafn, skyinputs, inputsfn
+    ) == ("full", None)
+    # AR only an option changes
+    fbargs.rundate = "2021-03-06T00:00:00"
+    write_sky(skyfn, np.linspace(10, 11, 5))
+    assert fba_sv1.get_incr_plan(
+        0,
+        prevtargfn,
+        targfn,
+        prevfafn,
+        fba_sv1.get_incr_inputs({"sky": skyfn}, fdict),
+        inputsfn,
+    ) == ("full", None)
+    # AR only a PRIORITY changes
+    priorities[5] = 2000
+    write_targ(targfn, priorities, "2020-12-02T00:00:00")
+    plan, keep = fba_sv1.get_incr_plan(
+        0, prevtargfn, targfn, prevfafn, inputs, inputsfn
+    )
+    assert plan == "incr"
+    assert np.flatnonzero(keep).tolist() == [0, 1, 5]
+
+
+def test_ledger(tmp_path, fbargs, monkeypatch):
+    ledger = {
+        key: np.zeros(0, dtype=fba_sv1.mtldatamodel[key].dtype)
+        for key in ["TARGETID", "NUMOBS_MORE", "PRIORITY"]
+    }
+    monkeypatch.setattr(fba_sv1, "ledger", ledger)
+    mtlfn, fafn = str(tmp_path / "targ.fits"), str(tmp_path / "fa.fits")
+    m = np.zeros(
+        4, dtype=[("TARGETID", ">i8"), ("NUMOBS_MORE", ">i8"), ("PRIORITY", ">i8")]
+    )
+    m["TARGETID"] = [100, 101, 102, 103]
+    m["NUMOBS_MORE"] = [1, 2, 2, 1]
+    m["PRIORITY"] = 3000
+    fitsio.write(mtlfn, m, extname="MTL", clobber=True)
+    # AR 101 is assigned as a STD, 103 is not assigned: only 100, 102 are observed
+    fa = np.zeros(4, dtype=[("TARGETID", ">i8"), ("OBJTYPE", "S3")])
+    fa["TARGETID"] = [100, 101, 102, 1000]
+    fa["OBJTYPE"] = ["TGT", "STD", "TGT", "SKY"]
+    fitsio.write(fafn, fa, extname="FIBERASSIGN", clobber=True)
+    fba_sv1.ledger_update(fafn, [mtlfn])
+    assert ledger["TARGETID"].tolist() == [100, 102]
+    assert ledger["NUMOBS_MORE"].tolist() == [0, 1]
+    assert ledger["PRIORITY"].tolist() == [fba_sv1.ledger_done_priority, 3000]
+    # AR second tile: the new values supersede the ledger ones
+    fba_sv1.ledger_update(fafn, [mtlfn])
+    assert ledger["TARGETID"].tolist() == [100, 102]
+    m["NUMOBS_MORE"] = [0, 2, 1, 1]
+    fitsio.write(mtlfn, m, extname="MTL", clobber=True)
+    fba_sv1.ledger_update(fafn, [mtlfn])
+    assert ledger["NUMOBS_MORE"].tolist() == [0, 0]
+    assert ledger["PRIORITY"].tolist() == [fba_sv1.ledger_done_priority] * 2
+    # AR merging back into a MTL by TARGETID (unsorted, with targets not in the ledger)
+    mtl = Table()
+    mtl["TARGETID"] = [103, 102, 999, 100]
+    mtl["NUMOBS_MORE"] = [1, 2, 3, 1]
+    mtl["PRIORITY"] = [3000, 3000, 3000, 3000]
+    mtl = fba_sv1.ledger_apply(mtl)
+    assert mtl["NUMOBS_MORE"].tolist() == [1, 0, 3, 0]
+    done = fba_sv1.ledger_done_priority
+    assert mtl["PRIORITY"].tolist() == [3000, done, 3000, done]
+
+
+def test_write_dither_compact(tmp_path, fbargs):
+    d = {
+        "TARGETID": np.array([100, 101, 102]),
+        "RA": np.array([150.0, 150.1, 150.2]),
+        "DEC": np.array([2.0, 2.1, 2.2]),
+    }
+    dithtileids = [80601, 80602]
+    rng = np.random.default_rng(0)
+    dras = [rng.normal(size=3).astype("f4") for tileid in dithtileids]
+    ddecs = [rng.normal(size=3).astype("f4") for tileid in dithtileids]
+    fassigns = []
+    for fibers, tids in [([0, 4], [100, 102]), ([1, 2, 3], [101, 100, 102])]:
+        fassign = np.zeros(len(fibers), dtype=[("FIBER", ">i4"), ("TARGETID", ">i8")])
+        fassign["FIBER"], fassign["TARGETID"] = fibers, tids
+        fassigns.append(fassign)
+    outfn = str(tmp_path / "080600-dither.fits")
+    fba_sv1.write_dither_compact(
+        outfn, d, [1, 0, 1], dithtileids, dras, ddecs, fassigns, {"DITHFMT": "compact"}
+    )
+    assert os.listdir(str(tmp_path)) == ["080600-dither.fits"]
+    assert fitsio.read_header(outfn, ext="PRIMARY")["DITHFMT"] == "compact"
+    base = fitsio.read(outfn, ext="TARGETS")
+    for key in ["TARGETID", "RA", "DEC"]:
+        assert np.array_equal(base[key], d[key])
+    assert base["DITHER_CLASS"].tolist() == [1, 0, 1]
+    assert fitsio.read(outfn, ext="DITHERS")["TILEID"].tolist() == dithtileids
+    dra, ddec = fitsio.read(outfn, ext="DRA"), fitsio.read(outfn, ext="DDEC")
+    fibassign = fitsio.read(outfn, ext="FIBERASSIGN")
+    assert fibassign.shape == (2, 5)
+    for i in range(len(dithtileids)):
+        # AR offsets and FIBER -> TARGETID assignment of each dither
+        assert np.array_equal(dra[i], dras[i]) & np.array_equal(ddec[i], ddecs[i])
+        fibers = np.flatnonzero(fibassign[i] >= 0)
+        assert fibers.tolist() == fassigns[i]["FIBER"].tolist()
+        assert fibassign[i, fibers].tolist() == fassigns[i]["TARGETID"].tolist()
+
+
+def test_get_summary(tmp_path, fbargs):
+    lrg, elg, std = [
+        fba_sv1.cmx_mask[msk] for msk in ["SV0_LRG", "SV0_ELG", "STD_FAINT"]
+    ]
+    fafn, mtlfn = str(tmp_path / "fiberassign.fits"), str(tmp_path / "targ.fits")
+    fa = np.zeros(
+        5,
+        dtype=[
+            ("TARGETID", ">i8"),
+            ("PETAL_LOC", ">i2"),
+            ("OBJTYPE", "S3"),
+            ("CMX_TARGET", ">i8"),
+        ],
+    )
+    fa["TARGETID"] = [1, 2, 1000, -1, 3]
+    fa["PETAL_LOC"] = [0, 0, 0, 0, 1]
+    fa["OBJTYPE"] = ["TGT", "TGT", "SKY", "BAD", "TGT"]
+    fa["CMX_TARGET"] = [lrg, elg, 0, 0, lrg | std]
+    # AR target 1 reachable from two petal 0 locations; 4, 5 reachable, not assigned
+    pot = np.zeros(6, dtype=[("TARGETID", ">i8"), ("LOCATION", ">i4")])
+    pot["TARGETID"] = [1, 1, 2, 4, 3, 5]
+    pot["LOCATION"] = [0, 1, 2, 3, 1000, 1001]
+    m = np.zeros(5, dtype=[("TARGETID", ">i8"), ("CMX_TARGET", ">i8")])
+    m["TARGETID"] = [1, 2, 3, 4, 5]
+    m["CMX_TARGET"] = [lrg, elg, lrg | std, lrg, elg]
+    fitsio.write(fafn, fa, extname="FIBERASSIGN", clobber=True)
+    fitsio.write(fafn, pot, extname="POTENTIAL_ASSIGNMENTS")
+    fitsio.write(mtlfn, m, extname="MTL", clobber=True)
+    fdict = {"msks": "SV0_LRG,SV0_ELG", "addstd": False}
+    d = fba_sv1.get_summary(80600, fafn, [mtlfn], fdict, 1.5)
+    assert d.dtype == fba_sv1.summarydatamodel.dtype
+    counts = {
+        (row["PETAL"], row["CLASS"].decode()): (row["NASSIGN"], row["NAVAIL"])
+        for row in d
+    }
+    assert counts[(-1, "TGT")] == (3, 5)
+    assert counts[(-1, "SV0_LRG")] == (2, 3)
+    assert counts[(-1, "SV0_ELG")] == (1, 2)
+    assert counts[(-1, "STD")] == (1, 1)
+    assert counts[(-1, "STD_FAINT")] == (1, 1)
+    assert counts[(-1, "SKY")] == (1, -1)
+    assert counts[(0, "TGT")] == (2, 3)
+    assert counts[(0, "SV0_LRG")] == (1, 2)
+    assert counts[(1, "SV0_ELG")] == (0, 1)
+    assert counts[(2, "TGT")] == (0, 0)
+    sel = (d["PETAL"] == -1) & (d["CLASS"] == b"SV0_LRG")
+    assert np.isclose(d["COMPLETENESS"][sel][0], 2 / 3)
+    assert np.isnan(d["COMPLETENESS"][d["CLASS"] == b"SKY"]).all()
+    assert (d["FATIME"] == 1.5).all() & (d["FLAVOR"] == b"scidark").all()
+
+
+# AR exact footprint test: within get_tile_radius_deg() of a tile centre
+def is_point_in_tiles(tiles, ras, decs):
+    ras, decs, tras, tdecs = [
+        np.radians(np.atleast_1d(x)) for x in [ras, decs, tiles["RA"], tiles["DEC"]]
+    ]
+    cossep = np.sin(decs)[:, None] * np.sin(tdecs) + np.cos(decs)[:, None] * np.cos(
+        tdecs
+    ) * np.cos(ras[:, None] - tras)
+    return (cossep > np.cos(np.radians(fba_sv1.get_tile_radius_deg()))).any(axis=1)
+
+
+def test_tilecat(tmp_path, fbargs, monkeypatch):
+    footdir = tmp_path / "desimodel" / "data" / "footprint"
+    footdir.mkdir(parents=True)
+    d = np.zeros(3, dtype=[("TILEID", ">i4"), ("RA", ">f8"), ("DEC", ">f8")])
+    d["TILEID"], d["RA"], d["DEC"] = [3, 1, 2], [30.0, 10.0, 20.0], 0.0
+    fitsio.write(str(footdir / "desi-tiles.fits"), d, extname="TILES")
+    monkeypatch.setenv("DESIMODEL", str(tmp_path / "desimodel"))
+    # AR only tiles 1, 2 are in desi
+    desitiles = d[d["TILEID"] < 3]
+    monkeypatch.setattr(fba_sv1, "dmio", Namespace(load_tiles=lambda: desitiles))
+    monkeypatch.setattr(fba_sv1, "is_point_in_desi", is_point_in_tiles)
+    monkeypatch.setattr(fba_sv1, "tilecat", {})
+    cachedir = str(tmp_path / "tile-cache")
+    tilecat = fba_sv1.get_tilecat(cachedir)
+    assert tilecat["TILES"]["TILEID"].tolist() == [1, 2, 3]
+    assert tilecat["DESITILES"]["RA"].tolist() == [10.0, 20.0]
+    assert len(os.listdir(cachedir)) == 1
+    ras, decs, found = fba_sv1.get_tile_radecs(tilecat, np.array([2, 5, 3]))
+    assert ras[[0, 2]].tolist() == [20.0, 30.0]
+    assert found.tolist() == [True, False, True]
+    # AR footmap + exact test on the edge pixels: same as the exact test
+    rng = np.random.default_rng(0)
+    ras, decs = rng.uniform(5, 35, 20000), rng.uniform(-5, 5, 20000)
+    isin = fba_sv1.is_in_desi(tilecat, ras, decs)
+    assert np.array_equal(isin, is_point_in_tiles(desitiles, ras, decs))
+    assert isin.sum() > 0
+    assert fba_sv1.is_in_desi(tilecat, 10.0, 0.0).tolist() == [True]
+    assert fba_sv1.is_in_desi(tilecat, 30.0, 0.0).tolist() == [False]
+    # AR new process: read from the cache, not recomputed
+    monkeypatch.setattr(fba_sv1, "tilecat", {})
+    monkeypatch.setattr(fba_sv1, "dmio", None)
+    footmap = fba_sv1.get_tilecat(cachedir)["FOOTMAP"]
+    assert np.array_equal(footmap, tilecat["FOOTMAP"])
+
+
+def test_run_stage_resume(tmp_path, fbargs, monkeypatch):
+    fbargs.progressfn, fbargs.tileid = str(tmp_path / "progress.jsonl"), 80600
+    monkeypatch.setattr(fba_sv1, "manifest", {"fn": None, "steps": []})
+    manifestfn = str(tmp_path / "080600-manifest.json")
+    outfns = {key: str(tmp_path / "{}.fits".format(key)) for key in ["sky", "gfa"]}
+    calls = []
+
+    def make(stage):
+        calls.append(stage)
+        d = np.zeros(3, dtype=[("TARGETID", ">i8")])
+        fitsio.write(outfns[stage], d, clobber=True)
+
+    def run(stage):
+        fba_sv1.run_stage(stage, make, (stage,), outfns[stage])
+
+    def events():
+        return [json.loads(line)["event"] for line in open(fbargs.progressfn)]
+
+    fba_sv1.init_manifest(manifestfn, False)
+    run("sky")
+    assert calls == ["sky"]
+    assert json.load(open(manifestfn))["steps"] == ["sky"]
+    assert events() == ["stage_start", "stage_end"]
+    assert json.loads(open(fbargs.progressfn).readlines()[-1])["nrows"] == 3
+    # AR resumed run: sky skipped, gfa run
+    fba_sv1.init_manifest(manifestfn, True)
+    run("sky")
+    run("gfa")
+    assert calls == ["sky", "gfa"]
+    assert json.load(open(manifestfn))["steps"] == ["sky", "gfa"]
+    assert events()[2:] == ["stage_skip", "stage_start", "stage_end"]
+    # AR resumed run, with a missing output: re-run
+    os.remove(outfns["sky"])
+    fba_sv1.init_manifest(manifestfn, True)
+    run("sky")
+    run("gfa")
+    assert calls == ["sky", "gfa", "sky"]
+    # AR new run: all re-run
+    fba_sv1.init_manifest(manifestfn, False)
+    assert json.load(open(manifestfn))["steps"] == []
+    run("sky")
+    run("gfa")
+    assert calls == ["sky", "gfa", "sky", "sky", "gfa"]
+
+
+# AR focal plane with two positioners (the second one not in a good state)
+# AR and one sky monitor fibre; flat radec -> focal plane projection (1 deg = 100 mm)
+@pytest.fixture
+def focalplane(monkeypatch):
+    fp = {
+        "LOCATION": np.array([0, 1, 1000]),
+        "PETAL": np.array([0, 0, 1]),
+        "DEVICE_TYPE": np.array(["POS", "POS", "ETC"]),
+        "OFFSET_X": np.array([0.0, 20.0, 0.0]),
+        "OFFSET_Y": np.array([0.0, 0.0, 20.0]),
+        "LENGTH_R1": np.full(3, 3.0),
+        "LENGTH_R2": np.full(3, 3.0),
+    }
+    state = {"LOCATION": fp["LOCATION"], "STATE": np.array([0, 1, 0])}
+    monkeypatch.setattr(
+        fba_sv1,
+        "dmio",
+        Namespace(load_focalplane=lambda t: (fp, None, state, "2020-03-06")),
+    )
+    monkeypatch.setattr(
+        fba_sv1,
+        "radec2xy",
+        lambda tra, tdec, ras, decs: (
+            100 * (np.asarray(ras) - tra),
+            100 * (np.asarray(decs) - tdec),
+        ),
+    )
+    monkeypatch.setattr(fba_sv1, "patrols", {})
+
+
+def test_prefilter_reach(tmp_path, fbargs, focalplane):
+    fn, outfn = str(tmp_path / "targ.fits"), str(tmp_path / "targ-reach.fits")
+    patrol = fba_sv1.get_patrol(fbargs.rundate)
+    assert patrol["LOCATION"].tolist() == [0, 1, 1000]
+    assert patrol["GOOD"].tolist() == [True, False, True]
+    # AR one target per device, one out of reach
+    d = np.zeros(4, dtype=[("TARGETID", ">i8"), ("RA", ">f8"), ("DEC", ">f8")])
+    d["TARGETID"] = [0, 1, 2, 3]
+    d["RA"] = [150.01, 150.21, 150.0, 150.5]
+    d["DEC"] = [2.0, 2.0, 2.21, 2.0]
+    fitsio.write(fn, d, extname="MTL", clobber=True)
+    # AR positioners not in a good state are considered, as by fiberassign
+    fba_sv1.prefilter_reach(fn, outfn, ["POS"], 150.0, 2.0)
+    assert fitsio.read(outfn)["TARGETID"].tolist() == [0, 1]
+    fba_sv1.prefilter_reach(fn, outfn, ["POS", "ETC"], 150.0, 2.0)
+    assert fitsio.read(outfn)["TARGETID"].tolist() == [0, 1, 2]
+    # AR no device of the requested type
+    fba_sv1.prefilter_reach(fn, outfn, ["GFA"], 150.0, 2.0)
+    assert fitsio.read_header(outfn, 1)["NAXIS2"] == 0
+
+
+def test_thin_skies(fbargs, focalplane):
+    # AR 40 sky positions around each device, the best ones around the first positioner
+    rng = np.random.default_rng(0)
+    d = np.zeros(
+        120,
+        dtype=[
+            ("TARGETID", ">i8"),
+            ("RA", ">f8"),
+            ("DEC", ">f8"),
+            ("BLOBDIST", ">f4"),
+        ],
+    )
+    d["TARGETID"] = np.arange(len(d))
+    d["RA"] = 150.0 + np.repeat([0.0, 0.2, 0.0], 40) + rng.uniform(-0.03, 0.03, 120)
+    d["DEC"] = 2.0 + np.repeat([0.0, 0.0, 0.2], 40) + rng.uniform(-0.03, 0.03, 120)
+    d["BLOBDIST"] = rng.uniform(size=len(d)) + np.repeat([1, 0, 0], 40)
+    fdict = {"nskypet": "10"}
+    for skythin, npet0, npet1 in [(0.5, 5, 5), (1, 10, 10), (3, 30, 30), (10, 80, 40)]:
+        tids = fba_sv1.thin_skies(d, fdict, 150.0, 2.0, skythin)["TARGETID"]
+        ndevs = np.bincount(tids // 40, minlength=3)
+        assert (ndevs[0] + ndevs[1], ndevs[2]) == (npet0, npet1)
+        # AR petal 0: the positioners contribute in turn
+        assert ndevs[0] - ndevs[1] in [0, 1]
+
+
+def test_claim_tile(tmp_path):
+    lockfn = str(tmp_path / "000000.lock")
+    assert fba_sv1.claim_tile(lockfn, "host:1", 600) == (True, False)
+    assert fba_sv1.claim_tile(lockfn, "host:2", 600) == (False, False)
+    # AR dead worker: no heartbeat for longer than stale
+    os.utime(lockfn, (0, 0))
+    assert fba_sv1.claim_tile(lockfn, "host:2", 600) == (True, True)
+    assert open(lockfn).read() == "host:2\n"
+    assert os.listdir(str(tmp_path)) == ["000000.lock"]
+
+
+def test_claim_tile_stale_race(tmp_path, monkeypatch):
+    lockfn = str(tmp_path / "000000.lock")
+    with open(lockfn, "w") as f:
+        f.write("host:0\n")
+    os.utime(lockfn, (0, 0))
+    rename = os.rename
+
+    # AR another worker takes the stale lock over between the age check and the rename
+    def rename_after_takeover(src, dst):
+        monkeypatch.setattr(os, "rename", rename)
+        assert fba_sv1.claim_tile(lockfn, "host:2", 600) == (True, True)
+        rename(src, dst)
+
+    monkeypatch.setattr(os, "rename", rename_after_takeover)
+    assert fba_sv1.claim_tile(lockfn, "host:1", 600) == (False, False)
+    assert open(lockfn).read() == "host:2\n"
+    assert os.listdir(str(tmp_path)) == ["000000.lock"]
+
+
+def test_run_worker_retries(tmp_path, fbargs, monkeypatch):
+    queuedir = str(tmp_path / "queue")
+    enqfn = str(tmp_path / "tiles.txt")
+    with open(enqfn, "w") as f:
+        f.write("--tileid 1\n--tileid 2\n")
+    # AR tile 1 always fails, tile 2 fails once
+    runs = []
+
+    def run(cmd):
+        runs.append(cmd[cmd.index("--tileid") + 1 :])
+        failed = (runs[-1][0] == "1") | (runs[-1] == ["2"])
+        return Namespace(returncode=int(failed))
+
+    monkeypatch.setattr(fba_sv1.subprocess, "run", run)
+    wargs = Namespace(
+        queuedir=queuedir,
+        enqueue=enqfn,
+        heartbeat=60.0,
+        stale=600.0,
+        retries=2,
+        wait="n",
+    )
+    assert fba_sv1.run_worker(wargs, ["--outdir", "out"]) == 1
+    resumed = ["--resume", "y"]
+    assert runs == [["1"], ["1"] + resumed, ["1"] + resumed, ["2"], ["2"] + resumed]
+    donedir = os.path.join(queuedir, "done")
+    assert sorted(os.listdir(donedir)) == [
+        "000000-000001.failed-0.json",
+        "000000-000001.failed-1.json",
+        "000000-000001.json",
+        "000001-000002.failed-0.json",
+        "000001-000002.json",
+    ]
+    res = json.load(open(os.path.join(donedir, "000000-000001.json")))
+    assert (res["status"], res["attempt"]) == ("failed", 2)
+    res = json.load(open(os.path.join(donedir, "000001-000002.json")))
+    assert (res["status"], res["attempt"]) == ("done", 1)
+    assert os.listdir(os.path.join(queuedir, "claims")) == []
+    # AR nothing left to run
+    wargs.enqueue = None
+    assert fba_sv1.run_worker(wargs, ["--outdir", "out"]) == 0
+    assert len(runs) == 5
+
+
+def test_arrow_round_trip(tmp_path, fbargs):
+    pytest.importorskip("pyarrow")
+    if fba_sv1.pa is None:
+        pytest.skip("pyarrow not importable by fba_sv1")
+    fbargs.intermediate_format = "arrow"
+    d = np.zeros(
+        5,
+        dtype=[
+            ("TARGETID", ">i8"),
+            ("RA", ">f8"),
+            ("BRICKNAME", "S8"),
+            ("FLUX_IVAR", ">f4", (2,)),
+        ],
+    )
+    d["TARGETID"] = 100 + np.arange(len(d))
+    d["RA"] = np.linspace(10, 11, len(d))
+    d["BRICKNAME"] = ["0100p{:03d}".format(i) for i in range(len(d))]
+    d["FLUX_IVAR"] = np.arange(2 * len(d)).reshape(len(d), 2)
+    fn = str(tmp_path / "000000-targ.fits")
+    hdr = fitsio.FITSHDR([{"name": "SURVEY", "value": "cmx"}])
+    fitsio.write(fn, d, header=hdr, extname="MTL", clobber=True)
+    fba_sv1.write_arrow(fn, d)
+    assert os.path.isfile(str(tmp_path / "000000-targ.arrow"))
+    a = fba_sv1.read_product(fn)
+    assert list(a.keys()) == list(d.dtype.names)
+    for name in d.dtype.names:
+        assert np.array_equal(a[name], d[name])
+    assert list(fba_sv1.read_product(fn, ["RA"]).keys()) == ["RA"]
+    # AR edited copy of some rows, e.g. for the dithers
+    outfn = str(tmp_path / "000000-targ-dither.fits")
+    fba_sv1.write_product_rows(
+        fn, outfn, [1, 3], cols={"RA": [0.0, 1.0]}, keys={"DITHER": "y"}
+    )
+    out, outhdr = fitsio.read(outfn, ext=1, header=True)
+    assert out["TARGETID"].tolist() == [101, 103]
+    assert out["RA"].tolist() == [0.0, 1.0]
+    assert np.array_equal(out["FLUX_IVAR"], d["FLUX_IVAR"][[1, 3]])
+    assert out["BRICKNAME"].tolist() == ["0100p001", "0100p003"]
+    assert (outhdr["SURVEY"], outhdr["DITHER"]) == ("cmx", "y")